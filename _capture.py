@@ -0,0 +1,144 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+
+import sys
+import time
+
+from PyQt5.QtCore import (QPoint, QRect)
+from PyQt5.QtGui import (QImage, QGuiApplication)
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+
+# Бэкенды захвата экрана. grab возвращает список кусков (target_rect, image, source_rect),
+# которые потом склеиваются в кадр в Utils.compose_capture_frame;
+# screens - список пар (screen, geometry) из ScreenGeometryCache.
+# Вызывать grab можно только из GUI-потока
+
+
+class QtCaptureBackend():
+
+    name = 'qt'
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def grab(self, capture_rect, screens):
+        # с каждого экрана берётся только та часть, что попадает в область захвата
+        pieces = []
+        for screen, screen_geometry in screens:
+            region = screen_geometry.intersected(capture_rect)
+            if region.isEmpty():
+                continue
+            local = region.translated(-screen_geometry.topLeft())
+            image = screen.grabWindow(0, local.x(), local.y(), local.width(), local.height()).toImage()
+            target_rect = region.translated(-capture_rect.topLeft())
+            pieces.append((target_rect, image, image.rect()))
+        return pieces
+
+
+class MssCaptureBackend():
+
+    # X11 через MIT-SHM: сервер пишет пиксели в общую память, откуда mss
+    # делает одну копию в bytearray, а QImage уже ничего не копирует и лишь ссылается на этот буфер.
+    # Координаты mss в физических пикселях, поэтому бэкенд доступен, только когда масштаб экранов 1
+
+    name = 'mss'
+
+    def __init__(self):
+        self.sct = None
+
+    @staticmethod
+    def is_available():
+        if mss is None or not sys.platform.startswith('linux'):
+            return False
+        if QGuiApplication.platformName() != 'xcb':
+            return False
+        return all(screen.devicePixelRatio() == 1.0 for screen in QGuiApplication.screens())
+
+    def grab(self, capture_rect, screens):
+        if self.sct is None:
+            self.sct = mss.mss()
+        monitor = {
+            'left': capture_rect.left(),
+            'top': capture_rect.top(),
+            'width': capture_rect.width(),
+            'height': capture_rect.height(),
+        }
+        shot = self.sct.grab(monitor)
+        width, height = shot.size
+        image = QImage(shot.raw, width, height, width*4, QImage.Format_RGB32)
+        rect = QRect(QPoint(0, 0), image.size())
+        return [(rect, image, rect)]
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
+
+
+BACKENDS = (MssCaptureBackend, QtCaptureBackend)
+
+
+def available_backends():
+    return [cls() for cls in BACKENDS if cls.is_available()]
+
+
+def benchmark_backend(backend, capture_rect, screens, frames=10):
+    """
+        возвращает среднее время захвата одного кадра в секундах
+    """
+    backend.grab(capture_rect, screens)
+    start = time.perf_counter()
+    for n in range(frames):
+        backend.grab(capture_rect, screens)
+    return (time.perf_counter() - start)/frames
+
+
+def choose_backend(capture_rect, screens, name='auto', frames=10):
+    """
+        возвращает пару (backend, results), где results - словарь
+        с замерами по каждому доступному бэкенду;
+        бэкенд с именем name выбирается без замеров, если он доступен
+    """
+    backends = available_backends()
+    for backend in backends:
+        if backend.name == name:
+            return backend, {}
+    results = {}
+    for backend in backends:
+        try:
+            results[backend.name] = benchmark_backend(backend, capture_rect, screens, frames=frames)
+        except Exception:
+            continue
+    fastest = min(results, key=results.get, default=QtCaptureBackend.name)
+    chosen = QtCaptureBackend()
+    for backend in backends:
+        if backend.name == fastest:
+            chosen = backend
+        elif hasattr(backend, 'close'):
+            backend.close()
+    return chosen, results
@@ -0,0 +1,418 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+
+import struct
+import threading
+import time
+import zlib
+from fractions import Fraction
+
+from PyQt5.QtCore import (QByteArray, QBuffer, QIODevice, Qt)
+from PyQt5.QtGui import (QImage, QImageWriter)
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+from _protocol import ProtocolError, zlib_decompress, lz4_decompress
+
+
+RAW_HEADER = struct.Struct('>II')
+# больше пикселей в сыром кадре не бывает даже у нескольких 4K-мониторов,
+# а заголовок приходит от собеседника и верить ему на слово нельзя
+RAW_MAX_PIXELS = 32*1024*1024
+
+
+class FrameCodec():
+
+    # межкадровый кодек хранит состояние между кадрами,
+    # поэтому кодирует не он сам, а созданные им кодировщик и декодер
+    inter_frame = False
+
+    def __init__(self, name, lossless):
+        self.name = name
+        self.lossless = lossless
+
+        self.stats_lock = threading.Lock()
+        self.frames_count = 0
+        self.pixels_count = 0
+        self.bytes_count = 0
+        self.encode_time = 0.0
+        self.last_used = 0
+
+    def encode(self, image, quality):
+        start = time.perf_counter()
+        data = self.encode_image(image, quality)
+        self.record(image.width()*image.height(), len(data), time.perf_counter() - start)
+        return data
+
+    def record(self, pixels, size, duration):
+        with self.stats_lock:
+            self.frames_count += 1
+            self.pixels_count += pixels
+            self.bytes_count += size
+            self.encode_time += duration
+
+    def encode_image(self, image, quality):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def estimated_cost(self, pixels, throughput):
+        """
+            сколько секунд займёт кодирование и отправка кадра из pixels пикселей
+        """
+        with self.stats_lock:
+            if self.pixels_count == 0:
+                return 0.0
+            seconds_per_pixel = self.encode_time/self.pixels_count
+            bytes_per_pixel = self.bytes_count/self.pixels_count
+        return pixels*(seconds_per_pixel + bytes_per_pixel/throughput)
+
+    def info(self):
+        with self.stats_lock:
+            if self.frames_count == 0:
+                return f'{self.name}: not used yet'
+            avg_size = self.bytes_count/self.frames_count
+            avg_time = self.encode_time/self.frames_count*1000
+            bpp = self.bytes_count*8/self.pixels_count
+        return f'{self.name}: {self.frames_count} frames, avg {avg_size/1024:.1f} KB, ' + \
+                    f'{bpp:.2f} bits per pixel, avg encode {avg_time:.1f} ms'
+
+
+class QtImageCodec(FrameCodec):
+
+    def __init__(self, name, lossless, image_format):
+        super().__init__(name, lossless)
+        self.image_format = image_format
+
+    def encode_image(self, image, quality):
+        byte_array = QByteArray()
+        buffer = QBuffer(byte_array)
+        buffer.open(QIODevice.WriteOnly)
+        if self.lossless:
+            quality = -1
+        image.save(buffer, self.image_format, quality=quality)
+        # QByteArray уходит в сокет как есть, без копии в bytes
+        return byte_array
+
+    def decode(self, data):
+        image = QImage()
+        image.loadFromData(data, self.image_format)
+        return image
+
+
+class PaletteCodec(QtImageCodec):
+
+    # Для экранов с текстом, где цветов обычно немного:
+    # если цветов не больше 256, то Qt строит точную палитру и потерь нет,
+    # а если больше, то кадр уходит обычным png, и кодек всё равно остаётся без потерь
+
+    def __init__(self, name):
+        super().__init__(name, True, 'png')
+        self.fallback_count = 0
+
+    def encode_image(self, image, quality):
+        indexed = image.convertToFormat(QImage.Format_Indexed8, Qt.ThresholdDither | Qt.AvoidDither)
+        if indexed.convertToFormat(image.format()) != image:
+            with self.stats_lock:
+                self.fallback_count += 1
+            return super().encode_image(image, quality)
+        return super().encode_image(indexed, quality)
+
+    def info(self):
+        return super().info() + f', {self.fallback_count} frames with too many colours sent as png'
+
+    def decode(self, data):
+        return super().decode(data).convertToFormat(QImage.Format_RGB32)
+
+
+class RawCodec(FrameCodec):
+
+    def __init__(self, name, compress, decompress):
+        """
+            decompress(data, max_size) распаковывает не больше max_size+1 байт, как в _protocol.py
+        """
+        super().__init__(name, True)
+        self.compress = compress
+        self.decompress = decompress
+
+    def encode_image(self, image, quality):
+        if image.format() != QImage.Format_RGB32:
+            image = image.convertToFormat(QImage.Format_RGB32)
+        bits = image.constBits()
+        bits.setsize(image.sizeInBytes())
+        header = RAW_HEADER.pack(image.width(), image.height())
+        return header + self.compress(memoryview(bits))
+
+    def decode(self, data):
+        if len(data) < RAW_HEADER.size:
+            raise ProtocolError(f'{self.name} frame of {len(data)} bytes has no header')
+        width, height = RAW_HEADER.unpack_from(data)
+        if not 0 < width*height <= RAW_MAX_PIXELS:
+            raise ProtocolError(f'{self.name} frame {width}x{height} is out of bounds')
+        size = width*height*4
+        try:
+            pixels = self.decompress(bytes(data[RAW_HEADER.size:]), size)
+        except Exception as e:
+            raise ProtocolError(f'broken {self.name} data: {e}')
+        if len(pixels) != size:
+            # QImage читал бы пиксели за концом буфера
+            raise ProtocolError(f'{self.name} frame {width}x{height} has {len(pixels)} bytes of pixels instead of {size}')
+        image = QImage(pixels, width, height, width*4, QImage.Format_RGB32)
+        # QImage не владеет буфером pixels, поэтому копируем
+        return image.copy()
+
+
+class VideoCodec(FrameCodec):
+
+    inter_frame = True
+
+    def __init__(self, name, encoder_name, decoder_name):
+        super().__init__(name, False)
+        self.encoder_name = encoder_name
+        self.decoder_name = decoder_name
+
+    def create_encoder(self):
+        return VideoStreamEncoder(self)
+
+    def create_decoder(self):
+        return VideoStreamDecoder(self)
+
+    @staticmethod
+    def is_available(encoder_name, decoder_name):
+        if av is None:
+            return False
+        return encoder_name in av.codecs_available and decoder_name in av.codecs_available
+
+
+class VideoStreamEncoder():
+
+    # Кодировщик одного потока кадров. Ключевые кадры делаются только по запросу:
+    # их расписание ведёт TileDeltaEncoder, как и для тайлов
+
+    CRF_RANGE = (40, 18) # для качества 0 и 100
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.context = None
+        self.params = None
+        self.frame_index = 0
+
+    def open(self, width, height, quality):
+        low, high = self.CRF_RANGE
+        crf = round(low + (high - low)*quality/100)
+        context = av.CodecContext.create(self.codec.encoder_name, 'w')
+        context.width = width
+        context.height = height
+        context.pix_fmt = 'yuv420p'
+        context.time_base = Fraction(1, 1000)
+        context.gop_size = 1000000
+        context.max_b_frames = 0
+        context.options = {
+            'preset': 'ultrafast',
+            'tune': 'zerolatency',
+            'crf': str(crf),
+        }
+        context.open()
+        self.context = context
+        self.params = (width, height, quality)
+        self.frame_index = 0
+
+    def encode(self, image, quality, keyframe=False):
+        """
+            стороны image должны быть чётными;
+            возвращает пару (data, is_keyframe)
+        """
+        start = time.perf_counter()
+        width, height = image.width(), image.height()
+        # качество меняется часто, а новое crf требует нового кодировщика и ключевого кадра,
+        # поэтому оно вступает в силу только со следующим ключевым кадром
+        if self.params is None or self.params[:2] != (width, height) or keyframe and self.params[2] != quality:
+            self.open(width, height, quality)
+            keyframe = True
+
+        frame = av.VideoFrame(width, height, 'bgra')
+        plane = frame.planes[0]
+        bits = image.constBits()
+        bits.setsize(image.sizeInBytes())
+        source = memoryview(bits)
+        target = memoryview(plane)
+        bytes_per_line = image.bytesPerLine()
+        line_size = plane.line_size
+        if line_size == bytes_per_line:
+            target[:bytes_per_line*height] = source[:bytes_per_line*height]
+        else:
+            row = width*4
+            for y in range(height):
+                target[y*line_size:y*line_size+row] = source[y*bytes_per_line:y*bytes_per_line+row]
+
+        frame.pts = self.frame_index
+        self.frame_index += 1
+        if keyframe:
+            frame.pict_type = av.video.frame.PictureType.I
+
+        packets = self.context.encode(frame.reformat(format='yuv420p'))
+        data = b''.join(bytes(packet) for packet in packets)
+        is_keyframe = any(packet.is_keyframe for packet in packets)
+        self.codec.record(width*height, len(data), time.perf_counter() - start)
+        return data, is_keyframe
+
+
+class VideoStreamDecoder():
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.context = av.CodecContext.create(codec.decoder_name, 'r')
+        self.has_keyframe = False
+
+    def decode(self, data, is_keyframe):
+        """
+            возвращает None, если декодировать нечего или не от чего,
+            и тогда нужен ключевой кадр
+        """
+        if is_keyframe:
+            self.has_keyframe = True
+        if not self.has_keyframe or not data:
+            return None
+        try:
+            frames = self.context.decode(av.Packet(bytes(data)))
+        except av.error.FFmpegError:
+            self.has_keyframe = False
+            return None
+        if not frames:
+            return None
+        frame = frames[-1].reformat(format='bgra')
+        plane = frame.planes[0]
+        image = QImage(bytes(plane), frame.width, frame.height, plane.line_size, QImage.Format_RGB32)
+        return image.copy()
+
+
+class FrameCodecs():
+
+    # Реестр кодеков кадров. Набор доступных кодеков отправляется в приветствии,
+    # и отправитель выбирает кодек только из тех, что умеют обе стороны
+
+    PROBE_INTERVAL = 50 # frames
+    DEFAULT_THROUGHPUT = 10*1024*1024 # bytes per second, 100 Mbit LAN
+
+    codecs = {}
+    choose_counter = 0
+
+    @classmethod
+    def register(cls, codec):
+        cls.codecs[codec.name] = codec
+
+    @classmethod
+    def init(cls, allowed=None):
+        cls.codecs.clear()
+        writable = [bytes(f).decode() for f in QImageWriter.supportedImageFormats()]
+        cls.register(QtImageCodec('jpg', False, 'jpg'))
+        if 'webp' in writable:
+            cls.register(QtImageCodec('webp', False, 'webp'))
+        cls.register(QtImageCodec('png', True, 'png'))
+        cls.register(PaletteCodec('png8'))
+        cls.register(RawCodec('raw-zlib', zlib_compress_fast, zlib_decompress))
+        if lz4 is not None:
+            cls.register(RawCodec('raw-lz4', lz4.frame.compress, lz4_decompress))
+        if VideoCodec.is_available('libx264', 'h264'):
+            cls.register(VideoCodec('h264', 'libx264', 'h264'))
+        if allowed:
+            for name in list(cls.codecs.keys()):
+                if name not in allowed and name != 'jpg':
+                    cls.codecs.pop(name)
+
+    @classmethod
+    def names(cls):
+        return list(cls.codecs.keys())
+
+    @classmethod
+    def get(cls, name):
+        return cls.codecs.get(name)
+
+    @classmethod
+    def decoder(cls, name, inter_frame=False):
+        """
+            кодек для кадра от собеседника: имя приходит по сети,
+            поэтому незнакомый кодек или кодек не того вида даёт ProtocolError
+        """
+        codec = cls.codecs.get(name) if isinstance(name, str) else None
+        if codec is None or codec.inter_frame != inter_frame:
+            raise ProtocolError(f'unexpected frame codec {name!r}')
+        return codec
+
+    @classmethod
+    def mutual(cls, peer_codecs):
+        return tuple(name for name in cls.codecs.keys() if name in peer_codecs)
+
+    @classmethod
+    def choose(cls, names, pixels, throughput=None):
+        """
+            из кодеков names выбирается тот, у которого меньше всего
+            оценочное время кодирования и отправки кадра;
+            неопробованные кодеки и периодически остальные пробуются заново
+        """
+        candidates = [cls.codecs[n] for n in names if n in cls.codecs]
+        if not candidates:
+            return cls.codecs['jpg']
+        throughput = throughput or cls.DEFAULT_THROUGHPUT
+
+        cls.choose_counter += 1
+        for codec in candidates:
+            if codec.frames_count == 0:
+                return codec
+        if cls.choose_counter % cls.PROBE_INTERVAL == 0:
+            codec = min(candidates, key=lambda c: c.last_used)
+        else:
+            codec = min(candidates, key=lambda c: c.estimated_cost(pixels, throughput))
+        codec.last_used = cls.choose_counter
+        return codec
+
+    @classmethod
+    def candidates(cls, peer_codecs, mode):
+        """
+            mode - имя конкретного кодека, 'lossless' или 'auto' (любой кодек с потерями)
+        """
+        mutual = cls.mutual(peer_codecs)
+        if mode in mutual:
+            return (mode,)
+        # межкадровые кодеки выбираются только явно, автоматический выбор
+        # идёт из покадровых, и туда же откатываемся, если у одной из сторон нет PyAV
+        lossless = mode == 'lossless'
+        names = tuple(n for n in mutual if cls.codecs[n].lossless == lossless and not cls.codecs[n].inter_frame)
+        return names or ('jpg',)
+
+    @classmethod
+    def info(cls):
+        return '\n'.join(codec.info() for codec in cls.codecs.values())
+
+
+def zlib_compress_fast(data):
+    # первый уровень сжатия: на экранных данных он почти не уступает остальным, но в разы быстрее
+    return zlib.compress(data, 1)
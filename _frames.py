@@ -0,0 +1,626 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+
+import zlib
+import operator
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+
+TileDelta = namedtuple('TileDelta', 'is_keyframe dirty_rects move cache_ops')
+
+
+class TileDeltaEncoder():
+
+    # Кадр режется на вертикальные полосы шириной в тайл,
+    # для каждой полосы хранится crc32 каждой её строки.
+    # Тайл считается изменённым, если поменялась хотя бы одна его строка.
+    # Сравнение списков хешей делается на стороне C и поэтому дёшево
+
+    def __init__(self, tile_size=64, keyframe_interval=125, keyframe_area_ratio=0.6, refine_delay=6,
+                                                                                    min_move_rows=32):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_area_ratio = keyframe_area_ratio
+        self.refine_delay = refine_delay
+        self.min_move_rows = min_move_rows
+
+        self.layout = None
+        self.rows_hashes = None
+        self.frame_hash = None
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = True
+
+        # для постепенного улучшения: сколько кадров подряд тайл не менялся
+        # и был ли он уже отправлен в хорошем качестве
+        self.tiles_ages = None
+        self.tiles_refined = None
+
+        self.invalidated_rects = []
+        self.invalidation_lock = threading.Lock()
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def take_state(self, other):
+        # продолжить с того кадра, на котором остановился другой кодировщик
+        self.layout = other.layout
+        if other.rows_hashes is not None:
+            self.rows_hashes = [list(strip) for strip in other.rows_hashes]
+        self.frames_since_keyframe = other.frames_since_keyframe
+        self.keyframe_requested = other.keyframe_requested
+        if other.tiles_ages is not None:
+            self.tiles_ages = [list(row) for row in other.tiles_ages]
+            self.tiles_refined = [list(row) for row in other.tiles_refined]
+        with other.invalidation_lock:
+            self.invalidate(other.invalidated_rects)
+
+    def invalidate(self, rects):
+        # может вызываться из другого потока: прямоугольники будут
+        # отправлены заново со следующим кадром, даже если они не менялись
+        with self.invalidation_lock:
+            self.invalidated_rects.extend(rects)
+
+    def is_static(self, buffer, layout=None):
+        """
+            True, если кадр целиком совпал с предыдущим и отправлять нечего;
+            хеш всего буфера считается одним вызовом и обходится дешевле хешей строк
+        """
+        frame_hash = (zlib.crc32(buffer), layout)
+        with self.invalidation_lock:
+            has_invalidation = bool(self.invalidated_rects)
+        is_static = frame_hash == self.frame_hash and not self.keyframe_requested and not has_invalidation
+        self.frame_hash = frame_hash
+        return is_static
+
+    def apply_invalidation(self):
+        with self.invalidation_lock:
+            rects = self.invalidated_rects
+            self.invalidated_rects = []
+        if self.rows_hashes is None:
+            return
+        ts = self.tile_size
+        for left, top, width, height in rects:
+            for strip in self.rows_hashes[left//ts:(left+width+ts-1)//ts]:
+                strip[top:top+height] = [-1]*len(strip[top:top+height])
+
+    def hash_rows(self, buffer, width, height, bytes_per_line, bytes_per_pixel=4):
+        crc32 = zlib.crc32
+        strip_bytes = self.tile_size*bytes_per_pixel
+        row_bytes = width*bytes_per_pixel
+        lines_offsets = range(0, height*bytes_per_line, bytes_per_line)
+        strips = []
+        for start in range(0, row_bytes, strip_bytes):
+            end = min(start + strip_bytes, row_bytes)
+            strips.append([crc32(buffer[offset+start:offset+end]) for offset in lines_offsets])
+        return strips
+
+    def find_dirty_rects(self, before_rows, rows_hashes, width, height):
+        ts = self.tile_size
+        dirty_rects = []
+        for top in range(0, height, ts):
+            bottom = min(top + ts, height)
+            span_start = None
+            for n, (before, current) in enumerate(zip(before_rows, rows_hashes)):
+                is_dirty = before[top:bottom] != current[top:bottom]
+                if is_dirty and span_start is None:
+                    span_start = n
+                elif not is_dirty and span_start is not None:
+                    dirty_rects.append(self.span_rect(span_start, n, top, bottom, width))
+                    span_start = None
+            if span_start is not None:
+                dirty_rects.append(self.span_rect(span_start, len(rows_hashes), top, bottom, width))
+        return dirty_rects
+
+    def span_rect(self, start_tile, end_tile, top, bottom, width):
+        # соседние изменённые тайлы одного ряда склеиваются в один прямоугольник,
+        # чтобы не платить за заголовок jpeg на каждом тайле
+        left = start_tile*self.tile_size
+        right = min(end_tile*self.tile_size, width)
+        return (left, top, right-left, bottom-top)
+
+    def find_vertical_move(self, before_rows, rows_hashes, width, height):
+        """
+            ищет прямоугольник, который целиком сдвинулся по вертикали (прокрутка,
+            перетаскивание окна вверх-вниз); возвращает (left, top, width, height, dy),
+            где top - куда прямоугольник сдвинулся, а top - dy - откуда, или None
+        """
+        changed_strips = [n for n, (before, current) in enumerate(zip(before_rows, rows_hashes)) if before != current]
+        if not changed_strips:
+            return None
+
+        # изменённые строки голосуют за свой сдвиг, если такая же строка была в прошлом кадре
+        # ровно в одном месте: одноцветные строки ничего не говорят;
+        # для скорости голосуют каждая четвёртая строка и не больше восьми полос
+        votes = Counter()
+        step = max(1, len(changed_strips)//8)
+        for n in changed_strips[::step]:
+            before, current = before_rows[n], rows_hashes[n]
+            counts = Counter(before)
+            positions = {row_hash: row for row, row_hash in enumerate(before) if counts[row_hash] == 1}
+            for row in range(0, height, 4):
+                if before[row] != current[row]:
+                    old_row = positions.get(current[row])
+                    if old_row is not None:
+                        votes[row - old_row] += 1
+        if not votes:
+            return None
+        dy, count = votes.most_common(1)[0]
+        if count < self.min_move_rows//4:
+            return None
+
+        # полосы, которые сдвинулись на dy, и самая длинная их непрерывная последовательность
+        first_row, last_row = max(0, dy), min(height, height + dy)
+        moved_strips = []
+        strips_matches = {}
+        for n in changed_strips:
+            before, current = before_rows[n], rows_hashes[n]
+            matches = list(map(operator.eq, current[first_row:last_row], before[first_row-dy:last_row-dy]))
+            unchanged = sum(map(operator.eq, current[first_row:last_row], before[first_row:last_row]))
+            if sum(matches) - unchanged >= self.min_move_rows//4:
+                moved_strips.append(n)
+                strips_matches[n] = matches
+        span = self.longest_run(moved_strips)
+        if span is None:
+            return None
+        first_strip, last_strip = span
+
+        # строки, которые сдвинулись во всех этих полосах сразу
+        moved = strips_matches[first_strip]
+        for n in range(first_strip + 1, last_strip + 1):
+            moved = list(map(operator.and_, moved, strips_matches[n]))
+        rows_span = self.longest_run([first_row + i for i, is_moved in enumerate(moved) if is_moved])
+        if rows_span is None:
+            return None
+        top, bottom = rows_span
+        if bottom - top + 1 < self.min_move_rows:
+            return None
+
+        left = first_strip*self.tile_size
+        right = min((last_strip + 1)*self.tile_size, width)
+        return (left, top, right - left, bottom - top + 1, dy)
+
+    @staticmethod
+    def longest_run(numbers):
+        # самый длинный отрезок подряд идущих чисел из отсортированного списка
+        best = None
+        start = None
+        for i, number in enumerate(numbers):
+            if start is None or number != numbers[i-1] + 1:
+                start = number
+            if best is None or number - start > best[1] - best[0]:
+                best = (start, number)
+        return best
+
+    def apply_move(self, before_rows, move):
+        # то же самое, что сделает портал со своей картинкой
+        left, top, width, height, dy = move
+        ts = self.tile_size
+        moved_rows = [list(strip) for strip in before_rows]
+        for n in range(left//ts, (left + width + ts - 1)//ts):
+            moved_rows[n][top:top+height] = before_rows[n][top-dy:top-dy+height]
+        return moved_rows
+
+    def apply_tile_cache(self, rows_hashes, rects, tile_cache, width, dry_run=False):
+        """
+            делит прямоугольники на тайлы и ищет каждый тайл в кеше по хешам его строк;
+            возвращает (cache_ops, miss_rects), где cache_ops - список [x, y, w, h, id, hit]
+            в том же порядке, в каком к кешу должен обращаться и портал,
+            а miss_rects - прямоугольники из тайлов, которых в кеше не было;
+            при dry_run кеш не меняется
+        """
+        ts = self.tile_size
+        cache_ops = []
+        miss_rects = []
+        for left, top, w, h in rects:
+            span_start = None
+            first_col, end_col = left//ts, (left + w + ts - 1)//ts
+            for col in range(first_col, end_col):
+                x = col*ts
+                key = (min(ts, width - x), h, hash(tuple(rows_hashes[col][top:top+h])))
+                if dry_run:
+                    tile_id = tile_cache.peek(key)
+                else:
+                    tile_id = tile_cache.get(key)
+                is_hit = tile_id is not None
+                if not is_hit and not dry_run:
+                    tile_id = tile_cache.new_id()
+                    tile_cache.put(key, tile_id)
+                cache_ops.append([x, top, key[0], h, tile_id, is_hit])
+                if is_hit and span_start is not None:
+                    miss_rects.append(self.span_rect(span_start, col, top, top + h, width))
+                    span_start = None
+                elif not is_hit and span_start is None:
+                    span_start = col
+            if span_start is not None:
+                miss_rects.append(self.span_rect(span_start, end_col, top, top + h, width))
+        return cache_ops, miss_rects
+
+    def encode(self, buffer, width, height, bytes_per_line, layout=None, detect_moves=True, tile_cache=None):
+        """
+            возвращает TileDelta, где move - вертикальный сдвиг из find_vertical_move,
+            который надо применить до тайлов, или None, а cache_ops - обращения к кешу тайлов
+            из apply_tile_cache, и тогда dirty_rects - только тайлы, которых в кеше не нашлось;
+            layout - любое хешируемое описание области захвата,
+            при его смене кадр всегда будет ключевым
+        """
+        rows_hashes = self.hash_rows(buffer, width, height, bytes_per_line)
+        layout = (width, height, layout)
+        self.apply_invalidation()
+
+        is_keyframe = self.keyframe_requested or layout != self.layout
+        is_keyframe = is_keyframe or self.frames_since_keyframe + 1 >= self.keyframe_interval
+
+        dirty_rects = []
+        move = None
+        cache_ops = []
+        if not is_keyframe:
+            dirty_rects = self.find_dirty_rects(self.rows_hashes, rows_hashes, width, height)
+            if detect_moves and dirty_rects:
+                move = self.find_vertical_move(self.rows_hashes, rows_hashes, width, height)
+            if move is not None:
+                moved_rows = self.apply_move(self.rows_hashes, move)
+                moved_dirty_rects = self.find_dirty_rects(moved_rows, rows_hashes, width, height)
+                if sum(r[2]*r[3] for r in moved_dirty_rects) < sum(r[2]*r[3] for r in dirty_rects):
+                    dirty_rects = moved_dirty_rects
+                else:
+                    move = None
+            miss_rects = dirty_rects
+            if tile_cache is not None and dirty_rects:
+                # тайлы из кеша не в счёт: при переключении между окнами
+                # кадр может поменяться целиком, но почти весь найтись в кеше
+                miss_rects = self.apply_tile_cache(rows_hashes, dirty_rects, tile_cache, width, dry_run=True)[1]
+            dirty_area = sum(r[2]*r[3] for r in miss_rects)
+            if dirty_area >= width*height*self.keyframe_area_ratio:
+                is_keyframe = True
+                dirty_rects = []
+                move = None
+            elif tile_cache is not None and dirty_rects:
+                cache_ops, dirty_rects = self.apply_tile_cache(rows_hashes, dirty_rects, tile_cache, width)
+
+        if is_keyframe and tile_cache is not None:
+            # ключевой кадр тоже наполняет кеш, иначе к окну, показанному целиком, не вернуться из кеша
+            ts = self.tile_size
+            rows_rects = [(0, top, width, min(ts, height - top)) for top in range(0, height, ts)]
+            cache_ops = self.apply_tile_cache(rows_hashes, rows_rects, tile_cache, width)[0]
+
+        if is_keyframe:
+            self.frames_since_keyframe = 0
+            self.keyframe_requested = False
+        else:
+            self.frames_since_keyframe += 1
+
+        self.layout = layout
+        self.rows_hashes = rows_hashes
+        changed_rects = dirty_rects + [tuple(op[:4]) for op in cache_ops if op[5]]
+        if move is not None:
+            # сдвинутые тайлы могли быть черновиками, их потом надо улучшить заново
+            changed_rects.append(move[:4])
+        self.update_tiles_ages(is_keyframe, changed_rects, width, height)
+        return TileDelta(is_keyframe, dirty_rects, move, cache_ops)
+
+    def update_tiles_ages(self, is_keyframe, dirty_rects, width, height):
+        ts = self.tile_size
+        cols = (width + ts - 1)//ts
+        rows = (height + ts - 1)//ts
+        if is_keyframe or self.tiles_ages is None or len(self.tiles_ages) != rows \
+                                            or len(self.tiles_ages[0]) != cols:
+            self.tiles_ages = [[0]*cols for row in range(rows)]
+            self.tiles_refined = [[False]*cols for row in range(rows)]
+            return
+        for row in self.tiles_ages:
+            row[:] = [age + 1 for age in row]
+        for left, top, w, h in dirty_rects:
+            for row in range(top//ts, (top + h + ts - 1)//ts):
+                for col in range(left//ts, (left + w + ts - 1)//ts):
+                    self.tiles_ages[row][col] = 0
+                    self.tiles_refined[row][col] = False
+
+    def needs_refinement(self):
+        if self.tiles_refined is None:
+            return False
+        return not all(all(row) for row in self.tiles_refined)
+
+    def take_refinement(self, width, height, max_tiles):
+        """
+            возвращает прямоугольники из тайлов, которые не менялись refine_delay кадров
+            и ещё не отправлялись в хорошем качестве, но не больше max_tiles тайлов за раз
+        """
+        if self.tiles_ages is None:
+            return []
+        ts = self.tile_size
+        rects = []
+        count = 0
+        for row, (ages, refined) in enumerate(zip(self.tiles_ages, self.tiles_refined)):
+            top = row*ts
+            bottom = min(top + ts, height)
+            span_start = None
+            for col, age in enumerate(ages):
+                is_ready = age >= self.refine_delay and not refined[col] and count < max_tiles
+                if is_ready:
+                    refined[col] = True
+                    count += 1
+                    if span_start is None:
+                        span_start = col
+                elif span_start is not None:
+                    rects.append(self.span_rect(span_start, col, top, bottom, width))
+                    span_start = None
+            if span_start is not None:
+                rects.append(self.span_rect(span_start, len(ages), top, bottom, width))
+        return rects
+
+
+class TileCache():
+
+    # LRU-словарь тайлов, который отправитель и портал ведут синхронно:
+    # у отправителя ключ - хеш тайла, а значение - номер тайла,
+    # у портала ключ - номер тайла, а значение - сама картинка.
+    # Обе стороны обращаются к словарю в одном и том же порядке, поэтому и вытесняют одно и то же.
+    # Если синхронность нарушена (кадр выкинут, новый подписчик), то отправитель
+    # начинает новое поколение, и портал, увидев его номер, тоже очищает словарь.
+    # Номера поколений не повторяются между кешами, ведь портал может перейти с одного потока на другой
+
+    last_generation = 0
+    generation_lock = threading.Lock()
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.last_id = 0
+        self.reset_requested = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resets = 0
+
+    def request_reset(self):
+        # может вызываться из другого потока, сброс случится перед следующим кадром
+        self.reset_requested = True
+
+    def reset(self, generation=None, capacity=None):
+        self.entries.clear()
+        self.last_id = 0
+        self.reset_requested = False
+        if generation is None:
+            with TileCache.generation_lock:
+                TileCache.last_generation += 1
+                generation = TileCache.last_generation
+        self.generation = generation
+        if capacity is not None:
+            self.capacity = capacity
+        self.resets += 1
+
+    def new_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def peek(self, key):
+        return self.entries.get(key)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def take_state(self, other):
+        # новый поток продолжает с тем же кешем, что уже есть у портала
+        self.capacity = other.capacity
+        self.generation = other.generation
+        self.entries = OrderedDict(other.entries)
+        self.last_id = other.last_id
+        self.reset_requested = other.reset_requested
+
+    def fill(self, key, value):
+        # портал сначала заводит место под тайл, а картинку кладёт, когда тайл нарисован;
+        # порядок вытеснения при этом не меняется
+        if key in self.entries:
+            self.entries[key] = value
+
+    def info(self):
+        return f'generation {self.generation}, {len(self.entries)}/{self.capacity} tiles, ' + \
+                f'hits {self.hits}, misses {self.misses}, evictions {self.evictions}, resets {self.resets}'
+
+
+class AdaptiveStreamController():
+
+    # Замкнутый контур: по измеренному времени доставки кадров и пропускной способности
+    # подбираются качество jpeg, масштаб кадра и интервал между кадрами.
+    # Порядок, в котором параметры ухудшаются, зависит от предпочтения:
+    # для latency сначала жертвуем качеством, для quality - частотой кадров
+
+    LATENCY = 'latency'
+    QUALITY = 'quality'
+    MANUAL = 'manual'
+
+    QUALITY_STEPS = (20, 30, 40, 50, 60, 70, 80, 90)
+    SCALE_STEPS = (0.4, 0.5, 0.6, 0.75, 0.9, 1.0)
+
+    TARGET_LATENCY = {
+        LATENCY: 0.1,
+        QUALITY: 0.3,
+    }
+
+    ADJUST_INTERVAL = 0.5 # seconds
+    EWMA_FACTOR = 0.25
+
+    def __init__(self, preference=LATENCY, interval=40, min_interval=40, max_interval=1000):
+        self.preference = preference
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.interval = interval
+        self.quality_index = self.QUALITY_STEPS.index(50)
+        self.scale_index = len(self.SCALE_STEPS) - 1
+
+        self.reset_measurements()
+
+    def reset_measurements(self):
+        self.in_flight = []
+        self.bytes_written_total = 0
+        self.latency = None
+        self.throughput = None
+        self.frame_size = None
+        self.window_start = None
+        self.window_bytes = 0
+        self.adjust_timestamp = 0.0
+
+    @property
+    def quality(self):
+        return self.QUALITY_STEPS[self.quality_index]
+
+    @property
+    def scale(self):
+        return self.SCALE_STEPS[self.scale_index]
+
+    def set_preference(self, preference, interval=None):
+        self.preference = preference
+        if interval is not None:
+            self.interval = max(1, int(interval))
+        self.reset_measurements()
+
+    def ewma(self, old, new):
+        if old is None:
+            return new
+        return old + (new - old)*self.EWMA_FACTOR
+
+    def frame_queued(self, size, backlog, now):
+        """
+            backlog - сколько байт стоит в очереди сокета вместе с этим кадром,
+            кадр считается доставленным, когда сокет отправит все эти байты
+        """
+        self.in_flight.append((self.bytes_written_total + backlog, now))
+        self.frame_size = self.ewma(self.frame_size, size)
+
+    def bytes_written(self, count, now):
+        self.bytes_written_total += count
+
+        if self.window_start is None:
+            self.window_start = now
+        self.window_bytes += count
+        window_duration = now - self.window_start
+        if window_duration >= self.ADJUST_INTERVAL:
+            self.throughput = self.ewma(self.throughput, self.window_bytes/window_duration)
+            self.window_start = now
+            self.window_bytes = 0
+
+        while self.in_flight and self.in_flight[0][0] <= self.bytes_written_total:
+            mark, queued_timestamp = self.in_flight.pop(0)
+            self.latency = self.ewma(self.latency, now - queued_timestamp)
+
+    def socket_drained(self):
+        # окно замера пропускной способности имеет смысл, только пока сокет занят
+        self.window_start = None
+        self.window_bytes = 0
+
+    def adjust(self, now):
+        """
+            возвращает True, если параметры потока изменились
+        """
+        if self.preference == self.MANUAL or self.latency is None:
+            return False
+        if now - self.adjust_timestamp < self.ADJUST_INTERVAL:
+            return False
+        self.adjust_timestamp = now
+
+        target = self.TARGET_LATENCY[self.preference]
+        if self.latency > target:
+            return self.degrade()
+
+        if self.latency < target/2 and self.has_headroom():
+            return self.improve()
+
+        return False
+
+    def has_headroom(self):
+        if self.throughput is None or self.frame_size is None:
+            return True
+        required = self.frame_size*1000/self.interval
+        return required < self.throughput*0.7
+
+    def degrade(self):
+        if self.preference == self.LATENCY:
+            order = (self.lower_quality, self.lower_scale, self.lower_framerate)
+        else:
+            order = (self.lower_framerate, self.lower_scale, self.lower_quality)
+        return any(step() for step in order)
+
+    def improve(self):
+        if self.preference == self.LATENCY:
+            order = (self.raise_framerate, self.raise_scale, self.raise_quality)
+        else:
+            order = (self.raise_quality, self.raise_scale, self.raise_framerate)
+        return any(step() for step in order)
+
+    def lower_quality(self):
+        if self.quality_index > 0:
+            self.quality_index -= 1
+            return True
+        return False
+
+    def raise_quality(self):
+        if self.quality_index < len(self.QUALITY_STEPS) - 1:
+            self.quality_index += 1
+            return True
+        return False
+
+    def lower_scale(self):
+        if self.scale_index > 0:
+            self.scale_index -= 1
+            return True
+        return False
+
+    def raise_scale(self):
+        if self.scale_index < len(self.SCALE_STEPS) - 1:
+            self.scale_index += 1
+            return True
+        return False
+
+    def lower_framerate(self):
+        if self.interval < self.max_interval:
+            self.interval = min(self.max_interval, int(self.interval*1.25) + 1)
+            return True
+        return False
+
+    def raise_framerate(self):
+        if self.interval > self.min_interval:
+            self.interval = max(self.min_interval, int(self.interval/1.25))
+            return True
+        return False
+
+    def info(self):
+        latency = '-' if self.latency is None else f'{self.latency*1000:.0f} ms'
+        throughput = '-' if self.throughput is None else f'{self.throughput/1024:.0f} KB/s'
+        return f'{self.preference}: quality {self.quality}, scale {self.scale}, ' + \
+                    f'interval {self.interval} ms, latency {latency}, throughput {throughput}'
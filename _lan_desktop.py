@@ -27,7 +27,7 @@ import platform
 import json
 from functools import partial
 import hashlib
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, deque
 import builtins
 import subprocess
 import traceback
@@ -35,19 +35,30 @@ import locale
 import ctypes
 import webbrowser
 import ipaddress
+import math
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtNetwork import *
 
-import cbor2
 import pyautogui
 from no_dep_wakeonlan import send_magic_packet
 
 import threading
 
 from _utils import (fit_rect_into_rect, build_valid_rectF)
+from _frames import TileDeltaEncoder, TileCache, AdaptiveStreamController
+from _frame_codecs import FrameCodecs
+from _capture import (QtCaptureBackend, choose_backend)
+from _protocol import (MessageReader, OutboundScheduler, MessageStats, MessageCompressor, Priority, ProtocolError,
+                        HEADER, StreamedPayload, MediaPacketizer, MediaReassembler,
+                        compression_names, choose_compression,
+                        encode_message, decode_message, encode_datagram, decode_datagram, message_size,
+                        check_value, Optional,
+                        INPUT_EVENTS_FEATURE, FRAGMENTS_FEATURE, CHANNELS_FEATURE, MEDIA_FEATURE, MOUSE_EVENTS,
+                        MOUSE_BUTTONS,
+                        pack_input_event, unpack_input_event)
 from update import do_update
 
 try:
@@ -66,6 +77,8 @@ def print(*args, **kwargs):
 
 RegionInfo = namedtuple('RegionInfo', 'setter coords getter')
 PeerListItemData = namedtuple('PeerListItemData', 'is_remote ip mac')
+CaptureJob = namedtuple('CaptureJob', 'capture_size pieces screen_info layout quality scale codecs throughput refine_codecs tile_cache_size keyframes_only')
+EncodedFrame = namedtuple('EncodedFrame', 'buffers size is_keyframe dirty_rects')
 
 
 writing_lock = threading.Lock()
@@ -80,8 +93,41 @@ class Globals():
     BROADCASTPORT = 45000
 
     SCREENSHOT_SENDING_INTERVAL = 40 # for 25 FPS
+    SMALL_REGION_SENDING_INTERVAL = 16 # for 60 FPS
+    SMALL_REGION_AREA = 640*480
+
+    SCREEN_TILE_SIZE = 64
+    SCREEN_KEYFRAME_INTERVAL = 125 # frames, every 5 seconds at 25 FPS
+    KEYFRAME_REQUEST_INTERVAL = 1.0 # seconds
+    ENCODED_FRAMES_QUEUE_SIZE = 2
+    VIEWPORT_REPORT_INTERVAL = 300 # ms
+    VIEWPORT_SCALE_STEP = 0.05
+    SCREEN_SENDING_BACKLOG_LIMIT = 256*1024 # bytes waiting in the socket
+    SOCKET_WRITE_BUDGET = 128*1024 # bytes handed to the socket at once, the rest waits in the priority queues
+    SEND_SLICE_SIZE = 32*1024 # large messages are sent in slices of this size
+    MAX_MESSAGE_SIZE = 64*1024*1024 # larger incoming messages abort the connection
+    DEFAULT_MESSAGE_SIZE_LIMIT = 1024*1024 # binary part limit for types missing in Connection.message_size_limits
+    # файлы, которые уже сжаты, и сжимать их куски при отправке бесполезно
+    INCOMPRESSIBLE_EXTENSIONS = ('.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4',
+                                    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv',
+                                    '.avi', '.mov', '.webm', '.pdf', '.docx', '.xlsx', '.pptx', '.jar', '.apk')
+    HEARTBEAT_INTERVAL = 1.0 # seconds, must be well below the portal's 3-second timeout
+    IDLE_STATIC_FRAMES = 25 # static frames in a row before capture slows down
+    IDLE_CAPTURE_INTERVAL = 500 # ms
+    REFINE_DELAY_FRAMES = 6 # tile must stay unchanged this long before it is refined
+    REFINE_TILES_PER_FRAME = 48
+    REFINE_QUALITY = 90 # when the peers have no lossless codec in common
+    DRAFT_TILES_SCALE = 0.5
+    TILE_CACHE_MB = 32 # per peer, on both ends
+    BACKGROUND_SENDING_INTERVAL = 1000 # ms, the desktop around the user-defined capture region
+    BACKGROUND_QUALITY = 30
+    MEDIA_FEC_GROUP = 8 # UDP frame datagrams per parity datagram, 0 turns FEC off
 
     file_sending_timers = []
+    screen_encoders = []
+    capture_backend = QtCaptureBackend()
+    tile_cache_size = 0 # tiles, set from the settings
+    frame_streams = {}
 
     INT_SIZE = 4
     TCP_MESSAGE_HEADER_SIZE = INT_SIZE*3
@@ -89,7 +135,23 @@ class Globals():
     VERSION_INFO = "v0.92"
     AUTHOR_INFO = "by Sergei Krumas"
 
-    IMAGE_FORMAT = 'jpg'
+    DEFAULT_FRAME_CODEC = 'jpg' # для хостов, которые не присылают список кодеков
+    PROTOCOL_FEATURES = [INPUT_EVENTS_FEATURE, FRAGMENTS_FEATURE, CHANNELS_FEATURE, MEDIA_FEATURE]
+
+    # кадры и куски файлов идут по отдельным TCP-соединениям к тому же собеседнику,
+    # а основное соединение остаётся для управления, ввода и чата
+    PRIORITY_CHANNELS = {
+        Priority.VIDEO: 'video',
+        Priority.BULK: 'bulk',
+    }
+    # Immediate = 64, AF41 = 136, CS1 = 32, Network control = 224
+    SOCKET_OPTIONS = {
+        'control': {'buffer': 200000, 'read_buffer': 157000, 'low_delay': 1, 'tos': 224},
+        'video': {'buffer': 1024*1024, 'read_buffer': 1024*1024, 'low_delay': 1, 'tos': 136},
+        'bulk': {'buffer': 4*1024*1024, 'read_buffer': 1024*1024, 'low_delay': 0, 'tos': 32},
+        # UDP-сокеты кадров: кадр уходит пачкой датаграмм и должен целиком поместиться в буфер
+        'media': {'buffer': 4*1024*1024, 'read_buffer': 0, 'low_delay': 0, 'tos': 136},
+    }
     peers_list_filename = f'peers_list_{platform.system()}.list'
 
     client_keys_logger = None
@@ -166,37 +228,123 @@ class DataType:
     PlainText = 1
     Greeting = 2
     InfoStatus = 3
+    ChannelGreeting = 4
 
     ScreenData = 10
     MouseData = 11
     KeyboardData = 12
     FileData = 13
+    ScreenTilesData = 14
+    ScreenVideoData = 15
+    ScreenHeartbeat = 16
 
     ControlFPS = 20
     ControlUserDefinedCaptureRect = 21
     ControlCaptureScreen = 22
     ControlRequest = 23
+    ControlKeyframe = 24
+    ControlStreamingPreference = 25
+    ControlViewport = 26
+    ControlCodec = 27
+    ControlProgressive = 28
+    ControlTileCacheResync = 29
+    ControlDualStream = 30
+    ControlMediaTransport = 31
+
+    @classmethod
+    def name(cls, data_type):
+        for name, value in vars(cls).items():
+            if value == data_type and isinstance(value, int):
+                return name
+        return str(data_type)
 
 class ControlRequest:
     GiveMeControl = 0
     Occupato = 1
     Granted = 2
     Break = 3
+    GiveMeView = 4
 
 class RemoteControlStatus:
     FOLLOW = 'follow'
     LEAD = 'lead'
 
+class MessageSchemas:
+
+    # Из чего собраны схемы Connection.message_schemas, см. check_value в _protocol.py
+
+    COORDINATE = range(-0x80000000, 0x80000000)
+    LENGTH = range(0, 0x10000)
+    RECT = [COORDINATE, COORDINATE, LENGTH, LENGTH]
+    SIZE = [LENGTH, LENGTH]
+    CAPTURE_INDEX = range(-2, 0x100)
+    SCREENS_COUNT = range(0, 0x100)
+    TILES = [[LENGTH, LENGTH, LENGTH, LENGTH, range(0, Globals.MAX_MESSAGE_SIZE+1)]]
+    TILE_CACHE = {
+        'gen': int,
+        'size': range(0, 0x100000),
+        'ops': [[LENGTH, LENGTH, LENGTH, LENGTH, int, object]],
+    }
+    MD5_HASH = lambda value: isinstance(value, str) and len(value) == 32 \
+                                        and all(c in '0123456789abcdef' for c in value)
+    FPS = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and 0 < value <= 1000
+    DPR = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and 0 < value <= 16
+
+    # значения событий мыши и клавиатуры в cbor-сообщениях MouseData и KeyboardData
+    INPUT_EVENTS = {
+        'mousePos': [COORDINATE, COORDINATE],
+        'mouseDown': frozenset(MOUSE_BUTTONS),
+        'mouseUp': frozenset(MOUSE_BUTTONS),
+        'mouseWheel': (int, float),
+        'keyDown': str,
+        'keyUp': str,
+        'keyHotkey': [str],
+    }
+
+class ScreenGeometryCache:
+
+    # геометрия экранов меняется редко, поэтому не стоит запрашивать её на каждом кадре;
+    # кеш сбрасывается, как только экран добавили, убрали или у него поменялась геометрия
+
+    screens = None
+    watching = False
+
+    @classmethod
+    def watch(cls, app):
+        if cls.watching:
+            return
+        cls.watching = True
+        app.screenAdded.connect(cls.onScreenAdded)
+        app.screenRemoved.connect(cls.invalidate)
+        for screen in app.screens():
+            screen.geometryChanged.connect(cls.invalidate)
+        cls.invalidate()
+
+    @classmethod
+    def onScreenAdded(cls, screen):
+        screen.geometryChanged.connect(cls.invalidate)
+        cls.invalidate()
+
+    @classmethod
+    def get(cls):
+        if cls.screens is None:
+            app = QApplication.instance()
+            # на случай, если кеш понадобился раньше, чем main подписала его на экраны
+            cls.watch(app)
+            cls.screens = [(screen, screen.geometry()) for screen in app.screens()]
+        return cls.screens
+
+    @classmethod
+    def invalidate(cls, *args):
+        cls.screens = None
+
 class Utils:
 
     @staticmethod
-    def make_capture_frame(capture_index):
-        desktop = QDesktopWidget()
-        # (11 фев 26) оставляю тут некомпилируемую дичь из запятых, чтобы
-        # вспомнить из-за чего, возможно, не будет работать захват,
-        # так как именно сейчас у меня нет возможности проверить захват
-        ,,,
-        rects = [desktop.screenGeometry(screen=i) for i in range(desktop.screenCount()) \
+    def capture_frame_rect(capture_index):
+        # (11 фев 26) если не работает захват, то возможно из-за этого места:
+        # именно сейчас у меня нет возможности проверить захват
+        rects = [geometry for i, (screen, geometry) in enumerate(ScreenGeometryCache.get()) \
                                                     if capture_index == -1 or i == capture_index]
         left = min(r.left() for r in rects)
         right = max(r.right() for r in rects)
@@ -207,114 +355,232 @@ class Utils:
             capture_rect = QRect(QPoint(left, top), QPoint(right+1, bottom+1))
         else:
             capture_rect = QRect(QPoint(left, top), QPoint(right, bottom))
+        return capture_rect
 
-        qimage = QImage(
-            capture_rect.width(),
-            capture_rect.height(),
-            QImage.Format_RGB32
-        )
-        qimage.fill(Qt.black)
-
-        painter = QPainter()
-        painter.begin(qimage)
-        screens = QGuiApplication.screens()
+    @staticmethod
+    def grab_capture_frame(capture_index):
+        capture_rect = Utils.capture_frame_rect(capture_index)
         if capture_index == -1:
-            for n, screen in enumerate(screens):
-                p = screen.grabWindow(0)
-                source_rect = QRect(QPoint(0, 0), screen.geometry().size())
-                painter.drawPixmap(screen.geometry(), p, source_rect)
+            pieces = Utils.grab_screens_region(capture_rect)
         else:
-            for n, screen in enumerate(screens):
-                if capture_index == n:
-                    painter.drawPixmap(QPoint(0, 0), screen.grabWindow(0))
-                    break
-        painter.end()
+            screens = [ScreenGeometryCache.get()[capture_index]]
+            pieces = Globals.capture_backend.grab(capture_rect, screens)
+        return pieces, capture_rect
 
-        return qimage, capture_rect
+    @staticmethod
+    def grab_screens_region(capture_rect):
+        # захват экрана возможен только в GUI-потоке, поэтому здесь только сам захват,
+        # а склейка в один кадр делается в compose_capture_frame уже в потоке кодировщика
+        return Globals.capture_backend.grab(capture_rect, ScreenGeometryCache.get())
 
     @staticmethod
-    def make_user_defined_capture_screenshot(capture_rect):
-        desktop = QDesktopWidget()
-        qimage = QImage(
-            capture_rect.width(),
-            capture_rect.height(),
-            QImage.Format_RGB32
-        )
-        qimage.fill(Qt.black)
+    def grab_user_defined_capture_screenshot(capture_rect):
+        return Utils.grab_screens_region(capture_rect)
+
+    @staticmethod
+    def compose_capture_frame(capture_size, pieces, canvas=None):
+        canvas_rect = QRect(QPoint(0, 0), capture_size)
+
+        if len(pieces) == 1:
+            target_rect, image, source_rect = pieces[0]
+            if target_rect == canvas_rect and source_rect == canvas_rect \
+                                    and image.format() == QImage.Format_RGB32:
+                # кадр снят с одного экрана целиком, склеивать нечего
+                return image
+
+        if canvas is None or canvas.size() != capture_size:
+            canvas = QImage(
+                capture_size.width(),
+                capture_size.height(),
+                QImage.Format_RGB32
+            )
+        if sum(p[0].width()*p[0].height() for p in pieces) < capture_size.width()*capture_size.height():
+            # экраны не покрывают область захвата целиком
+            canvas.fill(Qt.black)
 
         painter = QPainter()
-        painter.begin(qimage)
-        screens = QGuiApplication.screens()
-        for n, screen in enumerate(screens):
-            screen_geometry = screen.geometry()
-            if screen_geometry.intersects(capture_rect):
-                screen_pixmap = screen.grabWindow(0)
-                repos = screen_geometry.topLeft() - capture_rect.topLeft()
-                screen_geometry.moveTopLeft(repos)
-                source_rect = QRect(QPoint(0, 0), screen.geometry().size())
-                painter.drawPixmap(screen_geometry, screen_pixmap, source_rect)
+        painter.begin(canvas)
+        for target_rect, image, source_rect in pieces:
+            painter.drawImage(target_rect, image, source_rect)
         painter.end()
-        return qimage
+        return canvas
 
     @staticmethod
     def prepare_data_to_write(serial_data, binary_attachment_data):
+        # для коротких сообщений: всё склеивается в один bytes
+        return b''.join(Utils.prepare_message_to_write(serial_data, binary_attachment_data))
 
-        if serial_data is not None:
-            serial_binary = cbor2.dumps(serial_data)
-            serial_length = len(serial_binary)
-        else:
-            serial_binary = b''
-            serial_length = 0
-
-        if binary_attachment_data is not None:
-            bin_binary = binary_attachment_data
-            bin_length = len(binary_attachment_data)
-        else:
-            bin_binary = b''
-            bin_length = 0
-        total_data_length = serial_length + bin_length
-        header = total_data_length.to_bytes(Globals.INT_SIZE, 'big') + serial_length.to_bytes(Globals.INT_SIZE, 'big') + bin_length.to_bytes(Globals.INT_SIZE, 'big')
-        data_to_sent = header + serial_binary + bin_binary
+    @staticmethod
+    def prepare_message_to_write(serial_data, binary_attachment_data=None):
+        """
+            возвращает список буферов сообщения для Connection.writeMessage;
+            binary_attachment_data - один буфер или список буферов, они не копируются
+        """
+        if binary_attachment_data is None:
+            binary_attachment_data = ()
+        return encode_message(serial_data, binary_attachment_data)
 
-        # print('prepare_data_to_write', serial_data)
+    @staticmethod
+    def flush_outbound(socket, outbound):
+        # в буфер сокета кладём не больше SOCKET_WRITE_BUDGET байт, чтобы срочное сообщение
+        # не стояло за мегабайтами файла, и сразу отдаём их системе через flush;
+        # пока система принимает данные, берём из очередей следующую порцию
+        while outbound.pending_size():
+            budget = Globals.SOCKET_WRITE_BUDGET - socket.bytesToWrite()
+            if budget <= 0:
+                break
+            for buffer in outbound.pull(budget):
+                socket.write(buffer)
+            if not socket.flush():
+                break
 
-        return data_to_sent
+    @staticmethod
+    def image_buffer(image):
+        bits = image.constBits()
+        bits.setsize(image.sizeInBytes())
+        return memoryview(bits)
 
     @staticmethod
-    def prepare_screenshot_to_transfer(connection):
+    def grab_screenshot(stream):
 
-        if connection.capture_index == -2:
-            capture_rect = connection.user_defined_capture_rect
-            image = Utils.make_user_defined_capture_screenshot(capture_rect)
+        if stream.capture_index == -2:
+            capture_rect = stream.user_defined_capture_rect
+            pieces = Utils.grab_user_defined_capture_screenshot(capture_rect)
         else:
-            screens_count = len(QGuiApplication.screens())
-            if connection.capture_index+1 > screens_count:
-                connection.capture_index = 0
-            image, capture_rect = Utils.make_capture_frame(connection.capture_index)
-
-        byte_array = QByteArray()
-        buffer = QBuffer(byte_array)
-        buffer.open(QIODevice.WriteOnly)
-        # image.save(buffer, "jpg", quality=20)
-        # image.save(buffer, "jpg")
-        image.save(buffer, Globals.IMAGE_FORMAT, quality=50)
+            pieces, capture_rect = Utils.grab_capture_frame(stream.capture_index)
 
         capture_rect_tuple = [capture_rect.left(), capture_rect.top(), capture_rect.width(), capture_rect.height()]
 
-        serial_data = {DataType.ScreenData: {
+        screen_info = {
             'rect': capture_rect_tuple,
-            'capture_index': connection.capture_index,
-            'screens_count': len(QGuiApplication.screens()),
-        }}
+            'capture_index': stream.capture_index,
+            'screens_count': len(ScreenGeometryCache.get()),
+        }
+        if stream.background:
+            screen_info['background'] = True
+        layout = (stream.capture_index, *capture_rect_tuple)
+
+        return CaptureJob(capture_rect.size(), pieces, screen_info, layout,
+                                    stream.quality(), stream.scale(), stream.codecs, stream.throughput(),
+                                    stream.refine_codecs, stream.tile_cache_size(), stream.keyframes_only)
+
+    @staticmethod
+    def prepare_screenshot_to_transfer(job, tile_encoder, canvas=None, video_encoder=None, tile_cache=None):
+
+        image = Utils.compose_capture_frame(job.capture_size, job.pieces, canvas=canvas)
+        progressive = job.refine_codecs is not None and video_encoder is None
+        # масштаб меняется без нового потока, и на стоящем экране после его смены нужен кадр
+        is_static = tile_encoder.is_static(Utils.image_buffer(image), (job.layout, job.scale))
+        if is_static and not (progressive and tile_encoder.needs_refinement()):
+            # экран не менялся: ни масштабирования, ни кодирования, ни отправки
+            return None
+        if job.scale < 1.0:
+            image = image.scaled(
+                max(1, round(image.width()*job.scale)),
+                max(1, round(image.height()*job.scale)),
+                Qt.IgnoreAspectRatio,
+                Qt.SmoothTransformation,
+            )
+        if video_encoder is not None and (image.width() % 2 or image.height() % 2):
+            # видеокодекам нужны чётные стороны кадра, а портал всё равно растянет кадр на область захвата
+            image = image.copy(0, 0, max(2, image.width() & ~1), max(2, image.height() & ~1))
+        screen_info = dict(job.screen_info)
+        # размер кадра может отличаться от размера области захвата
+        screen_info['size'] = [image.width(), image.height()]
+
+        if video_encoder is not None or progressive or not job.tile_cache_size:
+            # черновик в кеше так и остался бы черновиком, а видеокодеку кеш не нужен
+            tile_cache = None
+        elif tile_cache.reset_requested or tile_cache.capacity != job.tile_cache_size:
+            tile_cache.reset(capacity=job.tile_cache_size)
+        is_keyframe, dirty_rects, move, cache_ops = tile_encoder.encode(
+            Utils.image_buffer(image),
+            image.width(),
+            image.height(),
+            image.bytesPerLine(),
+            layout=job.layout,
+            # видеокодек и сам находит сдвиги
+            detect_moves=video_encoder is None,
+            tile_cache=tile_cache,
+        )
+        if cache_ops:
+            screen_info['cache'] = {
+                'gen': tile_cache.generation,
+                'size': tile_cache.capacity,
+                'ops': cache_ops,
+            }
+        refine_rects = []
+        if progressive and not is_keyframe:
+            refine_rects = tile_encoder.take_refinement(image.width(), image.height(), Globals.REFINE_TILES_PER_FRAME)
+        if not is_keyframe and not dirty_rects and not refine_rects and move is None and not cache_ops:
+            # например, изменения пропали при уменьшении кадра
+            return None
+        if job.keyframes_only:
+            # кадры идут по UDP и могут теряться, поэтому каждый кадр обходится без предыдущих
+            is_keyframe = True
+
+        if video_encoder is not None:
+            data, is_keyframe = video_encoder.encode(image, job.quality, keyframe=is_keyframe)
+            screen_info['codec'] = video_encoder.codec.name
+            screen_info['keyframe'] = is_keyframe
+            serial_data = {DataType.ScreenVideoData: screen_info}
+            buffers = Utils.prepare_message_to_write(serial_data, data)
+            return EncodedFrame(buffers, message_size(buffers), is_keyframe, None)
+
+        if is_keyframe:
+            pixels = image.width()*image.height()
+        else:
+            pixels = sum(w*h for x, y, w, h in dirty_rects)
+        codec = FrameCodecs.choose(job.codecs, pixels, job.throughput)
+        screen_info['codec'] = codec.name
+
+        if is_keyframe:
+            serial_data = {DataType.ScreenData: screen_info}
+            buffers = Utils.prepare_message_to_write(serial_data, codec.encode(image, job.quality))
+            return EncodedFrame(buffers, message_size(buffers), True, [])
+
+        # в кадр уходят только изменённые тайлы;
+        # в постепенном режиме они идут уменьшенными черновиками, а портал их растянет
+        draft_scale = Globals.DRAFT_TILES_SCALE if progressive else 1.0
+        changed_rects = dirty_rects + refine_rects
+        if move is not None:
+            # сначала портал сдвигает у себя уже полученную картинку, и только потом патчит тайлами
+            left, top, width, height, dy = move
+            screen_info['copy'] = [left, top - dy, width, height, left, top]
+            changed_rects.append((left, top, width, height))
+        # тайлы, найденные в кеше, портал возьмёт у себя
+        changed_rects.extend(tuple(op[:4]) for op in cache_ops if op[5])
+        tiles_data = []
+        screen_info['tiles'] = Utils.encode_tiles(image, dirty_rects, codec, job.quality, tiles_data, scale=draft_scale)
+
+        if refine_rects:
+            # а тайлы, которые успели устояться, отправляются заново уже без потерь
+            refine_codec = FrameCodecs.choose(job.refine_codecs, sum(r[2]*r[3] for r in refine_rects), job.throughput)
+            screen_info['refine'] = {
+                'codec': refine_codec.name,
+                'tiles': Utils.encode_tiles(image, refine_rects, refine_codec, Globals.REFINE_QUALITY, tiles_data),
+            }
 
-        return Utils.prepare_data_to_write(serial_data, byte_array.data())
+        serial_data = {DataType.ScreenTilesData: screen_info}
+        buffers = Utils.prepare_message_to_write(serial_data, tiles_data)
+        return EncodedFrame(buffers, message_size(buffers), False, changed_rects)
 
     @staticmethod
-    def prepare_data_to_UDP(data_obj):
-        data = cbor2.dumps(data_obj)
-        data_length = len(data)
-        data_to_sent = data_length.to_bytes(4, 'big') + data
-        return data_to_sent
+    def encode_tiles(image, rects, codec, quality, tiles_data, scale=1.0):
+        tiles = []
+        for rect in rects:
+            tile_image = image.copy(*rect)
+            if scale < 1.0:
+                tile_image = tile_image.scaled(
+                    max(1, round(rect[2]*scale)),
+                    max(1, round(rect[3]*scale)),
+                    Qt.IgnoreAspectRatio,
+                    Qt.SmoothTransformation,
+                )
+            tile_data = codec.encode(tile_image, quality)
+            tiles.append([*rect, len(tile_data)])
+            tiles_data.append(tile_data)
+        return tiles
 
     @staticmethod
     def retrieve_ip_mac_pairs():
@@ -342,22 +608,23 @@ class Utils:
         return 'MAC not found!'
 
     @staticmethod
-    def socket_info_to_chat(intro, socket):
+    def apply_socket_options(socket, channel_kind):
+        options = Globals.SOCKET_OPTIONS[channel_kind]
+        socket.setSocketOption(QAbstractSocket.SendBufferSizeSocketOption, options['buffer'])
+        socket.setSocketOption(QAbstractSocket.ReceiveBufferSizeSocketOption, options['buffer'])
+        socket.setSocketOption(QAbstractSocket.LowDelayOption, options['low_delay'])
+        socket.setReadBufferSize(options['read_buffer'])
+        socket.setSocketOption(QAbstractSocket.TypeOfServiceOption, options['tos'])
+
+    @staticmethod
+    def socket_info_to_chat(intro, socket, channel_kind='control'):
         send_size = socket.socketOption(QAbstractSocket.SendBufferSizeSocketOption)
         receive_size = socket.socketOption(QAbstractSocket.ReceiveBufferSizeSocketOption)
         buffer_size = socket.readBufferSize()
 
         msg1 = f'1 {intro}, receive buffer {receive_size} bytes, send buffer {send_size} bytes, buffer size {buffer_size}'
 
-        socket.setSocketOption(QAbstractSocket.SendBufferSizeSocketOption, 200000)
-        socket.setSocketOption(QAbstractSocket.ReceiveBufferSizeSocketOption, 200000)
-
-        socket.setSocketOption(QAbstractSocket.LowDelayOption, 1)
-        socket.setReadBufferSize(157000)
-
-        # Immediate = 64
-        Network_control = 224
-        socket.setSocketOption(QAbstractSocket.TypeOfServiceOption, Network_control)
+        Utils.apply_socket_options(socket, channel_kind)
 
         send_size = socket.socketOption(QAbstractSocket.SendBufferSizeSocketOption)
         receive_size = socket.socketOption(QAbstractSocket.ReceiveBufferSizeSocketOption)
@@ -469,11 +736,16 @@ class Portal(QWidget):
 
         self.editing_mode = False
         self.show_log_keys = False
+        self.view_only = False
 
         self.disconnect = False
         self.before_client_screen_capture_rect = QRect()
 
         self.receiving_capture_index = 0
+        # монитор, который в двухпоточном режиме идёт фоном под областью захвата
+        self.background_capture_index = None
+        self.keyframe_request_timestamp = 0.0
+        self.user_defined_client_rect = None
 
         self.canvas_scale_x = 1.0
         self.canvas_scale_y = 1.0
@@ -510,6 +782,12 @@ class Portal(QWidget):
         self.update_timer.timeout.connect(self.update)
         self.update_timer.start()
 
+        self.reported_viewport = None
+        self.viewport_timer = QTimer()
+        self.viewport_timer.setInterval(Globals.VIEWPORT_REPORT_INTERVAL)
+        self.viewport_timer.timeout.connect(self.reportViewportSize)
+        self.viewport_timer.start()
+
         self.menuBar = QMenuBar(self)
         self.canvas_origin = QPoint(0, self.menuBar.height())
 
@@ -525,9 +803,9 @@ class Portal(QWidget):
         )
         keyboardMenu = self.menuBar.addMenu('Keyboard')
         def send_hotkey(hotkey_list):
-            data_key = 'keyHotkey'
-            key_data_dict = {DataType.KeyboardData: {data_key: hotkey_list}}
-            self.connection.socket.write(Utils.prepare_data_to_write(key_data_dict, None))
+            if not self.isInputAllowed():
+                return
+            self.connection.sendInputEvent('keyHotkey', hotkey_list)
         for text, args in keyboard_send_actions_data:
             action = QAction(text, self)
             action.triggered.connect(partial(send_hotkey, args))
@@ -551,11 +829,80 @@ class Portal(QWidget):
                 self.connection.sendControlFPS(value)
                 chat_dialog.appendSystemMessage(f'FPS is set to {value}')
 
-        for fps_value in [25, 20, 15, 10, 5, 1, 0.5]:
+        for fps_value in [60, 25, 20, 15, 10, 5, 1, 0.5]:
             set_fps_action = QAction(f'Set FPS to {fps_value}', self)
             set_fps_action.triggered.connect(partial(send_contol_fps, fps_value))
             viewMenu.addAction(set_fps_action)
 
+        def send_streaming_preference(preference):
+            if self.connection:
+                self.connection.sendControlStreamingPreference(preference)
+                chat_dialog.appendSystemMessage(f'Streaming preference is set to {preference}')
+
+        viewMenu.addSeparator()
+        streaming_preferences = (
+            ('Adaptive: prefer low latency', AdaptiveStreamController.LATENCY),
+            ('Adaptive: prefer image quality', AdaptiveStreamController.QUALITY),
+        )
+        for text, preference in streaming_preferences:
+            action = QAction(text, self)
+            action.triggered.connect(partial(send_streaming_preference, preference))
+            viewMenu.addAction(action)
+
+        def send_codec(codec_mode):
+            if self.connection:
+                self.connection.sendControlCodec(codec_mode)
+                chat_dialog.appendSystemMessage(f'Frame codec is set to {codec_mode}')
+
+        codecsMenu = viewMenu.addMenu('Frame codec')
+        codec_modes = [
+            ('Auto: lossy', 'auto'),
+            ('Auto: lossless', 'lossless'),
+        ]
+        for name in FrameCodecs.names():
+            if FrameCodecs.get(name).inter_frame:
+                codec_modes.append((f'{name} (video stream)', name))
+            else:
+                codec_modes.append((name, name))
+        for text, codec_mode in codec_modes:
+            action = QAction(text, self)
+            action.triggered.connect(partial(send_codec, codec_mode))
+            codecsMenu.addAction(action)
+
+        def send_progressive(checked):
+            if self.connection:
+                self.connection.sendControlProgressive(checked)
+                chat_dialog.appendSystemMessage(f'Progressive refinement is set to {checked}')
+
+        self.progressive_action = QAction('Progressive refinement (lossless when the screen settles)', self)
+        self.progressive_action.setCheckable(True)
+        self.progressive_action.triggered.connect(send_progressive)
+        viewMenu.addAction(self.progressive_action)
+
+        def send_dual_stream(checked):
+            if self.connection:
+                self.connection.sendControlDualStream(checked)
+                chat_dialog.appendSystemMessage(f'Dual-stream mode is set to {checked}')
+
+        self.dual_stream_action = QAction('Keep the monitor live around the user-defined capture region', self)
+        self.dual_stream_action.setCheckable(True)
+        self.dual_stream_action.triggered.connect(send_dual_stream)
+        viewMenu.addAction(self.dual_stream_action)
+
+        def send_media_transport(checked):
+            if self.connection:
+                if checked and MEDIA_FEATURE not in self.connection.peer_features:
+                    self.media_transport_action.setChecked(False)
+                    chat_dialog.appendSystemMessage('Remote host cannot send frames over UDP')
+                    return
+                self.connection.sendControlMediaTransport(checked)
+                chat_dialog.appendSystemMessage(f'Frames over UDP are set to {checked}')
+
+        self.media_transport_action = QAction('Receive whole frames over UDP (lost frames are skipped, not resent)', self)
+        self.media_transport_action.setCheckable(True)
+        self.media_transport_action.triggered.connect(send_media_transport)
+        viewMenu.addAction(self.media_transport_action)
+
         viewMenu.addSeparator()
         reset_userdefined_capture = QAction('Reset user-defined capture region', self)
         reset_userdefined_capture.triggered.connect(self.reset_userdefined_capture)
@@ -813,6 +1160,7 @@ class Portal(QWidget):
         painter.fillRect(self.rect(), Qt.black)
 
         if self.activated:
+            # пока экран не меняется, вместо кадров приходят heartbeat-сообщения
             WAIT_FOR_SCREENSHOT_SECONDS = 3 #seconds
             if time.time() - self.update_timestamp > WAIT_FOR_SCREENSHOT_SECONDS:
                 self.disconnect = True
@@ -974,10 +1322,12 @@ class Portal(QWidget):
 
     def get_viewport_rect(self, sub=False):
 
+        # размеры холста берутся из области захвата, а не из картинки,
+        # так как ведомое приложение может присылать уменьшенные кадры
         if sub:
-            image_rect = self.user_defined_image_to_show.rect()
+            image_rect = QRect(QPoint(0, 0), self.user_defined_client_rect.size())
         else:
-            image_rect = self.image_to_show.rect()
+            image_rect = QRect(QPoint(0, 0), self.monitor_capture_rect.size())
 
         if self.canvas_scale_x == 0.0 or self.canvas_scale_y == 0.0:
             self.canvas_scale_x = 1.0
@@ -1003,12 +1353,28 @@ class Portal(QWidget):
             # по крайней мере на приложуха в виртуалке Linux захлёбывается
             if self.isViewportReadyAndCursorInsideViewport():
                 x, y = self.mapViewportToClient()
-                mouse_data_dict = {DataType.MouseData: {'mousePos': [x, y]}}
-                self.connection.socket.write(Utils.prepare_data_to_write(mouse_data_dict, None))
+                self.connection.sendInputEvent('mousePos', [x, y])
 
     def mouseAnimationTimerHandler(self):
         self.update()
 
+    def reportViewportSize(self):
+        # ведомое приложение не будет слать кадры крупнее, чем их реально видно в портале
+        if self.connection is None or not self.activated:
+            return
+        if self.receiving_capture_index == -2:
+            if self.user_defined_image_to_show is None:
+                return
+            viewport_rect = self.get_viewport_rect(sub=True)
+        else:
+            if self.image_to_show is None:
+                return
+            viewport_rect = self.get_viewport_rect()
+        viewport = (viewport_rect.width(), viewport_rect.height(), self.devicePixelRatioF())
+        if viewport != self.reported_viewport:
+            self.reported_viewport = viewport
+            self.connection.sendControlViewport(*viewport)
+
     def mapViewportToClient(self):
         mapped_cursor_pos = self.mapFromGlobal(QCursor().pos())
         viewport_rect = self.get_viewport_rect()
@@ -1117,8 +1483,12 @@ class Portal(QWidget):
             self.define_regions_rects_and_set_cursor()
         self.update()
 
+    def isInputAllowed(self):
+        # в режиме просмотра управляющие данные не отправляются
+        return self.connection is not None and not self.view_only
+
     def isViewportReadyAndCursorInsideViewport(self):
-        if self.image_to_show is not None and self.isActiveWindow():
+        if self.image_to_show is not None and self.isActiveWindow() and self.isInputAllowed():
             mapped_cursor_pos = self.mapFromGlobal(QCursor().pos())
             viewport_rect = self.get_viewport_rect()
             if viewport_rect.contains(mapped_cursor_pos):
@@ -1280,8 +1650,7 @@ class Portal(QWidget):
                 mouse_button = 'right'
             elif event.button() == Qt.MiddleButton:
                 mouse_button = 'middle'
-            mouse_data_dict = {DataType.MouseData: {data_key: mouse_button}}
-            self.connection.socket.write(Utils.prepare_data_to_write(mouse_data_dict, None))
+            self.connection.sendInputEvent(data_key, mouse_button)
 
     def mouseReleaseEvent(self, event):
         alt = event.modifiers() & Qt.AltModifier
@@ -1323,8 +1692,7 @@ class Portal(QWidget):
                 mouse_button = 'right'
             elif event.button() == Qt.MiddleButton:
                 mouse_button = 'middle'
-            mouse_data_dict = {DataType.MouseData: {data_key: mouse_button}}
-            self.connection.socket.write(Utils.prepare_data_to_write(mouse_data_dict, None))
+            self.connection.sendInputEvent(data_key, mouse_button)
 
     def wheelEvent(self, event):
         scroll_value = event.angleDelta().y()/240
@@ -1334,17 +1702,16 @@ class Portal(QWidget):
             alt = event.modifiers() & Qt.AltModifier
             no_mod = event.modifiers() == Qt.NoModifier
             self.doScaleCanvas(scroll_value, ctrl, shift, no_mod)
-        else:
-            data_key = 'mouseWheel'
-            mouse_data_dict = {DataType.MouseData: {data_key: scroll_value}}
-            self.connection.socket.write(Utils.prepare_data_to_write(mouse_data_dict, None))
+        elif self.isInputAllowed():
+            self.connection.sendInputEvent('mouseWheel', scroll_value)
 
     def sendKeyData(self, event, data_key):
+        if not self.isInputAllowed():
+            return
         pyautogui_arg = self.translateQtKeyEventDataToPyautoguiArgumentValue(event)
         if pyautogui_arg:
-            key_data_dict = {DataType.KeyboardData: {data_key: pyautogui_arg}}
-            print(key_data_dict)
-            self.connection.socket.write(Utils.prepare_data_to_write(key_data_dict, None))
+            print(data_key, pyautogui_arg)
+            self.connection.sendInputEvent(data_key, pyautogui_arg)
         else:
             self.triggerKeyTranslationError()
 
@@ -1374,7 +1741,15 @@ class Portal(QWidget):
             self.sendKeyData(event, 'keyUp')
 
     def close_portal(self):
+        if self.connection is not None:
+            self.connection.closeMediaReceiver()
         self.connection = None
+        self.reported_viewport = None
+        # у нового сеанса постепенное улучшение, фоновый поток и кадры по UDP снова выключены
+        self.progressive_action.setChecked(False)
+        self.dual_stream_action.setChecked(False)
+        self.media_transport_action.setChecked(False)
+        self.background_capture_index = None
         self.user_defined_image_to_show = None
         self.image_to_show = None
         self.activated = False
@@ -1382,15 +1757,30 @@ class Portal(QWidget):
         self.update_monitors_submenu(0)
 
     @staticmethod
-    def show_in_portal(image, capture_index, screens_count, client_screen_capture_rect, connection):
+    def show_in_portal(image, capture_index, screens_count, client_screen_capture_rect, connection, background=False):
 
         portal = chat_dialog.portal_widget
+        if background and not Portal.accepts_background():
+            return
         portal.connection = connection
         portal.update_timestamp = time.time()
+        portal.disconnect = False
+
+        if background:
+            # фон под областью захвата: область захвата, зум и выбранный монитор не трогаем
+            portal.image_to_show = image
+            portal.monitor_capture_rect = client_screen_capture_rect
+            portal.background_capture_index = capture_index
+            portal.is_grayed = False
+            portal.update()
+            return
 
         if capture_index == -2:
             portal.user_defined_image_to_show = image
-            portal.gray_received_image()
+            portal.user_defined_client_rect = client_screen_capture_rect
+            if not portal.dual_stream_action.isChecked():
+                # без фонового потока монитор вокруг области захвата замирает, и это видно по серому
+                portal.gray_received_image()
         else:
             portal.image_to_show = image
             portal.user_defined_image_to_show = None
@@ -1407,6 +1797,170 @@ class Portal(QWidget):
             portal.before_client_screen_capture_rect = client_screen_capture_rect
             portal.fit_capture_to_portal()
 
+    @staticmethod
+    def accepts_background():
+        # кадр фона мог быть в пути, когда область захвата сбросили или фоновый поток выключили,
+        # и тогда он заменил бы основную картинку, а тайлы основного потока легли бы поверх него
+        portal = chat_dialog.portal_widget
+        return portal.receiving_capture_index == -2 and portal.dual_stream_action.isChecked()
+
+    @staticmethod
+    def keep_alive_in_portal(heartbeat_info, connection):
+        portal = chat_dialog.portal_widget
+        if portal.connection is not connection:
+            return
+        portal.update_timestamp = time.time()
+        if portal.disconnect:
+            # пока связи не было, картинка посерела, и патчить её больше нельзя
+            portal.disconnect = False
+            Portal.request_keyframe(connection)
+        chat_dialog.framerate_label.setText(f'remote screen is static, heartbeat #{heartbeat_info["seq"]}')
+        portal.update()
+
+    @staticmethod
+    def request_keyframe(connection):
+        portal = chat_dialog.portal_widget
+        if time.time() - portal.keyframe_request_timestamp > Globals.KEYFRAME_REQUEST_INTERVAL:
+            portal.keyframe_request_timestamp = time.time()
+            connection.sendControlKeyframe()
+
+    @staticmethod
+    def play_in_portal(video_info, binary_data, connection):
+        codec = FrameCodecs.decoder(video_info['codec'], inter_frame=True)
+        decoder = connection.video_decoder
+        if decoder is None or decoder.codec is not codec:
+            decoder = connection.video_decoder = codec.create_decoder()
+
+        image = decoder.decode(binary_data, video_info['keyframe'])
+        if image is None:
+            if not decoder.has_keyframe:
+                Portal.request_keyframe(connection)
+            return
+
+        capture_rect = QRect(*video_info['rect'])
+        Portal.show_in_portal(image, video_info['capture_index'], video_info['screens_count'], capture_rect, connection)
+
+    @staticmethod
+    def patch_in_portal(tiles_info, binary_data, connection):
+
+        portal = chat_dialog.portal_widget
+        if tiles_info.get('background') and not Portal.accepts_background():
+            return
+        capture_index = tiles_info['capture_index']
+        size = QSize(*tiles_info['size'])
+        if capture_index == -2:
+            image = portal.user_defined_image_to_show
+        else:
+            image = portal.image_to_show
+        if tiles_info.get('background'):
+            expected_capture_index = portal.background_capture_index
+        else:
+            expected_capture_index = portal.receiving_capture_index
+
+        # патчить можно только то же самое изображение, что было у отправителя,
+        # иначе просим ключевой кадр и ждём его
+        if image is None or image.format() != QImage.Format_RGB32 or image.size() != size \
+                            or capture_index != expected_capture_index:
+            Portal.request_keyframe(connection)
+            return
+
+        portal.update_timestamp = time.time()
+
+        refine_info = tiles_info.get('refine')
+        copy_info = tiles_info.get('copy')
+        if copy_info:
+            x, y, w, h, target_x, target_y = copy_info
+            Portal.check_rect(image, x, y, w, h)
+            Portal.check_rect(image, target_x, target_y, w, h)
+        cache_hits, cache_misses = Portal.touch_tile_cache(tiles_info.get('cache'), image, connection)
+        if tiles_info['tiles'] or refine_info or copy_info or cache_hits:
+            codec = FrameCodecs.decoder(tiles_info.get('codec', Globals.DEFAULT_FRAME_CODEC))
+            refine_codec = None
+            if refine_info:
+                refine_codec = FrameCodecs.decoder(refine_info['codec'])
+            painter = QPainter()
+            painter.begin(image)
+            if copy_info:
+                # прокрутка: сдвигаем то, что уже есть, а тайлами придёт только открывшаяся полоса
+                x, y, w, h, target_x, target_y = copy_info
+                painter.drawImage(QPoint(target_x, target_y), image.copy(x, y, w, h))
+            # уменьшенные черновики тайлов растягиваются на свои прямоугольники
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+            offset = Portal.draw_tiles(painter, tiles_info['tiles'], codec, binary_data, 0)
+            if refine_info:
+                Portal.draw_tiles(painter, refine_info['tiles'], refine_codec, binary_data, offset)
+            tiles_images = Portal.fill_tile_cache(cache_misses, image, connection)
+            for x, y, w, h, tile_id, tile_image in cache_hits:
+                if tile_image is None:
+                    # тайл попал в кеш в этом же кадре
+                    tile_image = tiles_images[tile_id]
+                painter.drawImage(QPoint(x, y), tile_image)
+            painter.end()
+
+        portal.update()
+
+    @staticmethod
+    def touch_tile_cache(cache_info, image, connection):
+        """
+            повторяет у себя обращения отправителя к кешу тайлов в кадре image;
+            возвращает (hits, misses), где hits - список [x, y, w, h, id, image],
+            а misses - список [x, y, w, h, id] тайлов, картинки которых надо положить в кеш,
+            когда они будут нарисованы
+        """
+        if not cache_info:
+            return [], []
+        for x, y, w, h, tile_id, is_hit in cache_info['ops']:
+            Portal.check_rect(image, x, y, w, h)
+        cache = connection.tile_cache
+        if cache.generation != cache_info['gen'] or cache.capacity != cache_info['size']:
+            cache.reset(generation=cache_info['gen'], capacity=cache_info['size'])
+        hits = []
+        misses = []
+        is_broken = False
+        for x, y, w, h, tile_id, is_hit in cache_info['ops']:
+            if not is_hit:
+                cache.put(tile_id, None)
+                misses.append([x, y, w, h, tile_id])
+            elif tile_id in cache.entries:
+                hits.append([x, y, w, h, tile_id, cache.get(tile_id)])
+            else:
+                # кеши разошлись, на этом месте останется старая картинка
+                cache.misses += 1
+                is_broken = True
+        if is_broken:
+            Portal.request_tile_cache_resync(connection)
+        return hits, misses
+
+    @staticmethod
+    def check_rect(image, x, y, w, h):
+        # image.copy за пределами картинки выделил бы память под весь прямоугольник
+        if not image.rect().contains(QRect(x, y, w, h)):
+            raise ProtocolError(f'rect {x, y, w, h} is out of the {image.width()}x{image.height()} frame')
+
+    @staticmethod
+    def fill_tile_cache(misses, image, connection):
+        tiles_images = {}
+        for x, y, w, h, tile_id in misses:
+            tile_image = image.copy(x, y, w, h)
+            tiles_images[tile_id] = tile_image
+            connection.tile_cache.fill(tile_id, tile_image)
+        return tiles_images
+
+    @staticmethod
+    def request_tile_cache_resync(connection):
+        portal = chat_dialog.portal_widget
+        if time.time() - portal.keyframe_request_timestamp > Globals.KEYFRAME_REQUEST_INTERVAL:
+            portal.keyframe_request_timestamp = time.time()
+            connection.sendControlTileCacheResync()
+
+    @staticmethod
+    def draw_tiles(painter, tiles, codec, binary_data, offset):
+        for x, y, w, h, length in tiles:
+            tile_image = codec.decode(binary_data[offset:offset+length])
+            offset += length
+            painter.drawImage(QRect(x, y, w, h), tile_image)
+        return offset
+
 
 
 class FileTransfer(QTimer):
@@ -1419,6 +1973,7 @@ class FileTransfer(QTimer):
         self.filesize = self.fileobj.tell()
         self.fileobj.seek(0, 0)
         self.filename = os.path.basename(filepath)
+        self.compress = os.path.splitext(self.filename)[1].lower() not in Globals.INCOMPRESSIBLE_EXTENSIONS
         self.setInterval(200)
         self.md5_hash = self.generate_md5(filepath)
         self.timeout.connect(self.sendFileChunk)
@@ -1444,8 +1999,8 @@ class FileTransfer(QTimer):
                 'chunk_size': len(filechunk),
             }
             serial_data = {DataType.FileData: chunk_info}
-            binary_data = filechunk
-
+            # заголовок готовится один раз, а сам кусок файла не копируется ни для одного соединения
+            buffers = Utils.prepare_message_to_write(serial_data, filechunk)
 
             for conn in chat_dialog.client.get_peers_connections():
                 msg = f'Trying to send file chunk {self.filename}' + \
@@ -1453,7 +2008,7 @@ class FileTransfer(QTimer):
                             f' to address {conn.socket.peerAddress().toString()}'
                 chat_dialog.appendSystemMessage(msg)
 
-                conn.socket.write(Utils.prepare_data_to_write(serial_data, binary_data))
+                conn.writeMessage(buffers, Priority.BULK, compress=self.compress)
 
         else:
             self.stop()
@@ -1468,8 +2023,22 @@ class FileTransfer(QTimer):
     receiving_files = defaultdict(int)
     receiving_files_objs = defaultdict(None)
 
+    @classmethod
+    def open_received_file(cls, file_chunk_info):
+        md5_hash = file_chunk_info['md5_hash']
+        if md5_hash not in cls.receiving_files:
+            cls.receiving_files[md5_hash] = 0
+            cls.receiving_files_objs[md5_hash] = open(md5_hash, 'wb')
+        return cls.receiving_files_objs[md5_hash]
+
     @classmethod
     def write_file_chunk_data(cls, file_chunk_info, binary_data, peer_address_string):
+        cls.open_received_file(file_chunk_info).write(binary_data)
+        cls.finish_file_chunk(file_chunk_info, peer_address_string)
+
+    @classmethod
+    def finish_file_chunk(cls, file_chunk_info, peer_address_string):
+        # кусок уже записан в файл: целиком или по мере прихода, см. Connection.openMessageSink
 
         md5_hash = file_chunk_info['md5_hash']
         total_size = file_chunk_info['total_size']
@@ -1478,15 +2047,10 @@ class FileTransfer(QTimer):
 
         chat_dialog.appendSystemMessage(f'From address {peer_address_string} a file chunk has been received {filename}, its size is {chunk_size}')
 
-        if md5_hash not in cls.receiving_files:
-            cls.receiving_files_objs[md5_hash] = open(md5_hash, 'wb')
-
         file_obj = cls.receiving_files_objs[md5_hash]
 
         cls.receiving_files[md5_hash] += chunk_size
 
-        file_obj.write(binary_data)
-
         if cls.receiving_files[md5_hash] >= total_size:
             cls.receiving_files.pop(md5_hash)
             cls.receiving_files_objs.pop(md5_hash)
@@ -1509,6 +2073,471 @@ class FileTransfer(QTimer):
 
 
 
+class ScreenEncoder(QObject):
+
+    encodeRequested = pyqtSignal(object)
+    frameEncoded = pyqtSignal(bool)
+
+    def __init__(self):
+        super().__init__()
+
+        self.tile_encoder = TileDeltaEncoder(
+            tile_size=Globals.SCREEN_TILE_SIZE,
+            keyframe_interval=Globals.SCREEN_KEYFRAME_INTERVAL,
+            refine_delay=Globals.REFINE_DELAY_FRAMES,
+        )
+
+        # готовые к отправке кадры, разбирает их GUI-поток
+        self.frames = deque()
+        self.frames_lock = threading.Lock()
+
+        self.busy = False
+        # ошибка кодирования уже выведена, повторные не печатаются
+        self.encode_failed = False
+
+        # изображение, в которое склеивается кадр, переиспользуется от кадра к кадру
+        self.canvas = None
+
+        # кодировщик межкадрового кодека, создаётся первым кадром, если поток идёт через него
+        self.video_encoder = None
+
+        # кеш уже отправленных тайлов, такой же словарь ведёт у себя каждый портал
+        self.tile_cache = TileCache()
+
+        self.worker_thread = QThread()
+        self.moveToThread(self.worker_thread)
+        self.encodeRequested.connect(self.encode)
+        self.worker_thread.start()
+
+        Globals.screen_encoders.append(self)
+
+    def request_keyframe(self):
+        self.tile_encoder.request_keyframe()
+
+    def reset_tile_cache(self):
+        self.tile_cache.request_reset()
+
+    def drop(self, frame):
+        # выкинутый кадр мог быть дельтой, и тогда то, что в нём было,
+        # надо отправить заново, иначе портал рассинхронизируется
+        # а без выкинутого видеокадра портал не сможет декодировать следующие
+        if frame.dirty_rects is not None:
+            # кеш портала не видел обращений из выкинутого кадра
+            self.tile_cache.request_reset()
+        if frame.is_keyframe or frame.dirty_rects is None:
+            self.tile_encoder.request_keyframe()
+        else:
+            self.tile_encoder.invalidate(frame.dirty_rects)
+
+    def request(self, job):
+        if self.busy:
+            return False
+        self.busy = True
+        self.encodeRequested.emit(job)
+        return True
+
+    @pyqtSlot(object)
+    def encode(self, job):
+        # выполняется в потоке кодировщика
+        try:
+            if self.canvas is None or self.canvas.size() != job.capture_size:
+                self.canvas = QImage(job.capture_size, QImage.Format_RGB32)
+            codec = FrameCodecs.get(job.codecs[0])
+            if self.video_encoder is None and codec.inter_frame:
+                self.video_encoder = codec.create_encoder()
+            frame = Utils.prepare_screenshot_to_transfer(job, self.tile_encoder,
+                                    canvas=self.canvas, video_encoder=self.video_encoder,
+                                    tile_cache=self.tile_cache)
+            if frame is not None:
+                with self.frames_lock:
+                    if len(self.frames) >= Globals.ENCODED_FRAMES_QUEUE_SIZE:
+                        self.drop(self.frames.popleft())
+                    self.frames.append(frame)
+        except Exception:
+            # исключение из слота в этом потоке ушло бы в excepthook, а тот завершает
+            # приложение не из того потока; поэтому тик пропускается, а поток
+            # начинается заново с ключевого кадра
+            frame = None
+            if not self.encode_failed:
+                self.encode_failed = True
+                builtins.print(f'frame encoding failed:\n{traceback.format_exc()}')
+            self.video_encoder = None
+            self.tile_cache.request_reset()
+            self.tile_encoder.request_keyframe()
+        finally:
+            self.busy = False
+        self.frameEncoded.emit(frame is None)
+
+    def is_idle(self):
+        # все закодированные кадры уже розданы подписчикам
+        with self.frames_lock:
+            return not self.busy and not self.frames
+
+    def take_frames(self):
+        with self.frames_lock:
+            frames = list(self.frames)
+            self.frames.clear()
+        return frames
+
+    def stop(self):
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+        if self in Globals.screen_encoders:
+            Globals.screen_encoders.remove(self)
+
+
+
+class FrameStream(QObject):
+
+    # Один поток кадров на каждый набор параметров захвата и кодеков:
+    # кадр захватывается и кодируется один раз за тик
+    # и один и тот же буфер раздаётся всем подписанным соединениям.
+    # Качество и масштаб в ключ не входят: контроллер потока меняет их часто,
+    # и они берутся у подписчиков на каждом кадре, без нового потока и его кодировщика
+
+    def __init__(self, key):
+        super().__init__()
+
+        self.key = key
+        self.capture_index, rect_tuple, self.codecs, self.refine_codecs, self.background, self.keyframes_only = key
+        if rect_tuple is None:
+            self.user_defined_capture_rect = None
+        else:
+            self.user_defined_capture_rect = QRect(*rect_tuple)
+
+        self.subscribers = []
+
+        # сколько кадров подряд экран не менялся
+        self.static_frames = 0
+        self.heartbeat_seq = 0
+        self.heartbeat_timestamp = 0.0
+        # ключевой кадр запрошен только для повтора картинки, а не потому что экран поменялся
+        self.refresh_requested = False
+
+        self.encoder = ScreenEncoder()
+        self.encoder.frameEncoded.connect(self.distributeFrames)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.captureFrame)
+
+        Globals.frame_streams[key] = self
+
+    @staticmethod
+    def make_key(capture_index, user_defined_capture_rect, codecs, refine_codecs=None, background=False,
+                                                                                        keyframes_only=False):
+        """
+            refine_codecs - кодеки для постепенного улучшения тайлов, None если оно выключено;
+            background - фоновый поток монитора вокруг области захвата, такие кадры портал
+            рисует под областью захвата и не путает с основными;
+            keyframes_only - только целые кадры ScreenData, для отправки по UDP
+        """
+        if capture_index == -2:
+            r = user_defined_capture_rect
+            rect_tuple = (r.left(), r.top(), r.width(), r.height())
+        else:
+            rect_tuple = None
+        return (capture_index, rect_tuple, codecs, refine_codecs, background, keyframes_only)
+
+    @classmethod
+    def subscribe(cls, connection, key, previous_stream=None):
+        stream = Globals.frame_streams.get(key)
+        if stream is None:
+            stream = cls(key)
+            if previous_stream is not None and previous_stream.key[:2] == key[:2] \
+                                            and not previous_stream.keyframes_only \
+                                            and previous_stream.encoder.is_idle():
+                # портал уже держит картинку предыдущего потока
+                # и поменялись только кодеки, поэтому можно продолжить с его тайлов;
+                # но не после кадров по UDP: последний из них мог и не дойти
+                stream.encoder.tile_encoder.take_state(previous_stream.encoder.tile_encoder)
+                stream.encoder.tile_cache.take_state(previous_stream.encoder.tile_cache)
+            else:
+                stream.encoder.request_keyframe()
+        else:
+            # новому подписчику нечего патчить, поэтому нужен ключевой кадр,
+            # а его кеш тайлов пока пуст
+            stream.encoder.request_keyframe()
+            stream.encoder.reset_tile_cache()
+        stream.subscribers.append(connection)
+        stream.updateInterval()
+        return stream
+
+    def unsubscribe(self, connection):
+        if connection in self.subscribers:
+            self.subscribers.remove(connection)
+        if self.subscribers:
+            self.updateInterval()
+        else:
+            self.stop()
+
+    def updateInterval(self):
+        # общий поток идёт с частотой самого требовательного подписчика
+        if not self.subscribers:
+            return
+        interval = min(c.frameInterval(self) for c in self.subscribers)
+        if self.static_frames >= Globals.IDLE_STATIC_FRAMES:
+            # экран давно не менялся, и захватывать его часто незачем
+            interval = max(interval, Globals.IDLE_CAPTURE_INTERVAL)
+        if self.timer.interval() != interval:
+            self.timer.setInterval(interval)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def request_keyframe(self):
+        self.encoder.request_keyframe()
+
+    def reset_tile_cache(self):
+        self.encoder.reset_tile_cache()
+
+    def quality(self):
+        # качество и масштаб, как и частота, - по самому требовательному подписчику
+        return max(c.frameQuality(self) for c in self.subscribers)
+
+    def scale(self):
+        return max(c.frameScale(self) for c in self.subscribers)
+
+    def capture_size(self):
+        if self.capture_index == -2:
+            return self.user_defined_capture_rect.size()
+        return Utils.capture_frame_rect(self.capture_index).size()
+
+    def tile_cache_size(self):
+        # кеш не больше, чем у самого бедного подписчика, а старые версии его не поддерживают
+        return min([c.tileCacheSize(self) for c in self.subscribers] + [Globals.tile_cache_size])
+
+    def throughput(self):
+        # кодек выбирается под самое медленное соединение
+        values = [c.stream_controller.throughput for c in self.subscribers]
+        values = [v for v in values if v is not None]
+        return min(values) if values else None
+
+    def captureFrame(self):
+        if not chat_dialog.remote_control_chb.isChecked():
+            return
+        if self.capture_index >= len(ScreenGeometryCache.get()):
+            # монитор этого потока отключили: подписчики переходят на другие потоки,
+            # а этот остановится, когда от него отпишется последний
+            for connection in self.subscribers[:]:
+                connection.updateFrameSubscription()
+            return
+        # захватываем, пока хотя бы один подписчик может принять кадр
+        ready = [c for c in self.subscribers if c.isReadyForFrame()]
+        if not ready:
+            return
+        if self.encoder.busy:
+            for connection in ready:
+                connection.skipFrame()
+            return
+        job = Utils.grab_screenshot(self)
+        self.encoder.request(job)
+
+    def wake(self):
+        # пользователь что-то делает, и экран вот-вот поменяется
+        if self.static_frames:
+            self.static_frames = 0
+            self.updateInterval()
+
+    def distributeFrames(self, is_static):
+        frames = self.encoder.take_frames()
+        for frame in frames:
+            for connection in self.subscribers[:]:
+                connection.queueFrame(frame, self)
+
+        if frames:
+            self.heartbeat_timestamp = time.time()
+            if self.refresh_requested:
+                # повтор картинки для UDP не значит, что экран ожил
+                self.refresh_requested = False
+            else:
+                self.wake()
+        elif is_static:
+            self.static_frames += 1
+            if self.static_frames == Globals.IDLE_STATIC_FRAMES:
+                self.updateInterval()
+            if time.time() - self.heartbeat_timestamp >= Globals.HEARTBEAT_INTERVAL:
+                if self.keyframes_only:
+                    # последний кадр мог потеряться по дороге, а новых не будет, пока экран стоит
+                    self.refresh_requested = True
+                    self.request_keyframe()
+                self.sendHeartbeat()
+
+    def sendHeartbeat(self):
+        # вместо одинаковых кадров портал изредка получает короткое сообщение, что связь жива
+        self.heartbeat_timestamp = time.time()
+        self.heartbeat_seq += 1
+        data = Utils.prepare_data_to_write({DataType.ScreenHeartbeat: {'seq': self.heartbeat_seq}}, None)
+        for connection in self.subscribers[:]:
+            connection.sendHeartbeat(data)
+
+    def drop(self, frame):
+        self.encoder.drop(frame)
+
+    def stop(self):
+        self.timer.stop()
+        self.encoder.stop()
+        if Globals.frame_streams.get(self.key) is self:
+            Globals.frame_streams.pop(self.key)
+
+
+
+class Channel(QObject):
+
+    # дополнительный сокет соединения для одного класса трафика: у него свои очереди отправки,
+    # свой разбор сообщений и свои настройки сокета, а сообщения обрабатывает само соединение
+
+    def __init__(self, connection, kind, socket, message_reader=None):
+        super().__init__()
+
+        self.connection = connection
+        self.kind = kind
+        self.socket = socket
+        self.ready = False
+
+        self.message_reader = message_reader or connection.createMessageReader()
+        self.message_reader.open_sink = connection.openMessageSink
+        self.outbound = OutboundScheduler(slice_size=Globals.SEND_SLICE_SIZE)
+        self.outbound.fragments = connection.outbound.fragments
+
+        self.socket.readyRead.connect(self.processReadyRead)
+        self.socket.bytesWritten.connect(self.onBytesWritten)
+        self.socket.disconnected.connect(self.onDisconnected)
+
+    def open(self, session):
+        self.socket.connected.connect(lambda: self.sendChannelGreeting(session))
+        self.socket.errorOccurred.connect(self.onDisconnected)
+        connection_socket = self.connection.socket
+        self.socket.connectToHost(connection_socket.peerAddress(), connection_socket.peerPort())
+
+    def sendChannelGreeting(self, session):
+        Utils.socket_info_to_chat(f'{self.kind} channel opened', self.socket, channel_kind=self.kind)
+        data = Utils.prepare_data_to_write({DataType.ChannelGreeting: {
+            'session': session,
+            'channel': self.kind,
+        }}, None)
+        self.socket.write(data)
+        self.connection.addChannel(self)
+
+    def processReadyRead(self):
+        while self.socket.bytesAvailable() > 0:
+            self.message_reader.feed(self.socket.read(self.socket.bytesAvailable()))
+        self.connection.processMessages(self.message_reader, channel=self)
+
+    def writeMessage(self, buffers, priority):
+        self.outbound.push(buffers, priority)
+        Utils.flush_outbound(self.socket, self.outbound)
+
+    def bytesToWrite(self):
+        return self.socket.bytesToWrite() + self.outbound.pending_size()
+
+    def onBytesWritten(self, bytes_count):
+        Utils.flush_outbound(self.socket, self.outbound)
+        if self.kind == Globals.PRIORITY_CHANNELS[Priority.VIDEO]:
+            self.connection.onVideoBytesWritten(bytes_count)
+
+    def onDisconnected(self, *args):
+        self.connection.removeChannel(self)
+
+    def close(self):
+        self.outbound.clear()
+        self.socket.abort()
+
+
+
+class MediaSender(QObject):
+
+    # Кадры ScreenData по UDP к порталу собеседника. Потерянный кадр не перепосылается,
+    # его всё равно заменит следующий, поэтому кадры не ждут друг друга, как в TCP.
+    # Управление, ввод, файлы и остальные кадры идут по TCP как раньше
+
+    def __init__(self, connection, port, stream_id, fec_group):
+        super().__init__()
+
+        self.address = connection.socket.peerAddress()
+        self.port = port
+        self.packetizer = MediaPacketizer(stream_id, fec_group=fec_group)
+        self.failed_datagrams = 0
+
+        self.socket = QUdpSocket(self)
+        self.socket.bind(QHostAddress.Any, 0)
+        Utils.apply_socket_options(self.socket, 'media')
+
+    def writeFrame(self, buffers):
+        """
+            возвращает False, если кадр не режется на датаграммы и его надо отправить по TCP
+        """
+        try:
+            datagrams = self.packetizer.packetize([bytes(buffer) for buffer in buffers])
+        except ValueError:
+            return False
+        for datagram in datagrams:
+            if self.socket.writeDatagram(datagram, self.address, self.port) < 0:
+                # буфер сокета переполнен, и остаток кадра всё равно не соберётся
+                self.failed_datagrams += 1
+                break
+        return True
+
+    def info(self):
+        return self.packetizer.info() + f', {self.failed_datagrams} frames cut short by the socket'
+
+    def close(self):
+        self.socket.close()
+
+
+
+class MediaReceiver(QObject):
+
+    # UDP-сокет портала: собирает кадры из датаграмм собеседника и отдаёт их соединению
+
+    def __init__(self, connection):
+        super().__init__()
+
+        self.connection = connection
+        self.reassembler = MediaReassembler(int.from_bytes(os.urandom(4), 'big'),
+                                max_frame_size=Connection.message_size_limits[DataType.ScreenData])
+        self.message_reader = connection.createMessageReader()
+
+        self.socket = QUdpSocket(self)
+        self.socket.bind(QHostAddress.Any, 0)
+        Utils.apply_socket_options(self.socket, 'media')
+        self.socket.readyRead.connect(self.processPendingDatagrams)
+
+    def port(self):
+        return self.socket.localPort()
+
+    def stream_id(self):
+        return self.reassembler.stream_id
+
+    def processPendingDatagrams(self):
+        peer_address = self.connection.socket.peerAddress()
+        while self.socket.hasPendingDatagrams():
+            datagram = self.socket.receiveDatagram()
+            # датаграммы принимаются только от того, кому отдан номер порта
+            if not datagram.senderAddress().isEqual(peer_address, QHostAddress.TolerantConversion):
+                continue
+            frame = self.reassembler.feed(bytes(datagram.data()))
+            if frame is not None:
+                self.processFrame(frame)
+
+    def processFrame(self, frame):
+        # кадр приходит целиком, поэтому между кадрами в message_reader ничего не остаётся
+        self.message_reader.feed(frame)
+        try:
+            for cbor2_data, binary_data in self.message_reader.messages():
+                # по UDP принимаются только кадры, всё остальное ходит по TCP
+                if cbor2_data and decode_message(cbor2_data)[0] == DataType.ScreenData:
+                    self.connection.processMessage(cbor2_data, binary_data)
+        except ProtocolError as e:
+            print(f'broken UDP frame: {e}')
+            self.message_reader = self.connection.createMessageReader()
+
+    def info(self):
+        return self.reassembler.info()
+
+    def close(self):
+        self.socket.close()
+
+
+
 class Connection(QObject):
 
     readyForUse = pyqtSignal()
@@ -1532,10 +2561,6 @@ class Connection(QObject):
         #     super().deleteLater()
         # RuntimeError: wrapped C/C++ object of type Connection has been deleted
 
-    class states():
-        readSize = 0
-        readData = 1
-
     def __init__(self, parent, client_socket=None):
         super().__init__()
 
@@ -1543,25 +2568,63 @@ class Connection(QObject):
 
         self.greetingMessage = 888
         self.username = 'unknown'
-        self.screenshotTimer = QTimer()
 
         self.buffer = ''
 
-        self.screenshotTimer.setInterval(Globals.SCREENSHOT_SENDING_INTERVAL)
+        self.frame_stream = None
+        # в двухпоточном режиме рядом с областью захвата идёт редкий и дешёвый поток всего монитора
+        self.background_stream = None
+        self.dual_stream = False
+
+        # последний закодированный кадр, который ждёт, пока сокет разгрузится
+        self.pending_frame = None
+        self.pending_background_frame = None
+        self.frame_wanted = False
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+
+        self.stream_controller = AdaptiveStreamController(
+            interval=Globals.SCREENSHOT_SENDING_INTERVAL,
+            min_interval=Globals.SCREENSHOT_SENDING_INTERVAL,
+        )
+
+        # размер вьюпорта портала в физических пикселях
+        self.viewport_size = None
+
+        self.peer_codecs = [Globals.DEFAULT_FRAME_CODEC]
+        self.peer_features = set()
+        self.peer_tile_cache_size = 0
+        # кеш тайлов на стороне портала, ключи в нём - номера тайлов от отправителя
+        self.tile_cache = TileCache()
+        self.codec_mode = 'auto'
+        self.progressive = False
+        self.video_decoder = None
         self.currentDataType = DataType.Undefined
         self.isGreetingMessageSent = False
 
         self.socket.readyRead.connect(self.processReadyRead)
-        self.socket.disconnected.connect(self.screenshotTimer.stop)
-        self.screenshotTimer.timeout.connect(self.sendScreenshot)
+        self.socket.disconnected.connect(self.stopScreenStreaming)
+        self.socket.bytesWritten.connect(self.onBytesWritten)
         self.socket.connected.connect(self.sendGreetingMessage)
 
-        self.socket_buffer = bytes()
-        self.readState = self.states.readSize
-
-        self.content_data_size = 0
-        self.cbor2_data_size = 0
-        self.binary_data_size = 0
+        self.message_reader = self.createMessageReader()
+        self.outbound = OutboundScheduler(slice_size=Globals.SEND_SLICE_SIZE)
+        self.message_stats = MessageStats()
+        # кодек сжатия выбирается, когда придёт приветствие собеседника
+        self.compressor = MessageCompressor()
+
+        # дополнительные сокеты к тому же собеседнику по классам трафика, см. Globals.PRIORITY_CHANNELS;
+        # собеседник находит по session, к какому соединению они относятся
+        self.session = os.urandom(8).hex()
+        self.channels = dict()
+        self.opens_channels = False
+        self.socket.disconnected.connect(self.closeChannels)
+
+        # кадры ScreenData по UDP: media_sender у того, кто показывает экран,
+        # а media_receiver у портала, который его об этом попросил
+        self.media_sender = None
+        self.media_receiver = None
+        self.socket.disconnected.connect(self.closeMediaReceiver)
 
         # -2 - user defined capture region
         # -1 - all monitors
@@ -1575,9 +2638,13 @@ class Connection(QObject):
         self.status = ''
 
         self.control_connection = False
+        self.view_connection = False
 
         self.mac = None
 
+    def isStreamingConnection(self):
+        return self.control_connection or self.view_connection
+
     def remove_occupato_flag_if_needed(self):
         if self.control_connection:
             Globals.OCCUPATO = False
@@ -1591,269 +2658,775 @@ class Connection(QObject):
     def sendMessage(self, message):
         if not message:
             return False
-        self.socket.write(Utils.prepare_data_to_write({DataType.PlainText: message}, None))
+        self.writeMessage(Utils.prepare_data_to_write({DataType.PlainText: message}, None), Priority.CHAT)
         return True
 
     def processReadyRead(self):
+        # дочитываем всё, что есть в сокете, и разбираем все пришедшие целиком сообщения,
+        # а не по одному сообщению за вызов
+        while self.socket.bytesAvailable() > 0:
+            self.message_reader.feed(self.socket.read(self.socket.bytesAvailable()))
+        self.processMessages(self.message_reader)
+
+    def createMessageReader(self):
+        return MessageReader(
+            max_message_size=Globals.MAX_MESSAGE_SIZE,
+            size_limits=self.message_size_limits,
+            default_size_limit=Globals.DEFAULT_MESSAGE_SIZE_LIMIT,
+            open_sink=self.openMessageSink,
+        )
+
+    def openMessageSink(self, data_type, value, binary_size):
+        # большие куски файлов пишутся на диск по мере прихода, а не копятся в памяти
+        if data_type == DataType.FileData:
+            # файл открывается ещё до processMessage, поэтому значение проверяется здесь
+            check_value(value, self.message_schemas[DataType.FileData], DataType.name(data_type))
+            return FileTransfer.open_received_file(value)
+        return None
 
-        def retrieve_data(length):
-            data = self.socket_buffer
-            requested_data = data[:length]
-            left_data = data[length:]
-            self.socket_buffer = left_data
-            return requested_data
-
-        self.socket_buffer = self.socket_buffer + self.socket.read(200000)
-
-        self.data_full_to_read = True
-
-        # while len(self.socket_buffer) > Globals.TCP_MESSAGE_HEADER_SIZE and self.data_full_to_read:
-        if True:
-            if self.readState == self.states.readSize:
-                if len(self.socket_buffer) >= Globals.TCP_MESSAGE_HEADER_SIZE:
-                    self.content_data_size = int.from_bytes(retrieve_data(Globals.INT_SIZE), 'big')
-                    self.cbor2_data_size = int.from_bytes(retrieve_data(Globals.INT_SIZE), 'big')
-                    self.binary_data_size = int.from_bytes(retrieve_data(Globals.INT_SIZE), 'big')
-                    self.readState = self.states.readData
-                    print('content_data_size', self.content_data_size, 'socket_buffer_size', len(self.socket_buffer))
-                    # print('size read', self.content_data_size)
+    def processMessages(self, message_reader, channel=None):
+        socket = self.socket if channel is None else channel.socket
+        try:
+            for cbor2_data, binary_data in message_reader.messages():
+                if cbor2_data is None:
+                    start = time.perf_counter()
+                    event_type, value, timestamp = unpack_input_event(binary_data)
+                    self.processInputEvent(event_type, value, timestamp)
+                    data_type = DataType.MouseData if event_type in MOUSE_EVENTS else DataType.KeyboardData
+                    self.message_stats.record(data_type, len(binary_data) + 1, time.perf_counter() - start)
                 else:
-                    pass
-                    # print('not enough data to read the data size')
-
-            # здесь обязательно, чтобы было if, и не было else if
-            # это нужно для того, чтобы сразу прочитать данные,
-            # если они уже есть и не ставить сообщение в очередь через emit
-            if self.readState == self.states.readData:
-                if self.content_data_size < 0:
-                    raise Exception('Fuck!')
-
-                if len(self.socket_buffer) >= self.content_data_size:
-                    cbor2_data = retrieve_data(self.cbor2_data_size)
-                    binary_data = retrieve_data(self.binary_data_size)
-
-                    try:
-
-                        screen_info = None
-                        file_chunk_info = None
-
-                        if cbor2_data:
-                            parsed_data = cbor2.loads(cbor2_data)
-
-                            if isinstance(parsed_data, dict):
-                                self.currentDataType, value = list(parsed_data.items())[0]
-                                if self.currentDataType == DataType.Greeting:
-
-                                    msg = value['msg']
-                                    mac = value['mac']
-                                    status = value['status']
-
-                                    addr = self.socket.peerAddress().toString()
-                                    port = self.socket.peerPort()
-
-                                    # print(f'reading thread: {QThread.currentThreadId()}', flush=True)
-                                    with writing_lock:
-                                        Globals.update_peers_list(addr, port, mac)
-
-                                    self.username = f'{msg}@{addr}:{port} // {mac}'
-                                    self.mac = mac
-
-                                    if not self.isGreetingMessageSent:
-                                        self.sendGreetingMessage()
-
-                                    self.readyForUse.emit()
-
-                                    # status update
-                                    self.status = status
-                                    chat_dialog.newParticipant(self.name(), self)
-
-                                elif self.currentDataType == DataType.ControlRequest:
-
-                                    if value == ControlRequest.GiveMeControl:
-                                        if Globals.OCCUPATO:
-                                            self.sendControlRequestAnswer(ControlRequest.Occupato)
-                                        else:
-                                            self.control_connection = True
-                                            Globals.OCCUPATO = True
-                                            self.sendControlRequestAnswer(ControlRequest.Granted)
-                                            self.screenshotTimer.start()
-
-                                    elif value == ControlRequest.Granted:
-                                        chat_dialog.prepare_portal()
-
-                                    elif value == ControlRequest.Occupato:
-                                        chat_dialog.appendSystemMessage('Error: remote host occupato!')
-
-                                    elif value == ControlRequest.Break:
-                                        if self.control_connection:
-                                            Globals.OCCUPATO = False
-                                            self.control_connection = False
-                                            self.screenshotTimer.stop()
-                                            self.sendControlRequestAnswer(ControlRequest.Break)
-                                        else:
-                                            chat_dialog.portal_off()
-
-                                elif self.currentDataType == DataType.InfoStatus:
-                                    new_status = value
-                                    chat_dialog.appendSystemMessage(f'Peer changed status from {self.status} to {new_status}')
-                                    self.status = new_status
-                                    chat_dialog.newParticipant(self.name(), self)
-
-                                elif self.currentDataType == DataType.PlainText:
-                                    self.newMessage.emit(self.username, value)
-
-                                elif self.currentDataType == DataType.MouseData:
-
-                                    if self.control_connection:
-                                        mouse_data = value
-                                        item = list(mouse_data.items())[0]
-                                        mouse_type = item[0]
-                                        mouse_value = item[1]
-
-                                        mouse_button = mouse_value
-                                        if mouse_type == 'mousePos':
-                                            x, y = mouse_value
-                                            try:
-                                                pyautogui.moveTo(x, y)
-                                            except:
-                                                pass
-
-                                        elif mouse_type == 'mouseDown':
-                                            pyautogui.mouseDown(button=mouse_button)
-                                        elif mouse_type == 'mouseUp':
-                                            pyautogui.mouseUp(button=mouse_button)
-                                            TransparentWidget.show_screencast_keys_window('up', mouse_button)
-
-                                        elif mouse_type == 'mouseWheel':
-                                            if mouse_value > 0:
-                                                pyautogui.scroll(1)
-                                                TransparentWidget.show_screencast_keys_window('up', "wheel up")
-                                            else:
-                                                pyautogui.scroll(-1)
-                                                TransparentWidget.show_screencast_keys_window('up', "wheel down")
-
-                                        print(mouse_data)
-
-                                elif self.currentDataType == DataType.KeyboardData:
-
-                                    if self.control_connection:
-                                        keyboard_data = value
-                                        item = list(keyboard_data.items())[0]
-                                        event_type = item[0]
-                                        key_value = item[1]
-
-                                        if event_type == 'keyDown':
-                                            pyautogui.keyDown(key_value)
-                                        elif event_type == 'keyUp':
-                                            pyautogui.keyUp(key_value)
-                                            TransparentWidget.show_screencast_keys_window('up', key_value)
-                                        elif event_type == 'keyHotkey':
-                                            pyautogui.hotkey(key_value)
-                                            TransparentWidget.show_screencast_keys_window('up', "+".join(key_value))
-
-                                elif self.currentDataType == DataType.FileData:
-                                    file_chunk_info = value
-
-
-                                elif self.currentDataType == DataType.ControlFPS:
-                                    if self.control_connection:
-                                        fps = value['fps']
-                                        chat_dialog.appendSystemMessage(f'Remote host wants {fps} FPS')
-                                        self.screenshotTimer.setInterval(int(1000/fps))
-
-                                elif self.currentDataType == DataType.ControlUserDefinedCaptureRect:
-
-                                    if self.control_connection:
-                                        if self.capture_index != -2:
-                                            self.before_user_defined_capture_index = self.capture_index
-                                        rect = value['rect']
-                                        rect = QRect(*rect)
-                                        if rect.isNull():
-                                            self.capture_index = self.before_user_defined_capture_index
-                                            self.user_defined_capture_rect = None
-                                            chat_dialog.appendSystemMessage(f'Remote host wants to reset user-defined capture rect')
-                                        else:
-                                            self.capture_index = -2
-                                            self.user_defined_capture_rect = rect
-                                            chat_dialog.appendSystemMessage(f'Remote host wants to set user-defined capture rect {rect}')
-
-                                elif self.currentDataType == DataType.ScreenData:
-                                    screen_info = value
-
-                                elif self.currentDataType == DataType.ControlCaptureScreen:
-                                    if self.control_connection:
-                                        capture_index = value
-                                        count = len(QGuiApplication.screens())
-                                        if capture_index > count-1:
-                                            chat_dialog.appendSystemMessage(f'Remote host wants to capture screen number {capture_index+1}, BUT THERE ARE ONLY {count} SCREENS!')
-                                        else:
-                                            self.capture_index = capture_index
-                                            chat_dialog.appendSystemMessage(f'Remote host wants to capture screen number {capture_index+1}')
-
-                                else:
-                                    chat_dialog.appendSystemMessage(f'Undefined crap has been received {parsed_data}')
+                    self.processMessage(cbor2_data, binary_data, channel=channel)
 
+                if not socket.isValid():
+                    return
+        except ProtocolError as e:
+            # после испорченного или слишком большого сообщения поток дальше не разобрать
+            address = socket.peerAddress().toString()
+            chat_dialog.appendSystemMessage(f'Protocol error from {address}: {e}, aborting...')
+            socket.abort()
+
+    def processMessage(self, cbor2_data, binary_data, channel=None):
+        # обработчик выбирается по типу сообщения из message_handlers,
+        # а время разбора и обработки записывается в message_stats по этому типу
+        if not cbor2_data:
+            return
+        start = time.perf_counter()
+        try:
+            self.currentDataType, value = decode_message(cbor2_data)
+        except ProtocolError as e:
+            chat_dialog.appendSystemMessage(f'Undefined crap has been received: {e}')
+            return
 
-                            else:
-                                chat_dialog.appendSystemMessage(f'Undefined crap has been received, and there is no header section within {parsed_data}')
+        # кривое значение от собеседника закрывает соединение, а не приложение,
+        # поэтому обработчик получает уже проверенное
+        check_value(value, self.message_schemas.get(self.currentDataType, object), DataType.name(self.currentDataType))
+        handler = self.message_handlers.get(self.currentDataType, Connection.handleUndefined)
+        handler(self, value, binary_data, channel)
 
-                        if binary_data:
+        if isinstance(binary_data, StreamedPayload):
+            binary_size = binary_data.size
+        else:
+            binary_size = len(binary_data)
+        size = HEADER.size + len(cbor2_data) + binary_size
+        self.message_stats.record(self.currentDataType, size, time.perf_counter() - start)
 
-                            if screen_info:
-                                input_byte_array = QByteArray(binary_data)
-                                capture_image = QImage()
-                                capture_image.loadFromData(input_byte_array, Globals.IMAGE_FORMAT);
-                                print(f'received image, {len(binary_data)}, {capture_image.size()}')
+    @classmethod
+    def register_handler(cls, data_type, handler, schema=object):
+        """
+            handler(connection, value, binary_data, channel) вызывается
+            для каждого сообщения с типом data_type, значение которого подходит под schema
+        """
+        cls.message_handlers[data_type] = handler
+        cls.message_schemas[data_type] = schema
 
-                                capture_rect_tuple = screen_info.get('rect', None)
-                                capture_index = screen_info.get('capture_index', None)
-                                screens_count = screen_info.get('screens_count', None)
+    def updateReadingFramerate(self):
+        value = Globals.calculate_reading_framerate()
+        text = f'reading image framerate: {value}'
+        chat_dialog.framerate_label.setText(text)
 
-                                Portal.show_in_portal(capture_image, capture_index, screens_count, QRect(*capture_rect_tuple), self)
+    def handleUndefined(self, value, binary_data, channel):
+        chat_dialog.appendSystemMessage(f'Undefined crap has been received {{{self.currentDataType}: {value}}}')
 
+    def handleGreeting(self, value, binary_data, channel):
+        if channel is not None:
+            # по дополнительному каналу приветствие присылает сервер собеседника,
+            # пока ещё не знает, что это канал
+            return
 
-                                value = Globals.calculate_reading_framerate()
-                                text = f'reading image framerate: {value}'
-                                chat_dialog.framerate_label.setText(text)
+        if self.opens_channels and CHANNELS_FEATURE in value.get('features', ()) and 'session' not in value:
+            raise ProtocolError('greeting offers channels without a session')
 
+        msg = value['msg']
+        mac = value['mac']
+        status = value['status']
+        self.peer_codecs = value.get('codecs', [Globals.DEFAULT_FRAME_CODEC])
+        self.peer_tile_cache_size = value.get('tile_cache', 0)
+        self.peer_features = set(value.get('features', ()))
+        self.outbound.fragments = FRAGMENTS_FEATURE in self.peer_features
+        self.compressor.compression = choose_compression(value.get('compression', ()))
+        # дополнительные каналы открывает тот, кто подключался сам
+        if self.opens_channels and CHANNELS_FEATURE in self.peer_features:
+            self.openChannels(value['session'])
 
+        addr = self.socket.peerAddress().toString()
+        port = self.socket.peerPort()
 
-                            elif file_chunk_info:
-                                FileTransfer.write_file_chunk_data(file_chunk_info, binary_data, self.socket.peerAddress().toString())
+        # print(f'reading thread: {QThread.currentThreadId()}', flush=True)
+        with writing_lock:
+            Globals.update_peers_list(addr, port, mac)
 
+        self.username = f'{msg}@{addr}:{port} // {mac}'
+        self.mac = mac
 
-                    except Exception as e:
-                        raise
-                        print(e, 'aborting...')
-                        self.socket.abort()
+        if not self.isGreetingMessageSent:
+            self.sendGreetingMessage()
 
-                        if not self.socket.isValid():
-                            self.socket.abort()
-                            return
+        self.readyForUse.emit()
 
+        # status update
+        self.status = status
+        chat_dialog.newParticipant(self.name(), self)
 
-                    self.content_data_size = 0
-                    self.readState = self.states.readSize
+    def handleChannelGreeting(self, value, binary_data, channel):
+        self.joinSession(value)
 
-                else:
-                    self.data_full_to_read = False
-                    print('not enough data to read', len(self.socket_buffer), self.content_data_size)
+    def handleControlRequest(self, value, binary_data, channel):
+        if value == ControlRequest.GiveMeControl:
+            if Globals.OCCUPATO:
+                self.sendControlRequestAnswer(ControlRequest.Occupato)
+            else:
+                self.control_connection = True
+                Globals.OCCUPATO = True
+                self.sendControlRequestAnswer(ControlRequest.Granted)
+                self.startScreenStreaming()
+
+        elif value == ControlRequest.GiveMeView:
+            # только просмотр: занятость не проверяется, управляющие данные не принимаются
+            self.view_connection = True
+            self.sendControlRequestAnswer(ControlRequest.Granted)
+            self.startScreenStreaming()
+
+        elif value == ControlRequest.Granted:
+            chat_dialog.prepare_portal()
+
+        elif value == ControlRequest.Occupato:
+            chat_dialog.appendSystemMessage('Error: remote host occupato!')
+
+        elif value == ControlRequest.Break:
+            if self.isStreamingConnection():
+                if self.control_connection:
+                    Globals.OCCUPATO = False
+                self.control_connection = False
+                self.view_connection = False
+                self.viewport_size = None
+                self.stopScreenStreaming()
+                self.sendControlRequestAnswer(ControlRequest.Break)
+            else:
+                chat_dialog.portal_off()
+
+    def handleInfoStatus(self, value, binary_data, channel):
+        new_status = value
+        chat_dialog.appendSystemMessage(f'Peer changed status from {self.status} to {new_status}')
+        self.status = new_status
+        chat_dialog.newParticipant(self.name(), self)
+
+    def handlePlainText(self, value, binary_data, channel):
+        self.newMessage.emit(self.username, value)
+
+    def handleInputData(self, value, binary_data, channel):
+        # так события присылают версии без коротких сообщений
+        if len(value) != 1:
+            raise ProtocolError(f'{len(value)} input events in one message')
+        event_type, event_value = next(iter(value.items()))
+        # события незнакомого типа processInputEvent пропускает
+        check_value(event_value, MessageSchemas.INPUT_EVENTS.get(event_type, object), event_type)
+        self.processInputEvent(event_type, event_value)
+
+    def handleFileData(self, value, binary_data, channel):
+        if isinstance(binary_data, StreamedPayload):
+            FileTransfer.finish_file_chunk(value, self.socket.peerAddress().toString())
+        elif binary_data:
+            FileTransfer.write_file_chunk_data(value, binary_data, self.socket.peerAddress().toString())
+
+    def handleControlFPS(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            fps = value['fps']
+            chat_dialog.appendSystemMessage(f'Remote host wants {fps} FPS')
+            self.stream_controller.set_preference(AdaptiveStreamController.MANUAL, interval=1000/fps)
+            self.updateFrameSubscription()
+
+    def handleControlViewport(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            width, height = value['size']
+            dpr = value['dpr']
+            self.viewport_size = QSize(math.ceil(width*dpr), math.ceil(height*dpr))
+            self.updateFrameSubscription()
+
+    def handleControlStreamingPreference(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            chat_dialog.appendSystemMessage(f'Remote host wants streaming preference {value}')
+            self.stream_controller.set_preference(value)
+            self.updateFrameSubscription()
+
+    def handleControlCodec(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            chat_dialog.appendSystemMessage(f'Remote host wants frame codec {value}')
+            self.codec_mode = value
+            self.updateFrameSubscription()
+
+    def handleControlProgressive(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            chat_dialog.appendSystemMessage(f'Remote host wants progressive refinement: {value}')
+            self.progressive = bool(value)
+            self.updateFrameSubscription()
+
+    def handleControlDualStream(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            chat_dialog.appendSystemMessage(f'Remote host wants dual-stream mode: {value}')
+            self.dual_stream = bool(value)
+            self.updateFrameSubscription()
+
+    def handleControlMediaTransport(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            self.closeMediaSender()
+            if value:
+                self.media_sender = MediaSender(self, value['port'], value['stream'], value.get('fec', 0))
+            chat_dialog.appendSystemMessage(f'Remote host wants frames over UDP: {bool(value)}')
+            self.updateFrameSubscription()
+
+    def handleControlUserDefinedCaptureRect(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            if self.capture_index != -2:
+                self.before_user_defined_capture_index = self.capture_index
+            rect = value['rect']
+            rect = QRect(*rect)
+            if rect.isNull():
+                self.capture_index = self.before_user_defined_capture_index
+                self.user_defined_capture_rect = None
+                chat_dialog.appendSystemMessage(f'Remote host wants to reset user-defined capture rect')
+            else:
+                self.capture_index = -2
+                self.user_defined_capture_rect = rect
+                chat_dialog.appendSystemMessage(f'Remote host wants to set user-defined capture rect {rect}')
+            self.updateFrameSubscription()
 
-        if self.data_full_to_read and len(self.socket_buffer) > Globals.TCP_MESSAGE_HEADER_SIZE:
-            self.socket.readyRead.emit()
+    def handleScreenData(self, value, binary_data, channel):
+        if not binary_data:
+            return
+        screen_info = value
+        codec = FrameCodecs.decoder(screen_info.get('codec', Globals.DEFAULT_FRAME_CODEC))
+        capture_image = codec.decode(binary_data)
+        print(f'received image, {len(binary_data)}, {capture_image.size()}')
+        # ключевой кадр целиком, поэтому тайлы из кеша рисовать не нужно
+        cache_misses = Portal.touch_tile_cache(screen_info.get('cache'), capture_image, self)[1]
+        Portal.fill_tile_cache(cache_misses, capture_image, self)
+
+        capture_rect_tuple = screen_info.get('rect', None)
+        capture_index = screen_info.get('capture_index', None)
+        screens_count = screen_info.get('screens_count', None)
+
+        Portal.show_in_portal(capture_image, capture_index, screens_count, QRect(*capture_rect_tuple), self,
+                                                    background=screen_info.get('background', False))
+        self.updateReadingFramerate()
+
+    def handleScreenTilesData(self, value, binary_data, channel):
+        Portal.patch_in_portal(value, binary_data, self)
+        self.updateReadingFramerate()
+
+    def handleScreenVideoData(self, value, binary_data, channel):
+        Portal.play_in_portal(value, binary_data, self)
+        self.updateReadingFramerate()
+
+    def handleScreenHeartbeat(self, value, binary_data, channel):
+        Portal.keep_alive_in_portal(value, self)
+
+    def handleControlKeyframe(self, value, binary_data, channel):
+        self.requestKeyframes()
+
+    def handleControlTileCacheResync(self, value, binary_data, channel):
+        if self.isStreamingConnection() and self.frame_stream:
+            self.frame_stream.reset_tile_cache()
+            self.frame_stream.request_keyframe()
+
+    def handleControlCaptureScreen(self, value, binary_data, channel):
+        if self.isStreamingConnection():
+            capture_index = value
+            count = len(QGuiApplication.screens())
+            if capture_index > count-1:
+                chat_dialog.appendSystemMessage(f'Remote host wants to capture screen number {capture_index+1}, BUT THERE ARE ONLY {count} SCREENS!')
+            else:
+                self.capture_index = capture_index
+                chat_dialog.appendSystemMessage(f'Remote host wants to capture screen number {capture_index+1}')
+            self.updateFrameSubscription()
+
+    # сколько байт может быть в бинарной части сообщения, проверяется ещё до её прихода
+    message_size_limits = {
+        DataType.ScreenData: Globals.MAX_MESSAGE_SIZE,
+        DataType.ScreenTilesData: Globals.MAX_MESSAGE_SIZE,
+        DataType.ScreenVideoData: 16*1024*1024,
+        DataType.FileData: 16*1024*1024,
+    }
+
+    # как выглядит значение сообщения каждого типа, см. check_value;
+    # значения типов, которых здесь нет, обработчики проверяют сами
+    message_schemas = {
+        DataType.Greeting: {
+            # попадает только в имя собеседника, а пока имя не задано, там число
+            'msg': object,
+            'mac': str,
+            'status': str,
+            'codecs': Optional([str]),
+            'tile_cache': Optional(range(0, 0x100000)),
+            'features': Optional([str]),
+            'session': Optional(str),
+            'compression': Optional([str]),
+        },
+        DataType.ChannelGreeting: {
+            'session': str,
+            'channel': frozenset(Globals.PRIORITY_CHANNELS.values()),
+        },
+        DataType.InfoStatus: str,
+        DataType.PlainText: str,
+        DataType.MouseData: dict,
+        DataType.KeyboardData: dict,
+        DataType.FileData: {
+            'md5_hash': MessageSchemas.MD5_HASH,
+            'total_size': range(0, 1 << 63),
+            'filename': str,
+            'chunk_size': range(0, 1 << 63),
+        },
+        DataType.ControlFPS: {'fps': MessageSchemas.FPS},
+        DataType.ControlViewport: {'size': MessageSchemas.SIZE, 'dpr': MessageSchemas.DPR},
+        DataType.ControlStreamingPreference: frozenset((AdaptiveStreamController.LATENCY, AdaptiveStreamController.QUALITY)),
+        DataType.ControlCodec: str,
+        DataType.ControlMediaTransport: (None, {
+            'port': range(1, 0x10000),
+            'stream': range(0, 1 << 32),
+            'fec': Optional(range(0, 0x100)),
+        }),
+        DataType.ControlUserDefinedCaptureRect: {'rect': MessageSchemas.RECT},
+        DataType.ControlCaptureScreen: range(-1, 0x100),
+        DataType.ScreenData: {
+            'rect': MessageSchemas.RECT,
+            'capture_index': MessageSchemas.CAPTURE_INDEX,
+            'screens_count': MessageSchemas.SCREENS_COUNT,
+            'codec': Optional(str),
+            'cache': Optional(MessageSchemas.TILE_CACHE),
+        },
+        DataType.ScreenTilesData: {
+            'capture_index': MessageSchemas.CAPTURE_INDEX,
+            'size': MessageSchemas.SIZE,
+            'tiles': MessageSchemas.TILES,
+            'codec': Optional(str),
+            'refine': Optional({'codec': str, 'tiles': MessageSchemas.TILES}),
+            'copy': Optional([MessageSchemas.LENGTH]*6),
+            'cache': Optional(MessageSchemas.TILE_CACHE),
+        },
+        DataType.ScreenVideoData: {
+            'codec': str,
+            'keyframe': object,
+            'rect': MessageSchemas.RECT,
+            'capture_index': MessageSchemas.CAPTURE_INDEX,
+            'screens_count': MessageSchemas.SCREENS_COUNT,
+        },
+        DataType.ScreenHeartbeat: {'seq': int},
+    }
+
+    message_handlers = {
+        DataType.Greeting: handleGreeting,
+        DataType.ChannelGreeting: handleChannelGreeting,
+        DataType.InfoStatus: handleInfoStatus,
+        DataType.PlainText: handlePlainText,
+        DataType.ControlRequest: handleControlRequest,
+
+        DataType.ScreenData: handleScreenData,
+        DataType.ScreenTilesData: handleScreenTilesData,
+        DataType.ScreenVideoData: handleScreenVideoData,
+        DataType.ScreenHeartbeat: handleScreenHeartbeat,
+        DataType.MouseData: handleInputData,
+        DataType.KeyboardData: handleInputData,
+        DataType.FileData: handleFileData,
+
+        DataType.ControlFPS: handleControlFPS,
+        DataType.ControlViewport: handleControlViewport,
+        DataType.ControlStreamingPreference: handleControlStreamingPreference,
+        DataType.ControlCodec: handleControlCodec,
+        DataType.ControlProgressive: handleControlProgressive,
+        DataType.ControlDualStream: handleControlDualStream,
+        DataType.ControlMediaTransport: handleControlMediaTransport,
+        DataType.ControlUserDefinedCaptureRect: handleControlUserDefinedCaptureRect,
+        DataType.ControlKeyframe: handleControlKeyframe,
+        DataType.ControlTileCacheResync: handleControlTileCacheResync,
+        DataType.ControlCaptureScreen: handleControlCaptureScreen,
+    }
+
+    def processInputEvent(self, event_type, value, timestamp=None):
+        if not self.control_connection:
+            return
+        self.wakeFrameStream()
+
+        if event_type == 'mousePos':
+            x, y = value
+            try:
+                pyautogui.moveTo(x, y)
+            except:
+                pass
+
+        elif event_type == 'mouseDown':
+            pyautogui.mouseDown(button=value)
+        elif event_type == 'mouseUp':
+            pyautogui.mouseUp(button=value)
+            TransparentWidget.show_screencast_keys_window('up', value)
+
+        elif event_type == 'mouseWheel':
+            if value > 0:
+                pyautogui.scroll(1)
+                TransparentWidget.show_screencast_keys_window('up', "wheel up")
+            else:
+                pyautogui.scroll(-1)
+                TransparentWidget.show_screencast_keys_window('up', "wheel down")
+
+        elif event_type == 'keyDown':
+            pyautogui.keyDown(value)
+        elif event_type == 'keyUp':
+            pyautogui.keyUp(value)
+            TransparentWidget.show_screencast_keys_window('up', value)
+        elif event_type == 'keyHotkey':
+            pyautogui.hotkey(value)
+            TransparentWidget.show_screencast_keys_window('up', "+".join(value))
+
+        if event_type in MOUSE_EVENTS:
+            print(event_type, value)
+
+    def requestKeyframes(self):
+        if self.isStreamingConnection() and self.frame_stream:
+            self.frame_stream.request_keyframe()
+            if self.background_stream:
+                self.background_stream.request_keyframe()
+
+    def startScreenStreaming(self):
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.updateFrameSubscription()
+
+    def stopScreenStreaming(self):
+        self.closeMediaSender()
+        self.pending_frame = None
+        self.pending_background_frame = None
+        self.frame_wanted = False
+        if self.frame_stream is not None:
+            self.frame_stream.unsubscribe(self)
+            self.frame_stream = None
+        if self.background_stream is not None:
+            self.background_stream.unsubscribe(self)
+            self.background_stream = None
+
+    def updateFrameSubscription(self):
+        if not self.isStreamingConnection():
+            return
 
-    def sendScreenshot(self):
+        screens_count = len(ScreenGeometryCache.get())
+        if self.capture_index+1 > screens_count:
+            self.capture_index = 0
+        if self.before_user_defined_capture_index is not None and self.before_user_defined_capture_index+1 > screens_count:
+            self.before_user_defined_capture_index = 0
 
-        if chat_dialog.remote_control_chb.isChecked() and self.control_connection:
-            data = Utils.prepare_screenshot_to_transfer(self)
-            print(f'sending screenshot... message size: {len(data)}')
-            self.socket.write(data)
-            self.socket.flush()
+        if self.capture_index == -2:
+            capture_size = self.user_defined_capture_rect.size()
+        else:
+            capture_size = Utils.capture_frame_rect(self.capture_index).size()
 
+        # качество и масштаб поток берёт через frameQuality и frameScale на каждом кадре
+        controller = self.stream_controller
+        if capture_size.width()*capture_size.height() <= Globals.SMALL_REGION_AREA:
+            controller.min_interval = Globals.SMALL_REGION_SENDING_INTERVAL
+        else:
+            controller.min_interval = Globals.SCREENSHOT_SENDING_INTERVAL
+        if controller.preference != AdaptiveStreamController.MANUAL:
+            controller.interval = max(controller.interval, controller.min_interval)
+        codecs = FrameCodecs.candidates(self.peer_codecs, self.codec_mode)
+        refine_codecs = None
+        keyframes_only = self.media_sender is not None
+        if keyframes_only:
+            # по UDP идут только целые кадры, а видеокодеку и постепенному улучшению нужны предыдущие
+            codecs = tuple(name for name in codecs if not FrameCodecs.get(name).inter_frame) \
+                                        or FrameCodecs.candidates(self.peer_codecs, 'auto')
+        elif self.progressive:
+            refine_codecs = FrameCodecs.candidates(self.peer_codecs, 'lossless')
+        key = FrameStream.make_key(self.capture_index, self.user_defined_capture_rect, codecs, refine_codecs,
+                                                        keyframes_only=keyframes_only)
+
+        self.updateBackgroundSubscription()
+
+        previous_stream = self.frame_stream
+        if previous_stream is not None and previous_stream.key == key:
+            previous_stream.updateInterval()
+            return
 
-            value = Globals.calculate_writing_framerate()
-            text = f'sending picture framerate: {value}'
-            chat_dialog.framerate_label.setText(text)
+        stale_frame = self.pending_frame
+        self.pending_frame = None
+        self.frame_stream = FrameStream.subscribe(self, key, previous_stream=previous_stream)
+        if previous_stream is not None:
+            previous_stream.unsubscribe(self)
+        if stale_frame is not None:
+            # неотправленный кадр старого потока надо перепослать уже в новом
+            self.frame_stream.drop(stale_frame)
+
+    def updateBackgroundSubscription(self):
+        # пока портал смотрит на свою область захвата, весь монитор вокруг неё
+        # идёт отдельным потоком: редко, с низким качеством и без кеша тайлов
+        key = None
+        if self.dual_stream and self.capture_index == -2:
+            capture_index = self.before_user_defined_capture_index
+            if capture_index is None:
+                capture_index = 0
+            codecs = FrameCodecs.candidates(self.peer_codecs, 'auto')
+            key = FrameStream.make_key(capture_index, None, codecs, background=True)
+
+        previous_stream = self.background_stream
+        if previous_stream is not None and previous_stream.key == key:
+            previous_stream.updateInterval()
+            return
+
+        # неотправленный кадр фона при отписке выкидывается: портал его уже не ждёт,
+        # а при смене потока он перепосылается уже в новом
+        stale_frame = self.pending_background_frame
+        self.pending_background_frame = None
+        self.background_stream = None
+        if key is not None:
+            self.background_stream = FrameStream.subscribe(self, key, previous_stream=previous_stream)
+            # подписка уже посчитала частоту, ещё не зная, что это фоновый поток
+            self.background_stream.updateInterval()
+        if previous_stream is not None:
+            previous_stream.unsubscribe(self)
+        if stale_frame is not None and self.background_stream is not None:
+            self.background_stream.drop(stale_frame)
+
+    def frameInterval(self, stream):
+        if stream is self.background_stream:
+            return max(Globals.BACKGROUND_SENDING_INTERVAL, self.stream_controller.interval)
+        return self.stream_controller.interval
+
+    def frameQuality(self, stream):
+        if stream is self.background_stream:
+            return Globals.BACKGROUND_QUALITY
+        return self.stream_controller.quality
+
+    def frameScale(self, stream):
+        return min(self.stream_controller.scale, self.viewport_scale(stream.capture_size()))
+
+    def tileCacheSize(self, stream):
+        # кеш портала следует только за основным потоком, а кадрам по UDP он не нужен
+        if stream is self.background_stream or stream.keyframes_only:
+            return 0
+        return self.peer_tile_cache_size
+
+    def viewport_scale(self, capture_size):
+        if self.viewport_size is None or capture_size.isEmpty():
+            return 1.0
+        scale = max(
+            self.viewport_size.width()/capture_size.width(),
+            self.viewport_size.height()/capture_size.height(),
+        )
+        # округляем вверх до шага, чтобы мелкие изменения зума в портале
+        # не вызывали смену размера кадра, а значит и ключевой кадр
+        step = Globals.VIEWPORT_SCALE_STEP
+        scale = math.ceil(scale/step)*step
+        if scale > 0.9:
+            return 1.0
+        return max(step, scale)
+
+    def wakeFrameStream(self):
+        if self.frame_stream is not None:
+            self.frame_stream.wake()
+        if self.background_stream is not None:
+            self.background_stream.wake()
+
+    def writeMessage(self, buffers, priority=Priority.CONTROL, compress=True):
+        # всё исходящее идёт через очереди по приоритетам, а не прямо в сокет;
+        # кадры уже сжаты своими кодеками, а остальное сжимается, если собеседник умеет
+        if compress and priority != Priority.VIDEO:
+            buffers = self.compressor.compress(buffers)
+        channel = self.channelFor(priority)
+        if channel is not None:
+            channel.writeMessage(buffers, priority)
+            return
+        self.outbound.push(buffers, priority)
+        self.flushOutbound()
+
+    def channelFor(self, priority):
+        channel = self.channels.get(Globals.PRIORITY_CHANNELS.get(priority))
+        if channel is not None and channel.ready:
+            return channel
+        return None
+
+    def openChannels(self, session):
+        for kind in Globals.PRIORITY_CHANNELS.values():
+            channel = Channel(self, kind, QTcpSocket())
+            self.channels[kind] = channel
+            channel.open(session)
+
+    def joinSession(self, channel_info):
+        # к серверу подключились ещё раз, чтобы открыть дополнительный канал
+        # уже существующего соединения, и этот сокет переходит к нему
+        address = self.socket.peerAddress()
+        for connection in clients_connections:
+            if connection is not self and connection.session == channel_info['session'] \
+                                            and connection.socket.peerAddress() == address:
+                break
+        else:
+            self.socket.abort()
+            return
+
+        if self in clients_connections:
+            clients_connections.remove(self)
+        socket = self.socket
+        for signal in (socket.readyRead, socket.bytesWritten, socket.connected, socket.disconnected, socket.errorOccurred):
+            try:
+                signal.disconnect()
+            except TypeError:
+                pass
+
+        kind = channel_info['channel']
+        Utils.socket_info_to_chat(f'{kind} channel joined', socket, channel_kind=kind)
+        channel = Channel(connection, kind, socket, message_reader=self.message_reader)
+        self.message_reader = MessageReader()
+        connection.addChannel(channel)
+        # то, что уже пришло следом за приветствием канала, разбирает основное соединение
+        channel.processReadyRead()
+
+    def addChannel(self, channel):
+        old_channel = self.channels.get(channel.kind)
+        self.channels[channel.kind] = channel
+        if old_channel is not None and old_channel is not channel:
+            old_channel.close()
+        channel.ready = True
+        if channel.kind == Globals.PRIORITY_CHANNELS[Priority.VIDEO]:
+            # замеры контроллера относились к байтам основного сокета
+            self.stream_controller.reset_measurements()
+            # кадры, ушедшие по основному соединению, могут прийти позже первых кадров канала
+            self.requestKeyframes()
+
+    def removeChannel(self, channel):
+        if self.channels.get(channel.kind) is not channel:
+            return
+        self.channels.pop(channel.kind)
+        # то, что ждало отправки в канале, потеряно, а кадры восстановит ключевой кадр
+        if channel.ready and channel.kind == Globals.PRIORITY_CHANNELS[Priority.VIDEO]:
+            self.stream_controller.reset_measurements()
+            self.requestKeyframes()
+
+    def closeChannels(self):
+        for channel in list(self.channels.values()):
+            channel.close()
+        self.channels.clear()
+
+    def closeMediaSender(self):
+        if self.media_sender is not None:
+            self.media_sender.close()
+            self.media_sender = None
+
+    def closeMediaReceiver(self):
+        if self.media_receiver is not None:
+            self.media_receiver.close()
+            self.media_receiver = None
+
+    def flushOutbound(self):
+        Utils.flush_outbound(self.socket, self.outbound)
+
+    def bytesToWrite(self):
+        # кадры ждут и в сокете, и в очередях, но не за кусками файлов
+        channel = self.channelFor(Priority.VIDEO)
+        if channel is not None:
+            return channel.bytesToWrite()
+        return self.socket.bytesToWrite() + self.outbound.pending_size(Priority.VIDEO)
+
+    def isSocketBacklogged(self):
+        return self.bytesToWrite() > Globals.SCREEN_SENDING_BACKLOG_LIMIT
+
+    def skipFrame(self):
+        self.frames_skipped += 1
+        self.frame_wanted = True
+
+    def isReadyForFrame(self):
+        # пока сокет не отправил предыдущие кадры, новый для него не захватываем,
+        # а захватим сразу как только сокет разгрузится
+        if self.isSocketBacklogged():
+            self.skipFrame()
+            return False
+        return True
+
+    def queueFrame(self, frame, stream):
+        # побеждает самый свежий кадр, а устаревший выкидывается
+        if stream is self.background_stream:
+            if self.pending_background_frame is not None:
+                stream.drop(self.pending_background_frame)
+                self.frames_dropped += 1
+            self.pending_background_frame = frame
+        else:
+            if self.pending_frame is not None:
+                stream.drop(self.pending_frame)
+                self.frames_dropped += 1
+            self.pending_frame = frame
+
+        if not self.isSocketBacklogged():
+            self.writePendingFrame()
+
+    def hasPendingFrames(self):
+        return self.pending_frame is not None or self.pending_background_frame is not None
+
+    def onBytesWritten(self, bytes_count):
+        # основной сокет; пока нет канала video, кадры идут тоже через него
+        self.flushOutbound()
+        if self.channelFor(Priority.VIDEO) is None:
+            self.onVideoBytesWritten(bytes_count)
+
+    def onVideoBytesWritten(self, bytes_count):
+        # контроллер потока считает только байты того сокета, в котором стоят кадры
+        now = time.time()
+        controller = self.stream_controller
+        controller.bytes_written(bytes_count, now)
+        if self.bytesToWrite() == 0:
+            controller.socket_drained()
+        if controller.adjust(now):
+            self.updateFrameSubscription()
+
+        if self.isSocketBacklogged():
+            return
+        if self.hasPendingFrames():
+            self.writePendingFrame()
+        elif self.frame_wanted and self.frame_stream is not None:
+            self.frame_wanted = False
+            self.frame_stream.captureFrame()
+
+    def sendHeartbeat(self, data):
+        # ждущий отправки кадр и так скажет порталу, что связь жива
+        if not self.hasPendingFrames() and not self.isSocketBacklogged():
+            self.writeMessage(data, Priority.VIDEO)
+
+    def writePendingFrame(self):
+        # кадр области захвата важнее кадра фона и уходит первым
+        frames = [f for f in (self.pending_frame, self.pending_background_frame) if f is not None]
+        if not frames:
+            return
+        main_frame = self.pending_frame
+        self.pending_frame = None
+        self.pending_background_frame = None
+
+        for frame in frames:
+            print(f'sending screenshot... message size: {frame.size}')
+            # целый кадр ScreenData основного потока уходит по UDP и ни за чем не стоит в очереди
+            if frame is main_frame and self.media_sender is not None \
+                                                and frame.is_keyframe and frame.dirty_rects is not None:
+                if self.media_sender.writeFrame(frame.buffers):
+                    continue
+            self.writeMessage(frame.buffers, Priority.VIDEO)
+            self.stream_controller.frame_queued(frame.size, self.bytesToWrite(), time.time())
+
+        value = Globals.calculate_writing_framerate()
+        text = f'sending picture framerate: {value}\nframes skipped: {self.frames_skipped}, frames dropped: {self.frames_dropped}'
+        text += f'\n{self.stream_controller.info()}'
+        chat_dialog.framerate_label.setText(text)
 
     def sendGreetingMessage(self):
         peer_address_string = self.socket.peerAddress().toString()
@@ -1864,35 +3437,107 @@ class Connection(QObject):
 
         chat_dialog.appendSystemMessage(msg)
         status = chat_dialog.retrieve_status()
-        self.socket.write(
-            Utils.prepare_data_to_write({DataType.Greeting: {'msg': self.greetingMessage, 'mac': mac_address, 'status': status}}, None)
+        self.writeMessage(
+            Utils.prepare_data_to_write({DataType.Greeting: {
+                'msg': self.greetingMessage,
+                'mac': mac_address,
+                'status': status,
+                'codecs': FrameCodecs.names(),
+                'tile_cache': Globals.tile_cache_size,
+                'features': Globals.PROTOCOL_FEATURES,
+                'session': self.session,
+                'compression': compression_names(),
+            }}, None)
         )
         self.isGreetingMessageSent = True
 
+    def sendInputEvent(self, event_type, value):
+        # мышь и клавиатура шлются часто, поэтому тем, кто умеет, они уходят короткими сообщениями
+        if INPUT_EVENTS_FEATURE in self.peer_features:
+            try:
+                data = pack_input_event(event_type, value)
+            except ValueError:
+                # не уместилось в короткое сообщение, уйдёт обычным
+                pass
+            else:
+                self.writeMessage(data)
+                return
+        if event_type in MOUSE_EVENTS:
+            data = Utils.prepare_data_to_write({DataType.MouseData: {event_type: value}}, None)
+        else:
+            data = Utils.prepare_data_to_write({DataType.KeyboardData: {event_type: value}}, None)
+        self.writeMessage(data)
+
     def sendControlFPS(self, value):
         data = Utils.prepare_data_to_write({DataType.ControlFPS: {'fps': value}}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
+
+    def sendControlViewport(self, width, height, dpr):
+        data = Utils.prepare_data_to_write({DataType.ControlViewport: {'size': [width, height], 'dpr': dpr}}, None)
+        self.writeMessage(data)
+
+    def sendControlStreamingPreference(self, preference):
+        data = Utils.prepare_data_to_write({DataType.ControlStreamingPreference: preference}, None)
+        self.writeMessage(data)
 
     def sendControlUserDefinedCaptureRect(self, rect_value):
         rect_tuple = (rect_value.left(), rect_value.top(), rect_value.width(), rect_value.height())
         data = Utils.prepare_data_to_write({DataType.ControlUserDefinedCaptureRect: {'rect': rect_tuple}}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
+
+    def sendControlCodec(self, codec_mode):
+        data = Utils.prepare_data_to_write({DataType.ControlCodec: codec_mode}, None)
+        self.writeMessage(data)
+
+    def sendControlProgressive(self, value):
+        data = Utils.prepare_data_to_write({DataType.ControlProgressive: value}, None)
+        self.writeMessage(data)
+
+    def sendControlKeyframe(self):
+        data = Utils.prepare_data_to_write({DataType.ControlKeyframe: None}, None)
+        self.writeMessage(data)
+
+    def sendControlDualStream(self, value):
+        data = Utils.prepare_data_to_write({DataType.ControlDualStream: value}, None)
+        self.writeMessage(data)
+
+    def sendControlMediaTransport(self, enabled):
+        # портал открывает свой UDP-сокет и отдаёт собеседнику его порт и номер потока
+        self.closeMediaReceiver()
+        value = None
+        if enabled:
+            self.media_receiver = MediaReceiver(self)
+            value = {
+                'port': self.media_receiver.port(),
+                'stream': self.media_receiver.stream_id(),
+                'fec': Globals.MEDIA_FEC_GROUP,
+            }
+        data = Utils.prepare_data_to_write({DataType.ControlMediaTransport: value}, None)
+        self.writeMessage(data)
+
+    def sendControlTileCacheResync(self):
+        data = Utils.prepare_data_to_write({DataType.ControlTileCacheResync: None}, None)
+        self.writeMessage(data)
 
     def sendControlCaptureScreen(self, capture_index):
         data = Utils.prepare_data_to_write({DataType.ControlCaptureScreen: capture_index}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
 
     def sendStatus(self, status):
         data = Utils.prepare_data_to_write({DataType.InfoStatus: status}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
 
     def requestControlPortal(self):
         data = Utils.prepare_data_to_write({DataType.ControlRequest: ControlRequest.GiveMeControl}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
+
+    def requestViewPortal(self):
+        data = Utils.prepare_data_to_write({DataType.ControlRequest: ControlRequest.GiveMeView}, None)
+        self.writeMessage(data)
 
     def sendControlRequestAnswer(self, value):
         data = Utils.prepare_data_to_write({DataType.ControlRequest: value}, None)
-        self.socket.write(data)
+        self.writeMessage(data)
 
 
 
@@ -2026,8 +3671,9 @@ class Client(QObject):
             self.newParticipant.emit(nick, connection)
 
     def removeConnection(self, socket):
-        if socket.peerAddress() in self.peers.keys():
-            connection = self.peers.pop(socket.peerAddress())
+        connection = self.peers.get(socket.peerAddress())
+        if connection is not None and connection.socket is socket:
+            self.peers.pop(socket.peerAddress())
             nick = connection.name()
             self.participantLeft.emit(nick)
             connection.remove_occupato_flag_if_needed()
@@ -2075,11 +3721,6 @@ class PeerManager(QObject):
         self.broadcastTimer.setInterval(Globals.BROADCASTINTERVAL);
         self.broadcastTimer.timeout.connect(self.sendBroadcastDatagram)
 
-        self.socket_buffer = bytes()
-        self.readState = self.states.readSize
-        self.SIZE_INT_SIZE = 4
-        self.data_size = 0
-
     def setServerPort(self, port):
         self.serverPort = port
 
@@ -2095,61 +3736,10 @@ class PeerManager(QObject):
                 return True
         return False
 
-    class states():
-        readSize = 0
-        readData = 1
-
-    def parse_datagram(self):
-
-        def slice_data(data, length):
-            return data[:length], data[length:]
-
-        # print('try read')
-
-        # while len(self.socket_buffer) > 0:
-
-        if True:
-
-            if self.readState == self.states.readSize:
-                if len(self.socket_buffer) >= self.SIZE_INT_SIZE:
-                    data, self.socket_buffer = slice_data(self.socket_buffer, self.SIZE_INT_SIZE)
-                    self.data_size = int.from_bytes(data, 'big')
-                    self.readState = self.states.readData
-                    # print('size read is', self.data_size)
-                else:
-                    pass
-                    # print('not enough data to read the data size')
-
-            # здесь обязательно, чтобы было if, и не было else if
-            # это нужно для того, чтобы сразу прочитать данные,
-            # если они уже есть и не ставить сообщение в очередь через emit
-            if self.readState == self.states.readData:
-                if self.data_size < 0:
-                    raise Exception('Fuck!')
-                if len(self.socket_buffer) >= self.data_size:
-                    data, self.socket_buffer = slice_data(self.socket_buffer, self.data_size)
-                    try:
-                        parsed_data = cbor2.loads(data)
-                        # print('data read')
-                        self.data_size = 0
-                        self.readState = self.states.readSize
-                        return parsed_data
-                    except Exception as e:
-                        print(e, 'aborting...')
-                        socket.abort()
-
-                    print(parsed_data)
-
-                else:
-                    pass
-                    # print('not enough data to read cbor data')
-
-        return None
-
     def sendBroadcastDatagram(self):
 
         data_obj = [self.username, self.serverPort]
-        datagram = Utils.prepare_data_to_UDP(data_obj)
+        datagram = encode_datagram(data_obj)
 
         validBroadcastAddresses = True
 
@@ -2170,11 +3760,9 @@ class PeerManager(QObject):
             datagram.resize(self.broadcastSocket.pendingDatagramSize())
             datagram, senderIp, senderPort = self.broadcastSocket.readDatagram(datagram.size() )
 
-            self.socket_buffer = datagram
-            # print('socket_buffer', self.socket_buffer)
-            parsed_data = self.parse_datagram()
+            parsed_data = decode_datagram(datagram)
 
-            if parsed_data is None:
+            if not isinstance(parsed_data, list) or len(parsed_data) < 2:
                 continue
 
             senderServerPort = parsed_data[1]
@@ -2190,6 +3778,7 @@ class PeerManager(QObject):
                 socket.waitForConnected()
 
                 connection = Connection(self, client_socket=socket)
+                connection.opens_channels = True
                 Utils.socket_info_to_chat('new peer added', socket)
 
 
@@ -2226,6 +3815,28 @@ class ChatDialog(QDialog):
     def go_to_app_page(self):
         webbrowser.open("https://github.com/sergkrumas/lan_desktop")
 
+    def show_codecs_stats(self):
+        self.appendSystemMessage('Frame codecs statistics:\n' + FrameCodecs.info())
+        lines = []
+        for stream in Globals.frame_streams.values():
+            lines.append(f'stream {stream.capture_index}: {stream.encoder.tile_cache.info()}')
+        for connection in self.client.get_peers_connections():
+            lines.append(f'{connection.socket.peerAddress().toString()}: {connection.tile_cache.info()}')
+        if lines:
+            self.appendSystemMessage('Tile cache statistics:\n' + '\n'.join(lines))
+
+    def show_message_stats(self):
+        for connection in self.client.get_peers_connections():
+            address = connection.socket.peerAddress().toString()
+            self.appendSystemMessage(f'Received from {address}:\n' + connection.message_stats.info(DataType.name))
+            self.appendSystemMessage(f'Sent to {address}:\n' + connection.outbound.info() + '\n' + connection.compressor.info())
+            for kind, channel in connection.channels.items():
+                self.appendSystemMessage(f'Sent to {address} by {kind} channel:\n' + channel.outbound.info())
+            if connection.media_sender is not None:
+                self.appendSystemMessage(f'Sent to {address} by UDP:\n' + connection.media_sender.info())
+            if connection.media_receiver is not None:
+                self.appendSystemMessage(f'Received from {address} by UDP:\n' + connection.media_receiver.info())
+
     def __init__(self, parent=None, *args, **kwargs):
         super().__init__()
 
@@ -2253,6 +3864,14 @@ class ChatDialog(QDialog):
         updateAppAction.triggered.connect(self.update_app)
         appMenu.addAction(updateAppAction)
 
+        codecsStatsAction = QAction('Show frame codecs statistics', self)
+        codecsStatsAction.triggered.connect(self.show_codecs_stats)
+        appMenu.addAction(codecsStatsAction)
+
+        messageStatsAction = QAction('Show message statistics', self)
+        messageStatsAction.triggered.connect(self.show_message_stats)
+        appMenu.addAction(messageStatsAction)
+
         if is_app_in_startup is not None:
             winautorun_toggle = QAction('Run on Windows start', self)
             winautorun_toggle.setCheckable(True)
@@ -2334,9 +3953,13 @@ class ChatDialog(QDialog):
         hor_layout.addWidget(self.testButton)
 
         self.openPortalBtn = QPushButton('Open Portal')
-        self.openPortalBtn.clicked.connect(self.portalButtonHandler)
+        self.openPortalBtn.clicked.connect(partial(self.portalButtonHandler, False))
         hor_layout.addWidget(self.openPortalBtn)
 
+        self.viewPortalBtn = QPushButton('View Only')
+        self.viewPortalBtn.clicked.connect(partial(self.portalButtonHandler, True))
+        hor_layout.addWidget(self.viewPortalBtn)
+
         self.portal_widget = Portal(self)
         self.portal_widget.resize(1200, 1000)
 
@@ -2375,6 +3998,7 @@ class ChatDialog(QDialog):
         for w in [self.textEdit,
                     self.peersList,
                     self.openPortalBtn,
+                    self.viewPortalBtn,
                     self.wakeOnLanButton,
                     self.testButton,
                     self.remote_control_chb,
@@ -2427,18 +4051,20 @@ class ChatDialog(QDialog):
         self.splt.setSizes([300, 400, 300])
         # self.disconnect_data = None
         self.openPortalBtn.setText("Close Portal")
+        self.viewPortalBtn.setEnabled(False)
         self.update()
 
     def portal_off(self):
         sizes = self.splt.sizes()
         self.splt.setSizes([sizes[0], 0, sizes[2]])
         self.openPortalBtn.setText("Open Portal")
+        self.viewPortalBtn.setEnabled(True)
         self.framerate_label.setText('')
         self.disconnect_data = None
         self.portal_widget.close_portal()
         self.update()
 
-    def portalButtonHandler(self):
+    def portalButtonHandler(self, view_only):
 
         if self.disconnect_data is not None:
             connection = self.disconnect_data
@@ -2467,7 +4093,11 @@ class ChatDialog(QDialog):
             if connection is None:
                 self.appendSystemMessage('No any active connection found for the selected peer!')
             else:
-                connection.requestControlPortal()
+                self.portal_widget.view_only = view_only
+                if view_only:
+                    connection.requestViewPortal()
+                else:
+                    connection.requestControlPortal()
                 self.disconnect_data = connection
 
     def make_broadcast_address(self, ip_address):
@@ -2705,6 +4335,35 @@ class SettingsUtil:
     def get_settings():
         return Globals.settings
 
+    @staticmethod
+    def init_frame_codecs():
+        # через frame_codecs=jpg,png8 в файле настроек можно ограничить набор кодеков,
+        # jpg остаётся всегда, потому что его понимают все версии
+        value = SettingsUtil.get_settings().value('frame_codecs', '')
+        if isinstance(value, str):
+            value = [v.strip() for v in value.split(',') if v.strip()]
+        FrameCodecs.init(allowed=value)
+
+    @staticmethod
+    def init_tile_cache():
+        # tile_cache_mb=0 в файле настроек отключает кеш тайлов
+        try:
+            megabytes = float(SettingsUtil.get_settings().value('tile_cache_mb', Globals.TILE_CACHE_MB))
+        except (TypeError, ValueError):
+            megabytes = Globals.TILE_CACHE_MB
+        tile_bytes = Globals.SCREEN_TILE_SIZE*Globals.SCREEN_TILE_SIZE*4
+        Globals.tile_cache_size = max(0, int(megabytes*1024*1024/tile_bytes))
+
+    @staticmethod
+    def init_capture_backend():
+        # capture_backend=qt или mss в файле настроек отключает замер и выбор самого быстрого
+        name = SettingsUtil.get_settings().value('capture_backend', 'auto')
+        backend, results = choose_backend(Utils.capture_frame_rect(0), ScreenGeometryCache.get(), name=name)
+        Globals.capture_backend = backend
+        for backend_name, duration in results.items():
+            print(f'capture backend {backend_name}: {duration*1000:.1f} ms per frame')
+        print(f'capture backend: {backend.name}')
+
     @staticmethod
     def bool_to_str(x):
         return str(int(x))
@@ -2778,8 +4437,12 @@ def main():
     sys.excepthook = excepthook
 
     app = QApplication(args)
+    ScreenGeometryCache.watch(app)
 
     SettingsUtil.init_settings(app)
+    SettingsUtil.init_frame_codecs()
+    SettingsUtil.init_tile_cache()
+    SettingsUtil.init_capture_backend()
 
     # print(f'main thread: {QThread.currentThreadId()}')
 
@@ -2805,6 +4468,11 @@ def main():
     app.exec()
 
     # после закрытия апликухи
+    for frame_stream in list(Globals.frame_streams.values()):
+        frame_stream.stop()
+    for screen_encoder in Globals.screen_encoders[:]:
+        screen_encoder.stop()
+
     stray_icon = app.property("stray_icon")
     if stray_icon:
         stray_icon.hide()
@@ -0,0 +1,1036 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+
+import struct
+import zlib
+from collections import deque, defaultdict, namedtuple
+
+import cbor2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Сообщение в TCP-потоке: заголовок из трёх беззнаковых int (длина всего содержимого,
+# длина cbor-части и длина бинарной части), за ним cbor-часть и бинарная часть.
+# Длина содержимого меньше 2**31, поэтому первый байт обычного сообщения всегда меньше 0x80.
+# Если старший бит первого байта выставлен, то это короткое сообщение: в младших битах
+# длина, а за ним событие мыши или клавиатуры в упакованном виде, см. pack_input_event.
+# Короткие сообщения шлются только тем, кто объявил в приветствии фичу INPUT_EVENTS_FEATURE.
+# Если выставлен следующий бит (0x40), то это кусок большого сообщения, см. OutboundScheduler:
+# в остальных битах первого int длина куска, затем номер сообщения и признак последнего куска.
+# Если выставлен третий бит (0x20), то это сжатое сообщение, см. MessageCompressor:
+# в остальных битах первого int длина сжатых данных, затем номер кодека сжатия,
+# а сжато обычное сообщение целиком, вместе с заголовком.
+# Поэтому обычное сообщение не может быть больше 2**29 байт
+#
+# Кадры ScreenData могут идти и по UDP, см. MediaPacketizer: сообщение целиком режется
+# на датаграммы, у каждой заголовок MEDIA_HEADER, а к каждой группе кусков может добавляться
+# XOR всех кусков группы, по которому восстанавливается один потерянный кусок.
+# Недособранный кадр выкидывается, как только собран кадр новее
+#
+# Модуль не знает ни про Qt, ни про сокеты: на вход байты, на выходе сообщения и буферы для записи,
+# поэтому его можно гонять в protocol_benchmark.py и в других инструментах без дисплея
+
+
+HEADER = struct.Struct('>III')
+
+COMPACT_FLAG = 0x80
+COMPACT_MAX_SIZE = 0x7f
+
+INPUT_EVENTS_FEATURE = 'input-events'
+FRAGMENTS_FEATURE = 'fragments'
+CHANNELS_FEATURE = 'channels'
+MEDIA_FEATURE = 'udp-media'
+
+FRAGMENT_FLAG = 0x40
+FRAGMENT_HEADER = struct.Struct('>IIB')
+FRAGMENT_MAX_SIZE = 0xffffff
+
+COMPRESSED_FLAG = 0x20
+COMPRESSED_HEADER = struct.Struct('>IB')
+COMPRESSED_MAX_SIZE = 0x1fffffff
+
+MESSAGE_MAX_SIZE = 0x1fffffff
+
+# бинарная часть от этого размера принимается сразу в свой буфер или в sink, см. MessageReader
+STREAM_MIN_SIZE = 64*1024
+SERIAL_MAX_SIZE = 1024*1024
+PENDING_FRAGMENTS_MAX_COUNT = 64
+
+# коды событий совпадают с ключами, которые ходят внутри cbor-сообщений MouseData и KeyboardData
+MOUSE_EVENTS = ('mousePos', 'mouseDown', 'mouseUp', 'mouseWheel')
+KEYBOARD_EVENTS = ('keyDown', 'keyUp', 'keyHotkey')
+INPUT_EVENTS = MOUSE_EVENTS + KEYBOARD_EVENTS
+INPUT_OPCODES = {event_type: opcode for opcode, event_type in enumerate(INPUT_EVENTS, start=1)}
+TIMESTAMP_FLAG = 0x80
+MOUSE_BUTTONS = ('left', 'right', 'middle')
+WHEEL_STEP = 240
+
+POSITION = struct.Struct('>hh')
+WHEEL = struct.Struct('>h')
+TIMESTAMP = struct.Struct('>I')
+
+# датаграмма обнаружения собеседников: длина и cbor-часть
+DATAGRAM_HEADER = struct.Struct('>I')
+
+# датаграмма кадра: номер потока, номер кадра, вид датаграммы, размер группы FEC,
+# номер куска (у чётности - номер группы), число кусков, размер куска и размер всего кадра
+MEDIA_HEADER = struct.Struct('>IIBBHHHI')
+MEDIA_DATA = 0
+MEDIA_PARITY = 1
+# вместе с заголовками IP и UDP укладывается в MTU 1500 и не фрагментируется
+MEDIA_FRAGMENT_SIZE = 1200
+MEDIA_WINDOW = 4
+
+# то, что отдаёт MessageReader.events
+Message = namedtuple('Message', 'data_type value binary_data')
+InputEvent = namedtuple('InputEvent', 'event_type value timestamp')
+# вместо бинарной части, которая уже целиком ушла в sink
+StreamedPayload = namedtuple('StreamedPayload', 'sink size')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def pack_input_event(event_type, value, timestamp=None):
+    """
+        возвращает короткое сообщение целиком, вместе с байтом длины;
+        timestamp - необязательное время события в миллисекундах, хранится по модулю 2**32;
+        ValueError значит, что событие не укладывается в короткое сообщение
+        и его надо отправить обычным cbor-сообщением
+    """
+    opcode = INPUT_OPCODES[event_type]
+    try:
+        if event_type == 'mousePos':
+            body = POSITION.pack(*value)
+        elif event_type in ('mouseDown', 'mouseUp'):
+            body = bytes((MOUSE_BUTTONS.index(value),))
+        elif event_type == 'mouseWheel':
+            body = WHEEL.pack(round(value*WHEEL_STEP))
+        elif event_type == 'keyHotkey':
+            body = '\0'.join(value).encode('utf8')
+        else:
+            body = value.encode('utf8')
+    except struct.error as e:
+        # координаты за пределами ±32767, например на очень большом виртуальном рабочем столе
+        raise ValueError(f'input event {event_type} {value!r} does not fit: {e}')
+    if timestamp is not None:
+        opcode |= TIMESTAMP_FLAG
+        body = TIMESTAMP.pack(int(timestamp) & 0xffffffff) + body
+    size = 1 + len(body)
+    if size > COMPACT_MAX_SIZE:
+        raise ValueError(f'input event {event_type} is too long: {size} bytes')
+    return bytes((COMPACT_FLAG | size, opcode)) + body
+
+
+def unpack_input_event(payload):
+    """
+        возвращает (event_type, value, timestamp) из содержимого короткого сообщения
+    """
+    try:
+        opcode = payload[0]
+        offset = 1
+        timestamp = None
+        if opcode & TIMESTAMP_FLAG:
+            timestamp = TIMESTAMP.unpack_from(payload, offset)[0]
+            offset += TIMESTAMP.size
+            opcode &= ~TIMESTAMP_FLAG
+        if not 1 <= opcode <= len(INPUT_EVENTS):
+            raise ProtocolError(f'unknown input event opcode {opcode}')
+        event_type = INPUT_EVENTS[opcode-1]
+        if event_type == 'mousePos':
+            value = list(POSITION.unpack_from(payload, offset))
+        elif event_type in ('mouseDown', 'mouseUp'):
+            value = MOUSE_BUTTONS[payload[offset]]
+        elif event_type == 'mouseWheel':
+            value = WHEEL.unpack_from(payload, offset)[0]/WHEEL_STEP
+        elif event_type == 'keyHotkey':
+            value = bytes(payload[offset:]).decode('utf8').split('\0')
+        else:
+            value = bytes(payload[offset:]).decode('utf8')
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f'broken input event: {e}')
+    return event_type, value, timestamp
+
+
+def frame_message(serial_binary, payload=()):
+    """
+        возвращает список буферов, которые надо записать в сокет один за другим:
+        заголовок вместе с cbor-частью и куски бинарной части как есть, без склейки;
+        payload - один буфер (bytes, QByteArray) или список буферов
+    """
+    if not isinstance(payload, (list, tuple)):
+        payload = [payload]
+    payload = [buffer for buffer in payload if len(buffer)]
+    payload_size = sum(len(buffer) for buffer in payload)
+    serial_size = len(serial_binary)
+    if serial_size + payload_size > MESSAGE_MAX_SIZE:
+        raise ValueError(f'message is too long: {serial_size + payload_size} bytes')
+    head = HEADER.pack(serial_size + payload_size, serial_size, payload_size) + serial_binary
+    return [head, *payload]
+
+
+def message_size(buffers):
+    return sum(len(buffer) for buffer in buffers)
+
+
+def encode_message(serial_data, payload=()):
+    """
+        возвращает список буферов сообщения, см. frame_message;
+        serial_data - словарь из одного элемента {DataType: значение} или None
+    """
+    serial_binary = b'' if serial_data is None else cbor2.dumps(serial_data)
+    return frame_message(serial_binary, payload)
+
+
+def decode_message(serial_data):
+    """
+        возвращает (data_type, value) из cbor-части сообщения
+    """
+    try:
+        parsed_data = cbor2.loads(serial_data)
+    except Exception as e:
+        raise ProtocolError(f'broken cbor data: {e}')
+    if not isinstance(parsed_data, dict) or len(parsed_data) != 1:
+        raise ProtocolError(f'there is no header section within {parsed_data!r}')
+    return next(iter(parsed_data.items()))
+
+
+class Optional():
+
+    # Ключ словаря-схемы, которого в значении может и не быть
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+def check_value(value, schema, path='value'):
+    """
+        проверяет значение из сообщения собеседника и даёт ProtocolError с путём до кривого места;
+        schema - это
+            None: только None;
+            тип: isinstance, причём bool не считается ни int, ни float, а object - что угодно;
+            range: целое из этого диапазона;
+            frozenset: одно из перечисленных значений;
+            tuple: годится хотя бы одна из схем;
+            список из одной схемы: список любой длины из таких элементов,
+            а из нескольких схем - список ровно такой длины, поэлементно;
+            dict: словарь с такими ключами, Optional(schema) - необязательный ключ, лишние ключи не мешают;
+            функция: возвращает True для годного значения
+    """
+    if schema is None:
+        is_valid = value is None
+    elif isinstance(schema, tuple):
+        for alternative in schema:
+            try:
+                check_value(value, alternative, path)
+                return
+            except ProtocolError:
+                pass
+        is_valid = False
+    elif isinstance(schema, type):
+        is_valid = isinstance(value, schema) and not (isinstance(value, bool) and schema in (int, float))
+    elif isinstance(schema, range):
+        is_valid = isinstance(value, int) and not isinstance(value, bool) and value in schema
+    elif isinstance(schema, frozenset):
+        try:
+            is_valid = value in schema
+        except TypeError:
+            # список или словарь не бывает среди перечисленных значений
+            is_valid = False
+    elif isinstance(schema, list):
+        if not isinstance(value, list) or len(schema) > 1 and len(value) != len(schema):
+            raise ProtocolError(f'{path} is {value!r:.100} instead of a list of {len(schema)} items')
+        items_schemas = schema if len(schema) > 1 else schema*len(value)
+        for index, (item, item_schema) in enumerate(zip(value, items_schemas)):
+            check_value(item, item_schema, f'{path}[{index}]')
+        return
+    elif isinstance(schema, dict):
+        if not isinstance(value, dict):
+            raise ProtocolError(f'{path} is {value!r:.100} instead of a dict')
+        for key, item_schema in schema.items():
+            if isinstance(item_schema, Optional):
+                if key not in value:
+                    continue
+                item_schema = item_schema.schema
+            elif key not in value:
+                raise ProtocolError(f'{path} has no {key!r}')
+            check_value(value[key], item_schema, f'{path}[{key!r}]')
+        return
+    else:
+        is_valid = schema(value)
+    if not is_valid:
+        raise ProtocolError(f'{path} has a bad value {value!r:.100}')
+
+
+def encode_datagram(data):
+    serial_binary = cbor2.dumps(data)
+    return DATAGRAM_HEADER.pack(len(serial_binary)) + serial_binary
+
+
+def decode_datagram(datagram):
+    """
+        возвращает содержимое датаграммы или None, если это не наша датаграмма
+    """
+    if len(datagram) < DATAGRAM_HEADER.size:
+        return None
+    size = DATAGRAM_HEADER.unpack_from(datagram)[0]
+    if len(datagram) < DATAGRAM_HEADER.size + size:
+        return None
+    try:
+        return cbor2.loads(bytes(datagram[DATAGRAM_HEADER.size:DATAGRAM_HEADER.size+size]))
+    except Exception:
+        return None
+
+
+# Кодеки сжатия сообщений: номер кодека уходит в заголовке сжатого сообщения,
+# а имена доступных кодеков - в приветствии. zlib есть всегда, zstd и lz4 - если установлены
+Compression = namedtuple('Compression', 'name id compress decompress')
+
+COMPRESSIONS = {}
+
+
+def register_compression(name, codec_id, compress, decompress):
+    COMPRESSIONS[name] = Compression(name, codec_id, compress, decompress)
+
+
+# decompress(data, max_size) распаковывает не больше max_size+1 байт,
+# чтобы испорченные или подложные данные не раздулись в памяти
+
+def zlib_decompress(data, max_size):
+    return zlib.decompressobj().decompress(data, max_size+1)
+
+
+def zstd_decompress(data, max_size):
+    with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+        return reader.read(max_size+1)
+
+
+def lz4_decompress(data, max_size):
+    return lz4.frame.LZ4FrameDecompressor().decompress(data, max_length=max_size+1)
+
+
+register_compression('zlib', 1, lambda data: zlib.compress(data, 1), zlib_decompress)
+if zstandard is not None:
+    register_compression('zstd', 2, zstandard.ZstdCompressor(level=3).compress, zstd_decompress)
+if lz4 is not None:
+    register_compression('lz4', 3, lz4.frame.compress, lz4_decompress)
+
+# от лучшего к худшему
+COMPRESSION_PREFERENCE = ('zstd', 'lz4', 'zlib')
+
+
+def compression_names():
+    return [name for name in COMPRESSION_PREFERENCE if name in COMPRESSIONS]
+
+
+def choose_compression(peer_names):
+    """
+        возвращает лучший кодек сжатия из тех, что есть у обеих сторон, или None
+    """
+    for name in compression_names():
+        if name in peer_names:
+            return COMPRESSIONS[name]
+    return None
+
+
+def decompress_message(data, codec_id, max_size=MESSAGE_MAX_SIZE):
+    for compression in COMPRESSIONS.values():
+        if compression.id == codec_id:
+            try:
+                data = compression.decompress(data, max_size)
+            except Exception as e:
+                raise ProtocolError(f'broken {compression.name} data: {e}')
+            if len(data) > max_size:
+                raise ProtocolError(f'compressed message is over the limit {max_size}')
+            return data
+    raise ProtocolError(f'unknown compression {codec_id}')
+
+
+class MessageCompressor():
+
+    # Сжимает исходящие сообщения выбранным с собеседником кодеком.
+    # Мелкие сообщения не сжимаются вовсе, а у больших сначала сжимается кусок из середины,
+    # и если он почти не сжался (архив, картинка, видео), то всё сообщение уходит как есть.
+    # Сообщение, которое сжалось хуже чем до max_ratio, тоже уходит несжатым
+
+    def __init__(self, min_size=1024, sample_size=4096, max_ratio=0.9):
+        self.compression = None
+        self.min_size = min_size
+        self.sample_size = sample_size
+        self.max_ratio = max_ratio
+
+        self.compressed_count = 0
+        self.skipped_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def is_compressible(self, data):
+        if len(data) < self.sample_size*4:
+            return True
+        start = (len(data) - self.sample_size)//2
+        sample = data[start:start+self.sample_size]
+        return len(zlib.compress(sample, 1)) <= len(sample)*self.max_ratio
+
+    def compress(self, buffers):
+        """
+            возвращает буферы сжатого сообщения или те же buffers, если сжимать не стоит
+        """
+        if isinstance(buffers, (bytes, bytearray)):
+            size = len(buffers)
+        else:
+            size = message_size(buffers)
+        if self.compression is None or size < self.min_size:
+            return buffers
+        if isinstance(buffers, (bytes, bytearray)):
+            data = bytes(buffers)
+        else:
+            data = b''.join(bytes(buffer) for buffer in buffers)
+        if not self.is_compressible(data):
+            self.skipped_count += 1
+            return buffers
+        body = self.compression.compress(data)
+        if len(body) > size*self.max_ratio or len(body) > COMPRESSED_MAX_SIZE:
+            self.skipped_count += 1
+            return buffers
+        self.compressed_count += 1
+        self.input_bytes += size
+        self.output_bytes += len(body)
+        head = COMPRESSED_HEADER.pack((COMPRESSED_FLAG << 24) | len(body), self.compression.id)
+        return [head, body]
+
+    def info(self):
+        name = self.compression.name if self.compression else 'off'
+        ratio = self.output_bytes/self.input_bytes if self.input_bytes else 1.0
+        return f'compression {name}: {self.compressed_count} messages compressed to {ratio:.0%}, ' + \
+                    f'{self.skipped_count} incompressible sent as is'
+
+
+class MessageReader():
+
+    # Приёмный буфер соединения. Прочитанные из сокета байты дописываются в конец bytearray,
+    # а разобранные сообщения не вырезаются из его начала, а только сдвигают курсор.
+    # Хвост буфера переносится в начало один раз перед следующим дописыванием,
+    # поэтому каждый байт копируется не больше двух раз, каким бы большим ни было сообщение.
+    #
+    # Память на приёме ограничена: заголовок с длиной больше max_message_size или cbor-частью
+    # больше max_serial_size даёт ProtocolError сразу, не дожидаясь тела. У бинарной части
+    # от stream_min_size байт тип сообщения известен раньше неё, и её длина сверяется
+    # с size_limits по типу (иначе default_size_limit). Затем open_sink(data_type, value, size)
+    # может вернуть объект с методом write, и тогда бинарная часть уходит в него по мере прихода,
+    # а вместо неё отдаётся StreamedPayload; иначе она принимается в заранее выделенный bytearray
+
+    def __init__(self, max_message_size=MESSAGE_MAX_SIZE, max_serial_size=SERIAL_MAX_SIZE,
+                        size_limits=None, default_size_limit=MESSAGE_MAX_SIZE, open_sink=None,
+                        stream_min_size=STREAM_MIN_SIZE):
+        self.buffer = bytearray()
+        self.cursor = 0
+
+        self.max_message_size = max_message_size
+        self.max_serial_size = max_serial_size
+        self.size_limits = size_limits or {}
+        self.default_size_limit = default_size_limit
+        self.open_sink = open_sink
+        self.stream_min_size = stream_min_size
+
+        # заголовок сообщения, тело которого ещё не пришло целиком
+        self.header = None
+        # у большого сообщения: его cbor-часть и то, куда принимается бинарная часть
+        self.serial_data = None
+        self.payload = None
+        self.payload_received = 0
+
+        # недособранные из кусков сообщения по их номерам
+        self.fragments = {}
+        self.is_nested = False
+
+        self.messages_count = 0
+        self.bytes_count = 0
+
+    def feed(self, data):
+        if self.cursor:
+            del self.buffer[:self.cursor]
+            self.cursor = 0
+        self.buffer += data
+
+    def pending_size(self):
+        return len(self.buffer) - self.cursor
+
+    def next_message(self):
+        """
+            возвращает (serial_data, binary_data) очередного полностью пришедшего сообщения
+            или None, если его ещё нет;
+            обе части не ссылаются на приёмный буфер, поэтому их можно хранить сколько угодно;
+            binary_data - это bytes, bytearray у больших сообщений или StreamedPayload,
+            если она ушла в sink; у короткого сообщения serial_data равно None,
+            а binary_data - это упакованное событие
+        """
+        while self.header is None and self.pending_size():
+            first_byte = self.buffer[self.cursor]
+            if first_byte & COMPACT_FLAG:
+                return self.next_compact_message()
+            if first_byte & COMPRESSED_FLAG and not first_byte & FRAGMENT_FLAG:
+                return self.next_compressed_message()
+            if not first_byte & FRAGMENT_FLAG:
+                break
+            is_taken, message = self.next_fragment()
+            if not is_taken or message is not None:
+                return message
+        if self.header is None:
+            if self.pending_size() < HEADER.size:
+                return None
+            header = HEADER.unpack_from(self.buffer, self.cursor)
+            self.check_header(*header)
+            self.header = header
+            self.cursor += HEADER.size
+        content_size, serial_size, binary_size = self.header
+        if binary_size >= self.stream_min_size:
+            return self.next_large_message()
+        if self.pending_size() < content_size:
+            return None
+        with memoryview(self.buffer) as view:
+            start = self.cursor
+            serial_data = bytes(view[start:start+serial_size])
+            binary_data = bytes(view[start+serial_size:start+content_size])
+        self.cursor += content_size
+        self.header = None
+        self.messages_count += 1
+        self.bytes_count += HEADER.size + content_size
+        return serial_data, binary_data
+
+    def check_header(self, content_size, serial_size, binary_size):
+        if content_size != serial_size + binary_size:
+            raise ProtocolError(f'broken message header {(content_size, serial_size, binary_size)}')
+        if content_size > self.max_message_size:
+            raise ProtocolError(f'message of {content_size} bytes is over the limit {self.max_message_size}')
+        if serial_size > self.max_serial_size:
+            raise ProtocolError(f'cbor data of {serial_size} bytes is over the limit {self.max_serial_size}')
+
+    def check_binary_size(self, data_type, binary_size):
+        limit = self.size_limits.get(data_type, self.default_size_limit)
+        if binary_size > limit:
+            raise ProtocolError(f'message {data_type} with {binary_size} bytes of binary data is over the limit {limit}')
+
+    def next_large_message(self):
+        # тип сообщения известен раньше, чем придёт бинарная часть,
+        # поэтому её размер проверяется сразу, а сама она не копится в общем буфере
+        content_size, serial_size, binary_size = self.header
+        if self.serial_data is None:
+            if self.pending_size() < serial_size:
+                return None
+            serial_data = bytes(self.buffer[self.cursor:self.cursor+serial_size])
+            data_type, value = decode_message(serial_data)
+            self.check_binary_size(data_type, binary_size)
+            self.cursor += serial_size
+            self.serial_data = serial_data
+            sink = None
+            if self.open_sink is not None:
+                sink = self.open_sink(data_type, value, binary_size)
+            self.payload = sink if sink is not None else bytearray(binary_size)
+            self.payload_received = 0
+
+        size = min(self.pending_size(), binary_size - self.payload_received)
+        if size:
+            with memoryview(self.buffer) as view, view[self.cursor:self.cursor+size] as data:
+                if isinstance(self.payload, bytearray):
+                    self.payload[self.payload_received:self.payload_received+size] = data
+                else:
+                    self.payload.write(data)
+            self.cursor += size
+            self.payload_received += size
+        if self.payload_received < binary_size:
+            return None
+
+        serial_data = self.serial_data
+        binary_data = self.payload
+        if not isinstance(binary_data, bytearray):
+            binary_data = StreamedPayload(binary_data, binary_size)
+        self.header = None
+        self.serial_data = None
+        self.payload = None
+        self.messages_count += 1
+        self.bytes_count += HEADER.size + content_size
+        return serial_data, binary_data
+
+    def next_fragment(self):
+        """
+            возвращает (is_taken, message): is_taken - пришёл ли кусок целиком,
+            message - собранное сообщение, если этот кусок был последним
+        """
+        if self.pending_size() < FRAGMENT_HEADER.size:
+            return False, None
+        word, message_id, is_last = FRAGMENT_HEADER.unpack_from(self.buffer, self.cursor)
+        size = word & FRAGMENT_MAX_SIZE
+        if self.pending_size() < FRAGMENT_HEADER.size + size:
+            return False, None
+        if self.is_nested:
+            raise ProtocolError('fragment inside a fragmented message')
+
+        # каждое сообщение собирается своим MessageReader с теми же ограничениями,
+        # поэтому и большое сообщение из кусков сразу уходит в sink или в свой bytearray
+        reader = self.fragments.get(message_id)
+        if reader is None:
+            if len(self.fragments) >= PENDING_FRAGMENTS_MAX_COUNT:
+                raise ProtocolError('too many fragmented messages at once')
+            reader = self.fragments[message_id] = self.nested_reader()
+        start = self.cursor + FRAGMENT_HEADER.size
+        with memoryview(self.buffer) as view:
+            reader.feed(view[start:start+size])
+        self.cursor = start + size
+        self.bytes_count += FRAGMENT_HEADER.size + size
+
+        message = reader.next_message()
+        if not is_last:
+            if message is not None:
+                raise ProtocolError(f'fragmented message {message_id} ended before its last fragment')
+            return True, None
+        self.fragments.pop(message_id)
+        if message is None or reader.pending_size():
+            raise ProtocolError(f'broken fragmented message {message_id}')
+        self.messages_count += 1
+        return True, message
+
+    def nested_reader(self):
+        reader = MessageReader(max_message_size=self.max_message_size, max_serial_size=self.max_serial_size,
+                                size_limits=self.size_limits, default_size_limit=self.default_size_limit,
+                                open_sink=self.open_sink, stream_min_size=self.stream_min_size)
+        reader.is_nested = True
+        return reader
+
+    def next_compressed_message(self):
+        if self.pending_size() < COMPRESSED_HEADER.size:
+            return None
+        word, codec_id = COMPRESSED_HEADER.unpack_from(self.buffer, self.cursor)
+        size = word & COMPRESSED_MAX_SIZE
+        if size > self.max_message_size:
+            raise ProtocolError(f'compressed message of {size} bytes is over the limit {self.max_message_size}')
+        if self.pending_size() < COMPRESSED_HEADER.size + size:
+            return None
+        start = self.cursor + COMPRESSED_HEADER.size
+        with memoryview(self.buffer) as view:
+            data = bytes(view[start:start+size])
+        self.cursor = start + size
+        self.messages_count += 1
+        self.bytes_count += COMPRESSED_HEADER.size + size
+        return self.unpack_message(data, codec_id)
+
+    def unpack_message(self, data, codec_id):
+        """
+            разбирает сжатое сообщение, пришедшее целиком в data
+        """
+        data = decompress_message(data, codec_id, self.max_message_size + HEADER.size)
+
+        if len(data) < HEADER.size:
+            raise ProtocolError('broken message')
+        content_size, serial_size, binary_size = HEADER.unpack_from(data)
+        self.check_header(content_size, serial_size, binary_size)
+        if len(data) != HEADER.size + content_size:
+            raise ProtocolError(f'broken message header {(content_size, serial_size, binary_size)}')
+        with memoryview(data) as view:
+            serial_data = bytes(view[HEADER.size:HEADER.size+serial_size])
+            binary_data = bytes(view[HEADER.size+serial_size:])
+        if binary_size >= self.stream_min_size:
+            self.check_binary_size(decode_message(serial_data)[0], binary_size)
+        return serial_data, binary_data
+
+    def next_compact_message(self):
+        size = self.buffer[self.cursor] & COMPACT_MAX_SIZE
+        if self.pending_size() < 1 + size:
+            return None
+        start = self.cursor + 1
+        payload = bytes(self.buffer[start:start+size])
+        self.cursor = start + size
+        self.messages_count += 1
+        self.bytes_count += 1 + size
+        return None, payload
+
+    def messages(self):
+        # все сообщения, что уже пришли целиком
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def events(self):
+        """
+            то же, что messages, но уже разобранное: Message для обычных сообщений
+            и InputEvent для коротких; испорченные данные дают ProtocolError
+        """
+        for serial_data, binary_data in self.messages():
+            if serial_data is None:
+                yield InputEvent(*unpack_input_event(binary_data))
+            elif not serial_data:
+                yield Message(None, None, binary_data)
+            else:
+                yield Message(*decode_message(serial_data), binary_data)
+
+
+class Priority:
+    CONTROL = 0 # мышь, клавиатура, управляющие сообщения
+    CHAT = 1
+    VIDEO = 2
+    BULK = 3 # куски файлов
+
+    COUNT = 4
+
+
+class OutboundMessage():
+
+    def __init__(self, buffers):
+        self.buffers = list(buffers)
+        self.size = message_size(self.buffers)
+        # сколько байт уже отдано кусками
+        self.offset = 0
+        self.buffer_index = 0
+        self.buffer_offset = 0
+        self.fragment_id = None
+
+    def take(self, size):
+        # следующие size байт сообщения одним bytes; копируется только этот кусок
+        parts = []
+        while size:
+            buffer = self.buffers[self.buffer_index]
+            with memoryview(buffer) as view:
+                part = bytes(view[self.buffer_offset:self.buffer_offset+size])
+            parts.append(part)
+            self.buffer_offset += len(part)
+            self.offset += len(part)
+            size -= len(part)
+            if self.buffer_offset == len(buffer):
+                self.buffer_index += 1
+                self.buffer_offset = 0
+        return b''.join(parts)
+
+
+class OutboundScheduler():
+
+    # Очереди исходящих сообщений одного соединения по приоритетам.
+    # В сокет сообщения отдаются порциями, пока в нём не больше budget байт,
+    # и каждый раз первым идёт самое приоритетное. Большие сообщения режутся на куски
+    # по slice_size, если другая сторона умеет их собирать (FRAGMENTS_FEATURE),
+    # и тогда нажатие клавиши ждёт не весь кадр или кусок файла, а только текущий кусок.
+    # Сокета здесь нет: pull возвращает буферы, которые надо записать
+
+    def __init__(self, slice_size=64*1024):
+        self.slice_size = min(slice_size, FRAGMENT_MAX_SIZE)
+        self.fragments = False
+        self.queues = [deque() for n in range(Priority.COUNT)]
+        self.queued_sizes = [0]*Priority.COUNT
+        self.last_fragment_id = 0
+
+        self.sent_messages = [0]*Priority.COUNT
+        self.sent_bytes = [0]*Priority.COUNT
+        self.sent_fragments = 0
+
+    def push(self, buffers, priority):
+        if isinstance(buffers, (bytes, bytearray)):
+            buffers = [buffers]
+        message = OutboundMessage(buffers)
+        self.queues[priority].append(message)
+        self.queued_sizes[priority] += message.size
+
+    def pending_size(self, max_priority=Priority.COUNT-1):
+        """
+            сколько байт ждёт отправки с приоритетом max_priority и выше
+        """
+        return sum(self.queued_sizes[:max_priority+1])
+
+    def pull(self, budget):
+        """
+            возвращает список буферов, которые можно записать в сокет прямо сейчас,
+            всего примерно на budget байт: целое сообщение или кусок могут его превысить
+        """
+        buffers = []
+        while budget > 0:
+            priority = next((n for n, queue in enumerate(self.queues) if queue), None)
+            if priority is None:
+                break
+            queue = self.queues[priority]
+            message = queue[0]
+            if message.offset == 0 and (message.size <= self.slice_size or not self.fragments):
+                queue.popleft()
+                buffers.extend(message.buffers)
+                sent_size = message.size
+                self.sent_messages[priority] += 1
+            else:
+                if message.fragment_id is None:
+                    self.last_fragment_id = (self.last_fragment_id + 1) & 0xffffffff
+                    message.fragment_id = self.last_fragment_id
+                data = message.take(min(self.slice_size, message.size - message.offset))
+                is_last = message.offset == message.size
+                buffers.append(FRAGMENT_HEADER.pack((FRAGMENT_FLAG << 24) | len(data), message.fragment_id, is_last))
+                buffers.append(data)
+                sent_size = len(data)
+                self.sent_fragments += 1
+                if is_last:
+                    queue.popleft()
+                    self.sent_messages[priority] += 1
+            self.queued_sizes[priority] -= sent_size
+            self.sent_bytes[priority] += sent_size
+            budget -= sent_size
+        return buffers
+
+    def clear(self):
+        for queue in self.queues:
+            queue.clear()
+        self.queued_sizes = [0]*Priority.COUNT
+
+    def info(self):
+        lines = []
+        for name in ('control', 'chat', 'video', 'bulk'):
+            priority = getattr(Priority, name.upper())
+            lines.append(f'{name}: sent {self.sent_messages[priority]} messages, ' + \
+                            f'{self.sent_bytes[priority]/1024:.0f} KB, queued {self.queued_sizes[priority]/1024:.0f} KB')
+        lines.append(f'fragments sent: {self.sent_fragments}')
+        return '\n'.join(lines)
+
+
+class MessageStats():
+
+    # Счётчики принятых сообщений по типам: сколько их пришло, сколько в них байт
+    # и сколько времени ушло на разбор cbor-части и обработку
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.sizes = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def record(self, data_type, size, seconds):
+        self.counts[data_type] += 1
+        self.sizes[data_type] += size
+        self.seconds[data_type] += seconds
+
+    def reset(self):
+        self.counts.clear()
+        self.sizes.clear()
+        self.seconds.clear()
+
+    def info(self, name=str):
+        """
+            name превращает тип сообщения в читаемое имя;
+            сверху типы, на которые ушло больше всего времени
+        """
+        lines = []
+        for data_type in sorted(self.counts, key=self.seconds.get, reverse=True):
+            count = self.counts[data_type]
+            seconds = self.seconds[data_type]
+            lines.append(f'{name(data_type)}: {count} messages, {self.sizes[data_type]/1024:.1f} KB, ' + \
+                            f'{seconds*1000:.1f} ms total, {seconds/count*1000000:.0f} us per message')
+        return '\n'.join(lines) or 'no messages'
+
+
+def xor_fragments(fragments, size):
+    # короткий последний кусок дополняется нулями до size
+    result = 0
+    for fragment in fragments:
+        result ^= int.from_bytes(fragment, 'little')
+    return result.to_bytes(size, 'little')
+
+
+def is_newer_frame(seq, other_seq):
+    # номера кадров идут по кругу через 2**32
+    return 0 < (seq - other_seq) & 0xffffffff < 0x80000000
+
+
+class MediaPacketizer():
+
+    # Режет сообщение кадра на датаграммы с номером кадра;
+    # fec_group - через сколько кусков добавляется датаграмма чётности, 0 - без неё
+
+    def __init__(self, stream_id, fragment_size=MEDIA_FRAGMENT_SIZE, fec_group=0):
+        self.stream_id = stream_id
+        self.fragment_size = fragment_size
+        self.fec_group = fec_group
+        self.seq = 0
+
+        self.sent_frames = 0
+        self.sent_datagrams = 0
+        self.sent_bytes = 0
+
+    def packetize(self, buffers):
+        if isinstance(buffers, (bytes, bytearray, memoryview)):
+            buffers = [buffers]
+        data = b''.join(buffers)
+        fragment_size = self.fragment_size
+        count = max(1, -(-len(data)//fragment_size))
+        if count > 0xffff:
+            raise ValueError(f'frame of {len(data)} bytes does not fit into {0xffff} datagrams')
+        self.seq = (self.seq + 1) & 0xffffffff
+
+        fragments = [data[offset:offset+fragment_size] for offset in range(0, count*fragment_size, fragment_size)]
+        datagrams = []
+        for index, fragment in enumerate(fragments):
+            header = MEDIA_HEADER.pack(self.stream_id, self.seq, MEDIA_DATA, self.fec_group,
+                                            index, count, fragment_size, len(data))
+            datagrams.append(header + fragment)
+        if self.fec_group and count > 1:
+            for group, start in enumerate(range(0, count, self.fec_group)):
+                header = MEDIA_HEADER.pack(self.stream_id, self.seq, MEDIA_PARITY, self.fec_group,
+                                                group, count, fragment_size, len(data))
+                datagrams.append(header + xor_fragments(fragments[start:start+self.fec_group], fragment_size))
+
+        self.sent_frames += 1
+        self.sent_datagrams += len(datagrams)
+        self.sent_bytes += sum(len(datagram) for datagram in datagrams)
+        return datagrams
+
+    def info(self):
+        return f'udp: sent {self.sent_frames} frames in {self.sent_datagrams} datagrams, ' + \
+                    f'{self.sent_bytes/1024:.0f} KB, fec group {self.fec_group or "off"}'
+
+
+class MediaFrame():
+
+    def __init__(self, count, fragment_size, frame_size, fec_group):
+        self.count = count
+        self.fragment_size = fragment_size
+        self.frame_size = frame_size
+        self.fec_group = fec_group
+        self.fragments = {}
+        self.parity = {}
+
+    def fragment_length(self, index):
+        if index == self.count - 1:
+            return self.frame_size - index*self.fragment_size
+        return self.fragment_size
+
+    def recover(self, group):
+        """
+            восстанавливает единственный потерянный кусок группы по её чётности,
+            возвращает True, если кусок восстановлен
+        """
+        if group not in self.parity:
+            return False
+        indices = range(group*self.fec_group, min((group + 1)*self.fec_group, self.count))
+        missing = [index for index in indices if index not in self.fragments]
+        if len(missing) != 1:
+            return False
+        index = missing[0]
+        others = [self.fragments[i] for i in indices if i != index]
+        fragment = xor_fragments(others + [self.parity[group]], self.fragment_size)
+        self.fragments[index] = fragment[:self.fragment_length(index)]
+        return True
+
+    def is_complete(self):
+        return len(self.fragments) == self.count
+
+    def data(self):
+        return b''.join(self.fragments[index] for index in range(self.count))
+
+
+class MediaReassembler():
+
+    # Собирает кадры из датаграмм MediaPacketizer. Одновременно собирается не больше window кадров,
+    # а кадр старее последнего собранного уже не нужен: следующий кадр его заменяет.
+    # Чужие, испорченные и опоздавшие датаграммы молча пропускаются, как и в decode_datagram
+
+    def __init__(self, stream_id, max_frame_size=MESSAGE_MAX_SIZE, window=MEDIA_WINDOW):
+        self.stream_id = stream_id
+        self.max_frame_size = max_frame_size
+        self.window = window
+        self.frames = {}
+        self.last_seq = None
+
+        self.received_frames = 0
+        self.dropped_frames = 0
+        self.recovered_fragments = 0
+        self.late_datagrams = 0
+        self.ignored_datagrams = 0
+
+    def feed(self, datagram):
+        """
+            возвращает собранный кадр или None
+        """
+        if len(datagram) < MEDIA_HEADER.size:
+            self.ignored_datagrams += 1
+            return None
+        stream_id, seq, kind, fec_group, index, count, fragment_size, frame_size = MEDIA_HEADER.unpack_from(datagram)
+        payload = bytes(datagram[MEDIA_HEADER.size:])
+        if stream_id != self.stream_id or not fragment_size or not 0 < frame_size <= self.max_frame_size \
+                                        or count != -(-frame_size//fragment_size):
+            self.ignored_datagrams += 1
+            return None
+        if self.last_seq is not None and not is_newer_frame(seq, self.last_seq):
+            # в том числе чётность и повторы уже собранного кадра
+            self.late_datagrams += 1
+            return None
+
+        frame = self.frames.get(seq)
+        if frame is None:
+            frame = MediaFrame(count, fragment_size, frame_size, fec_group)
+        elif (frame.count, frame.fragment_size, frame.frame_size, frame.fec_group) != (count, fragment_size, frame_size, fec_group):
+            self.ignored_datagrams += 1
+            return None
+
+        if kind == MEDIA_DATA and index < count and len(payload) == frame.fragment_length(index):
+            frame.fragments[index] = payload
+            group = index//fec_group if fec_group else None
+        elif kind == MEDIA_PARITY and fec_group and index*fec_group < count and len(payload) == fragment_size:
+            frame.parity[index] = payload
+            group = index
+        else:
+            self.ignored_datagrams += 1
+            return None
+
+        if seq not in self.frames:
+            self.frames[seq] = frame
+            self.trim_window()
+            if seq not in self.frames:
+                return None
+        if group is not None and frame.recover(group):
+            self.recovered_fragments += 1
+        if not frame.is_complete():
+            return None
+
+        self.last_seq = seq
+        for frame_seq in list(self.frames):
+            if frame_seq == seq or not is_newer_frame(frame_seq, seq):
+                if frame_seq != seq:
+                    self.dropped_frames += 1
+                del self.frames[frame_seq]
+        self.received_frames += 1
+        return frame.data()
+
+    def trim_window(self):
+        # самые старые недособранные кадры уступают место новым
+        while len(self.frames) > self.window:
+            oldest = next(iter(self.frames))
+            for seq in self.frames:
+                if is_newer_frame(oldest, seq):
+                    oldest = seq
+            del self.frames[oldest]
+            self.dropped_frames += 1
+
+    def info(self):
+        return f'udp: received {self.received_frames} frames, dropped {self.dropped_frames} incomplete, ' + \
+                    f'recovered {self.recovered_fragments} datagrams, {self.late_datagrams} late, ' + \
+                    f'ignored {self.ignored_datagrams}'
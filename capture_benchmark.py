@@ -0,0 +1,55 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import argparse
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QRect
+
+from _capture import (available_backends, benchmark_backend)
+
+# Замер скорости всех доступных бэкендов захвата экрана.
+# В Linux можно гонять и без монитора: xvfb-run -s "-screen 0 1920x1080x24" python capture_benchmark.py
+
+def main():
+    parser = argparse.ArgumentParser(description='capture backends benchmark')
+    parser.add_argument('--frames', type=int, default=100)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    screens = [(screen, screen.geometry()) for screen in app.screens()]
+    first_screen_rect = screens[0][1]
+    small_rect = QRect(first_screen_rect.topLeft(), first_screen_rect.size().boundedTo(QRect(0, 0, 640, 480).size()))
+    regions = (
+        ('first screen', first_screen_rect),
+        ('640x480 region', small_rect),
+    )
+
+    print(f'platform: {app.platformName()}, screens: {[geometry for screen, geometry in screens]}')
+    for backend in available_backends():
+        for region_name, rect in regions:
+            duration = benchmark_backend(backend, rect, screens, frames=args.frames)
+            print(f'{backend.name:>5} {region_name:>15}: {duration*1000:.2f} ms per frame, {1/duration:.0f} FPS max')
+        if hasattr(backend, 'close'):
+            backend.close()
+
+if __name__ == '__main__':
+    main()
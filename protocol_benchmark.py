@@ -0,0 +1,330 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+#  Author: Sergei Krumas (github.com/sergkrumas)
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import io
+import zlib
+import time
+import random
+import argparse
+
+import cbor2
+from PyQt5.QtGui import QImage
+
+from _protocol import (HEADER, COMPRESSIONS, MessageReader, MessageCompressor, OutboundScheduler, Priority, ProtocolError,
+                            MediaPacketizer, MediaReassembler,
+                            encode_message, encode_datagram, decode_datagram, pack_input_event, unpack_input_event,
+                            zlib_decompress)
+from _frame_codecs import RAW_HEADER, RawCodec, zlib_compress_fast
+
+# Замер скорости разбора входящего TCP-потока: прежний разбор через склейку и нарезку bytes
+# против MessageReader. Поток подаётся кусками, как его отдаёт сокет.
+# Отдельно замеряются события мыши и клавиатуры: cbor-сообщения против коротких сообщений,
+# и скорость MessageReader.events на смеси мелких сообщений.
+# Для кадров по UDP считается, сколько кадров доходит при разных потерях датаграмм с FEC и без.
+# Кодеки сжатия сообщений замеряются на тексте, похожем на лог, и на случайных байтах.
+# С --fuzz разбор проверяется на испорченных потоках и датаграммах: кроме ProtocolError
+# никаких исключений быть не должно, в том числе у сырых кадров с подложным заголовком
+
+READ_SIZE = 200000
+
+
+def build_stream(message_size, messages_count):
+    serial_data = cbor2.dumps({10: {'rect': [0, 0, 1920, 1080], 'capture_index': 0}})
+    binary_data = bytes(message_size)
+    message = HEADER.pack(len(serial_data) + len(binary_data), len(serial_data), len(binary_data)) + serial_data + binary_data
+    return message*messages_count
+
+
+def parse_legacy(stream, chunk_size):
+    # так Connection.processReadyRead разбирал поток раньше:
+    # буфер склеивается заново на каждом чтении, а сообщение разбирается одно за вызов
+    socket_buffer = b''
+    messages_count = 0
+    content_size = None
+    position = 0
+    while position < len(stream) or socket_buffer:
+        socket_buffer = socket_buffer + stream[position:position+chunk_size]
+        position += chunk_size
+        while True:
+            if content_size is None:
+                if len(socket_buffer) < HEADER.size:
+                    break
+                content_size, serial_size, binary_size = HEADER.unpack(socket_buffer[:HEADER.size])
+                socket_buffer = socket_buffer[HEADER.size:]
+            if len(socket_buffer) < content_size:
+                break
+            serial_data = socket_buffer[:serial_size]
+            socket_buffer = socket_buffer[serial_size:]
+            binary_data = socket_buffer[:binary_size]
+            socket_buffer = socket_buffer[binary_size:]
+            content_size = None
+            messages_count += 1
+        if position >= len(stream) and content_size is not None:
+            break
+    return messages_count
+
+
+def parse_reader(stream, chunk_size):
+    reader = MessageReader()
+    messages_count = 0
+    for position in range(0, len(stream), chunk_size):
+        reader.feed(stream[position:position+chunk_size])
+        for serial_data, binary_data in reader.messages():
+            messages_count += 1
+    return messages_count
+
+
+INPUT_EVENTS_SAMPLE = (
+    (11, 'mousePos', [1203, 755]),
+    (11, 'mousePos', [1210, 751]),
+    (11, 'mouseDown', 'left'),
+    (11, 'mouseUp', 'left'),
+    (11, 'mouseWheel', 0.5),
+    (12, 'keyDown', 'shift'),
+    (12, 'keyUp', 'a'),
+)
+
+
+def build_cbor_event(data_type, event_type, value):
+    serial_data = cbor2.dumps({data_type: {event_type: value}})
+    return HEADER.pack(len(serial_data), len(serial_data), 0) + serial_data
+
+
+def bench_input_events(events_count):
+    events = [INPUT_EVENTS_SAMPLE[n % len(INPUT_EVENTS_SAMPLE)] for n in range(events_count)]
+
+    start = time.perf_counter()
+    stream = b''.join(build_cbor_event(*event) for event in events)
+    encode_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    reader = MessageReader()
+    reader.feed(stream)
+    for serial_data, binary_data in reader.messages():
+        data_type, value = list(cbor2.loads(serial_data).items())[0]
+        event_type, event_value = list(value.items())[0]
+    decode_duration = time.perf_counter() - start
+    yield 'cbor', len(stream), encode_duration, decode_duration
+
+    start = time.perf_counter()
+    stream = b''.join(pack_input_event(event_type, value) for data_type, event_type, value in events)
+    encode_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    reader = MessageReader()
+    reader.feed(stream)
+    for serial_data, binary_data in reader.messages():
+        event_type, event_value, timestamp = unpack_input_event(binary_data)
+    decode_duration = time.perf_counter() - start
+    yield 'compact', len(stream), encode_duration, decode_duration
+
+
+def build_log_text(size):
+    lines = []
+    for n in range(size//60 + 1):
+        lines.append(f'2026-10-18 12:{n//60 % 60:02d}:{n % 60:02d} INFO worker {n % 7}: processed item {n*37 % 1000}\n')
+    return ''.join(lines).encode()[:size]
+
+
+def bench_compression(megabytes):
+    samples = (('log text', build_log_text(200000)), ('random', random.Random(0).randbytes(200000)))
+    for name, compression in COMPRESSIONS.items():
+        compressor = MessageCompressor()
+        compressor.compression = compression
+        for sample_name, data in samples:
+            buffers = encode_message({13: {'filename': 'sample'}}, data)
+            repeats = max(1, megabytes*1000*1000//len(data))
+            start = time.perf_counter()
+            for n in range(repeats):
+                compressed = compressor.compress(buffers)
+            duration = time.perf_counter() - start
+            size = sum(len(buffer) for buffer in compressed)
+            yield name, sample_name, size/len(data), len(data)*repeats/duration
+
+
+def build_mixed_stream(fragments=False):
+    # управляющие сообщения, события ввода, кадр и кусок файла, как они идут по сокету
+    scheduler = OutboundScheduler(slice_size=4096)
+    scheduler.fragments = fragments
+    scheduler.push(encode_message({2: {'msg': 'user', 'mac': '00:11:22:33:44:55', 'status': '', 'features': []}}), Priority.CONTROL)
+    scheduler.push(encode_message({1: 'hello'}), Priority.CHAT)
+    scheduler.push(encode_message({26: {'size': [1280, 720], 'dpr': 1.0}}), Priority.CONTROL)
+    scheduler.push(encode_message({14: {'tiles': [[0, 0, 64, 64, 300]], 'codec': 'png'}}, bytes(300)), Priority.VIDEO)
+    scheduler.push(encode_message({13: {'filename': 'a.txt', 'chunk_size': 10000}}, bytes(range(256))*40), Priority.BULK)
+    scheduler.push(encode_message({13: {'filename': 'a.txt', 'chunk_size': 80000}}, bytes(range(256))*320), Priority.BULK)
+    for event_type, value in (('mousePos', [10, 20]), ('mouseWheel', -1.0), ('keyHotkey', ['ctrl', 'c'])):
+        scheduler.push(pack_input_event(event_type, value, timestamp=123456), Priority.CONTROL)
+    compressor = MessageCompressor()
+    compressor.compression = COMPRESSIONS['zlib']
+    scheduler.push(compressor.compress(encode_message({13: {'filename': 'b.log'}}, build_log_text(10000))), Priority.BULK)
+    return b''.join(bytes(buffer) for buffer in scheduler.pull(1 << 30))
+
+
+def bench_events(events_count):
+    stream = build_mixed_stream()
+    reader = MessageReader()
+    reader.feed(stream)
+    sample_count = sum(1 for event in reader.events())
+    repeats = max(1, events_count//sample_count)
+    stream = stream*repeats
+    start = time.perf_counter()
+    reader = MessageReader()
+    reader.feed(stream)
+    parsed_count = sum(1 for event in reader.events())
+    duration = time.perf_counter() - start
+    assert parsed_count == sample_count*repeats
+    return parsed_count, duration
+
+
+def bench_media(frames_count, frame_size, loss, fec_group, seed=0):
+    # датаграммы теряются случайно и независимо, а часть приходит не по порядку
+    rng = random.Random(seed)
+    packetizer = MediaPacketizer(1, fec_group=fec_group)
+    reassembler = MediaReassembler(1)
+    frame = bytes(rng.randrange(256) for i in range(frame_size))
+    for n in range(frames_count):
+        datagrams = [d for d in packetizer.packetize(frame) if rng.random() >= loss]
+        for k in range(len(datagrams)//20):
+            a, b = rng.randrange(len(datagrams)), rng.randrange(len(datagrams))
+            datagrams[a], datagrams[b] = datagrams[b], datagrams[a]
+        for datagram in datagrams:
+            data = reassembler.feed(datagram)
+            assert data is None or data == frame
+    return reassembler.received_frames, packetizer.sent_bytes
+
+
+def check_forged_raw_frames():
+    # заголовок обещает огромный кадр, а пикселей за ним почти нет: раньше QImage читал за концом буфера
+    codec = RawCodec('raw-zlib', zlib_compress_fast, zlib_decompress)
+    forged_frames = [
+        RAW_HEADER.pack(4000, 4000) + zlib.compress(bytes(16)),
+        RAW_HEADER.pack(0xffffffff, 0xffffffff) + zlib.compress(bytes(16)),
+        RAW_HEADER.pack(0, 100) + zlib.compress(b''),
+        # бомба: 400 МБ нулей в паре сотен КБ
+        RAW_HEADER.pack(100, 100) + zlib.compress(bytes(400*1024*1024), 9),
+        RAW_HEADER.pack(4, 4) + b'not zlib',
+        RAW_HEADER.pack(4, 4)[:5],
+    ]
+    for data in forged_frames:
+        try:
+            codec.decode(data)
+        except ProtocolError:
+            continue
+        raise AssertionError(f'forged raw frame {data[:RAW_HEADER.size].hex()} has been decoded')
+
+
+def fuzz(iterations, seed):
+    """
+        возвращает, сколько испорченных потоков закончилось ProtocolError;
+        любое другое исключение - это ошибка в разборе
+    """
+    rng = random.Random(seed)
+    streams = [build_mixed_stream(), build_mixed_stream(fragments=True)]
+    media_packetizer = MediaPacketizer(1, fec_group=4)
+    media_datagrams = media_packetizer.packetize(bytes(range(256))*40) + media_packetizer.packetize(b'frame')
+    media_reassembler = MediaReassembler(1, max_frame_size=16*1024, window=2)
+    raw_codec = RawCodec('raw-zlib', zlib_compress_fast, zlib_decompress)
+    image = QImage(16, 8, QImage.Format_RGB32)
+    image.fill(0x336699)
+    raw_frame = bytes(raw_codec.encode(image, 100))
+    check_forged_raw_frames()
+    errors_count = 0
+    for n in range(iterations):
+        data = bytearray(rng.choice(streams))
+        for k in range(rng.randint(1, 8)):
+            position = rng.randrange(len(data))
+            action = rng.random()
+            if action < 0.6:
+                data[position] = rng.randrange(256)
+            elif action < 0.8:
+                del data[position:position+rng.randint(1, 16)]
+            else:
+                data[position:position] = bytes(rng.randrange(256) for i in range(rng.randint(1, 16)))
+        reader = MessageReader(size_limits={13: 100000}, default_size_limit=16*1024,
+                                open_sink=lambda data_type, value, size: io.BytesIO() if data_type == 13 else None)
+        read_size = rng.randint(1, 2048)
+        try:
+            for position in range(0, len(data), read_size):
+                reader.feed(data[position:position+read_size])
+                for event in reader.events():
+                    pass
+        except ProtocolError:
+            errors_count += 1
+
+        datagram = bytearray(encode_datagram(['user', rng.randrange(65536)]))
+        datagram[rng.randrange(len(datagram))] = rng.randrange(256)
+        decode_datagram(bytes(datagram[:rng.randint(0, len(datagram))]))
+
+        frame = bytearray(raw_frame)
+        frame[rng.randrange(len(frame))] = rng.randrange(256)
+        try:
+            raw_codec.decode(bytes(frame[:rng.randint(0, len(frame))]))
+        except ProtocolError:
+            pass
+
+        datagram = bytearray(rng.choice(media_datagrams))
+        datagram[rng.randrange(len(datagram))] = rng.randrange(256)
+        media_reassembler.feed(bytes(datagram[:rng.randint(0, len(datagram))]))
+    return errors_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TCP message parsing benchmark')
+    parser.add_argument('--megabytes', type=int, default=64, help='stream size for every message size')
+    parser.add_argument('--chunk', type=int, default=READ_SIZE, help='bytes per socket read')
+    parser.add_argument('--events', type=int, default=200000, help='input events count')
+    parser.add_argument('--fuzz', type=int, default=0, help='check the parser on this many broken streams and exit')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for --fuzz')
+    args = parser.parse_args()
+
+    if args.fuzz:
+        start = time.perf_counter()
+        errors_count = fuzz(args.fuzz, args.seed)
+        duration = time.perf_counter() - start
+        print(f'fuzz: {args.fuzz} broken streams in {duration:.1f} s, {errors_count} rejected with ProtocolError, no other exceptions')
+        return
+
+    for name, sample_name, ratio, speed in bench_compression(max(1, args.megabytes//4)):
+        print(f'{name:>5} compression, {sample_name:>8}: sent {ratio:6.1%} of the message, {speed/1e6:7.1f} MB/s')
+
+    for loss in (0.001, 0.01, 0.05):
+        for fec_group in (0, 8):
+            frames_count = 200
+            received_count, sent_bytes = bench_media(frames_count, 100*1000, loss, fec_group)
+            print(f'udp frames of 100 KB, {loss:5.1%} datagrams lost, fec group {fec_group or "off"}: ' + \
+                    f'{received_count/frames_count:6.1%} frames delivered, {sent_bytes/frames_count/1000:.1f} KB sent per frame')
+
+    parsed_count, duration = bench_events(args.events)
+    print(f'mixed small messages: {parsed_count/duration:9.0f} events/s through MessageReader.events')
+
+    for name, size, encode_duration, decode_duration in bench_input_events(args.events):
+        print(f'{name:>7} input events: {size/args.events:5.1f} bytes per event, ' + \
+                f'encode {encode_duration/args.events*1e6:.2f} us, decode {decode_duration/args.events*1e6:.2f} us per event')
+
+    for message_size in (100, 1000, 16*1000, 200*1000, 1000*1000, 4*1000*1000):
+        messages_count = max(1, args.megabytes*1000*1000//message_size)
+        stream = build_stream(message_size, messages_count)
+        for name, parse in (('legacy', parse_legacy), ('reader', parse_reader)):
+            start = time.perf_counter()
+            parsed_count = parse(stream, args.chunk)
+            duration = time.perf_counter() - start
+            assert parsed_count == messages_count, (name, parsed_count, messages_count)
+            print(f'{name:>6} {message_size:>8} bytes: {len(stream)/duration/1e6:8.1f} MB/s, {messages_count/duration:9.0f} messages/s')
+
+if __name__ == '__main__':
+    main()